@@ -1,8 +1,5 @@
-from flask import Flask, render_template, request, redirect, url_for, session, jsonify, abort, g
+from flask import Flask, Request, Response, render_template, request, redirect, url_for, session, jsonify, abort, g, send_file
 from flask_session import Session
-import psycopg2
-from psycopg2.extras import Json
-import pandas as pd
 import io
 import os
 import re
@@ -15,9 +12,88 @@ import math
 import datetime
 import unicodedata
 import glob
+import codecs
+import contextlib
+import hashlib
+import importlib
+import importlib.util
+import itertools
+import bisect
+import mmap
+import gzip
+import bz2
+import lzma
+import zipfile
+import time
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
 from werkzeug.utils import secure_filename
-from thefuzz import fuzz
+from werkzeug.exceptions import HTTPException, RequestEntityTooLarge, TooManyRequests
 from decimal import Decimal
+import statistics
+import subprocess
+import sys
+import sqlite3
+import click
+
+# ---------- IMPORTAÇÕES TARDIAS ---------- #
+# pandas, numpy, pyarrow, psycopg2 e thefuzz respondem pela maior parte do tempo de importação do app.
+# Cada um entra como um substituto que importa o módulo no primeiro uso e então se troca pelo módulo
+# nos globais, de modo que os acessos seguintes não têm custo extra. O openpyxl já só é carregado
+# pelo pandas ao ler um .xlsx.
+
+class ModuloTardio:
+    """Substituto de um módulo pesado: importa no primeiro acesso a um atributo."""
+
+    def __init__(self, apelido, nome, *submodulos):
+        self._apelido = apelido
+        self._nome = nome
+        self._submodulos = submodulos
+
+    def carregar(self):
+        modulo = importlib.import_module(self._nome)
+        for submodulo in self._submodulos:
+            importlib.import_module(submodulo)
+        globals()[self._apelido] = modulo
+        return modulo
+
+    def __getattr__(self, atributo):
+        return getattr(self.carregar(), atributo)
+
+    def __repr__(self):
+        return f"<módulo tardio '{self._nome}'>"
+
+pd = ModuloTardio('pd', 'pandas')
+np = ModuloTardio('np', 'numpy')
+psycopg2 = ModuloTardio('psycopg2', 'psycopg2', 'psycopg2.extras', 'psycopg2.errors')
+fuzz = ModuloTardio('fuzz', 'thefuzz.fuzz')
+
+# Armazenamento de texto compacto (Arrow) quando disponível; o dtype vai como texto para não importar o pandas aqui
+if importlib.util.find_spec('pyarrow') is not None:
+    pa = ModuloTardio('pa', 'pyarrow')
+    pa_csv = ModuloTardio('pa_csv', 'pyarrow.csv')
+    pa_compute = ModuloTardio('pa_compute', 'pyarrow.compute')
+    TIPO_TEXTO = 'string[pyarrow]'
+else:
+    pa = None
+    TIPO_TEXTO = 'string[python]'
+
+def precarregar_modulos():
+    """Importa de uma vez os módulos tardios ainda pendentes."""
+    for valor in list(globals().values()):
+        if isinstance(valor, ModuloTardio):
+            valor.carregar()
+
+# Num servidor que importa o app no processo pai e depois faz fork dos workers (ex.: gunicorn --preload),
+# pré-carregar faz os workers herdarem os módulos já importados em vez de cada um pagar a importação
+if os.environ.get('PRECARREGAR_MODULOS') == '1':
+    precarregar_modulos()
+
+# Colunas com poucos valores distintos (proporção ao total de linhas) viram categóricas
+FRACAO_MAX_CATEGORIA = 0.5
+MIN_LINHAS_CATEGORIA = 1000
 
 app = Flask(__name__)
 app.config['UPLOAD_FOLDER'] = 'uploads'
@@ -31,65 +107,699 @@ app.config['SESSION_FILE_DIR'] = os.path.join(app.root_path, 'flask_session')
 app.config['SESSION_PERMANENT'] = False
 Session(app)
 
+# Limites de upload (0 desativa o limite). O total da requisição é recusado antes da leitura do corpo.
+app.config['UPLOAD_MAX_BYTES'] = int(os.environ.get('UPLOAD_MAX_MB', 500)) * 1024 * 1024
+app.config['UPLOAD_MAX_LINHAS'] = int(os.environ.get('UPLOAD_MAX_LINHAS', 0))
+app.config['MAX_CONTENT_LENGTH'] = int(os.environ.get('UPLOAD_MAX_TOTAL_MB', 2048)) * 1024 * 1024 or None
+TAMANHO_BLOCO_UPLOAD = 1024 * 1024
+EXTENSOES_UPLOAD = ['.csv', '.txt', '.xlsx']
+# Compactados são lidos em fluxo; de um .zip entram só os membros de texto, cada um como um arquivo
+EXTENSOES_COMPACTADAS = {'.gz': 'gzip', '.bz2': 'bz2', '.xz': 'xz', '.zip': 'zip'}
+EXTENSOES_MEMBRO = ['.csv', '.txt']
+ZIP_MAX_MEMBROS = 50
+
+# Pastas de trabalho por sessão: expiram após o TTL sem uso e, acima da cota total, as mais antigas saem primeiro
+app.config['UPLOAD_TTL_MINUTOS'] = int(os.environ.get('UPLOAD_TTL_MINUTOS', 120))
+app.config['UPLOAD_COTA_MB'] = int(os.environ.get('UPLOAD_COTA_MB', 10240))
+app.config['UPLOAD_COLETA_SEGUNDOS'] = int(os.environ.get('UPLOAD_COLETA_SEGUNDOS', 300))
+
+def verificar_limites_upload(tamanho, linhas):
+    limite_bytes = app.config['UPLOAD_MAX_BYTES']
+    if limite_bytes and tamanho > limite_bytes:
+        raise RequestEntityTooLarge(f'O arquivo excede o limite de {limite_bytes / (1024 * 1024):g} MB.')
+    limite_linhas = app.config['UPLOAD_MAX_LINHAS']
+    if limite_linhas and linhas > limite_linhas:
+        raise RequestEntityTooLarge(f'O arquivo excede o limite de {limite_linhas} linhas.')
+
+class ArquivoUploadHash:
+    """Arquivo em disco que calcula hash, tamanho e linhas enquanto o upload é gravado em blocos."""
+
+    def __init__(self, pasta=None, progresso=None):
+        self._arquivo = tempfile.NamedTemporaryFile(dir=pasta or app.config['UPLOAD_FOLDER'], prefix='.upload_', delete=False)
+        self.caminho = self._arquivo.name
+        self.progresso = progresso
+        self._hash = hashlib.sha256()
+        self._ultimo_byte = b''
+        self.tamanho = 0
+        self.linhas = 0
+        self.persistido = False
+
+    def write(self, dados):
+        self.tamanho += len(dados)
+        self.linhas += dados.count(b'\n')
+        try:
+            verificar_limites_upload(self.tamanho, self.linhas)
+        except RequestEntityTooLarge:
+            self.close()
+            raise
+        try:
+            ARMAZENAMENTO_UPLOADS.reservar(len(dados))
+        except RequestEntityTooLarge:
+            self.close()
+            raise
+        self._hash.update(dados)
+        if dados:
+            self._ultimo_byte = dados[-1:]
+            if self.progresso:
+                self.progresso.avancar(len(dados))
+        return self._arquivo.write(dados)
+
+    def persistir(self, destino):
+        """Move o arquivo temporário para `destino` (sem copiar) e devolve as métricas do upload."""
+        self._arquivo.close()
+        os.replace(self.caminho, destino)
+        self.persistido = True
+        linhas = self.linhas + (1 if self.tamanho and self._ultimo_byte != b'\n' else 0)
+        return {'caminho': destino, 'tamanho': self.tamanho, 'hash': self._hash.hexdigest(), 'linhas': linhas}
+
+    def close(self):
+        self._arquivo.close()
+        if not self.persistido and os.path.exists(self.caminho):
+            os.remove(self.caminho)
+
+    def __getattr__(self, nome):
+        return getattr(self._arquivo, nome)
+
+class RequestUpload(Request):
+    """Grava os arquivos de formulário direto na pasta de uploads, sem cópia intermediária em memória."""
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        progresso = progresso_requisicao()
+        if progresso and progresso.estado['etapa'] != 'upload':
+            progresso.etapa('upload', total=total_content_length or 0, unidade='bytes')
+        # A API não usa sessão: recebe numa pasta comum e move para api-<hash> depois
+        pasta = ARMAZENAMENTO_UPLOADS.pasta('api') if self.endpoint == 'api_validar' else pasta_upload_sessao()
+        return ArquivoUploadHash(pasta, progresso=progresso)
+
+app.request_class = RequestUpload
+
+def gravar_upload(file, destino):
+    """Persiste o arquivo recebido em `destino`, devolvendo tamanho, hash SHA-256 e total de linhas."""
+    if isinstance(file.stream, ArquivoUploadHash):
+        return file.stream.persistir(destino)
+    arquivo = ArquivoUploadHash(os.path.dirname(destino) or None)
+    try:
+        while True:
+            bloco = file.stream.read(TAMANHO_BLOCO_UPLOAD)
+            if not bloco:
+                break
+            arquivo.write(bloco)
+        return arquivo.persistir(destino)
+    finally:
+        arquivo.close()
+
+# ---------- ARMAZENAMENTO DE UPLOADS ---------- #
+# Cada sessão grava seus arquivos em UPLOAD_FOLDER/<chave>, então o reset de um usuário não apaga
+# os arquivos de outro. Um coletor em segundo plano (um por processo; remoções concorrentes são
+# inofensivas) apaga as pastas sem uso há mais que o TTL e, se o total passar da cota, as usadas
+# há mais tempo. Pastas tocadas nos últimos minutos nunca são removidas pela cota.
+
+UPLOAD_EM_USO_SEGUNDOS = 600
+
+class ArmazenamentoUploads:
+    """Pastas de trabalho por sessão dentro de `raiz`, com uso de disco contabilizado e coleta por TTL e cota."""
+
+    def __init__(self, raiz):
+        self.raiz = raiz
+        self.uso_bytes = 0
+        self._lock = threading.Lock()
+        self._coletor_pid = None
+
+    @property
+    def cota_bytes(self):
+        return app.config['UPLOAD_COTA_MB'] * 1024 * 1024
+
+    def pasta(self, chave):
+        """Cria (ou reaproveita) a pasta da chave e marca o uso agora."""
+        caminho = os.path.join(self.raiz, chave)
+        os.makedirs(caminho, exist_ok=True)
+        os.utime(caminho)
+        return caminho
+
+    def descartar(self, chave):
+        caminho = os.path.join(self.raiz, chave)
+        tamanho = self._tamanho_pasta(caminho)
+        shutil.rmtree(caminho, ignore_errors=True)
+        with self._lock:
+            self.uso_bytes = max(0, self.uso_bytes - tamanho)
+
+    def reservar(self, tamanho):
+        """Contabiliza bytes gravados; ao estourar a cota tenta coletar antes de recusar."""
+        cota = self.cota_bytes
+        with self._lock:
+            self.uso_bytes += tamanho
+            dentro = not cota or self.uso_bytes <= cota
+        if not dentro and self.coletar() > cota:
+            with self._lock:
+                self.uso_bytes -= tamanho
+            raise RequestEntityTooLarge('Espaço reservado para uploads esgotado. Tente novamente mais tarde.')
+
+    @staticmethod
+    def _tamanho_pasta(caminho):
+        tamanho = 0
+        for pasta, _, arquivos in os.walk(caminho):
+            for nome in arquivos:
+                with contextlib.suppress(OSError):
+                    tamanho += os.path.getsize(os.path.join(pasta, nome))
+        return tamanho
+
+    def _entradas(self):
+        """(caminho, bytes, último uso) de cada pasta de sessão e de cada arquivo solto na raiz."""
+        entradas = []
+        for item in os.scandir(self.raiz):
+            try:
+                if item.is_dir(follow_symlinks=False):
+                    entradas.append((item.path, self._tamanho_pasta(item.path), item.stat().st_mtime))
+                elif item.is_file(follow_symlinks=False):
+                    info = item.stat()
+                    entradas.append((item.path, info.st_size, info.st_mtime))
+            except OSError:
+                continue
+        return entradas
+
+    def coletar(self):
+        """Remove o que expirou pelo TTL e, acima da cota, o uso mais antigo. Devolve o uso restante."""
+        agora = time.time()
+        ttl = app.config['UPLOAD_TTL_MINUTOS'] * 60
+        cota = self.cota_bytes
+        restantes = []
+        for caminho, tamanho, ultimo_uso in self._entradas():
+            if ttl and agora - ultimo_uso > ttl:
+                self._remover(caminho)
+            else:
+                restantes.append((ultimo_uso, caminho, tamanho))
+        uso = sum(t for _, _, t in restantes)
+        if cota and uso > cota:
+            for ultimo_uso, caminho, tamanho in sorted(restantes):
+                if uso <= cota:
+                    break
+                if agora - ultimo_uso < UPLOAD_EM_USO_SEGUNDOS:
+                    continue
+                self._remover(caminho)
+                uso -= tamanho
+        with self._lock:
+            self.uso_bytes = uso
+        return uso
+
+    @staticmethod
+    def _remover(caminho):
+        if os.path.isdir(caminho):
+            shutil.rmtree(caminho, ignore_errors=True)
+        else:
+            with contextlib.suppress(OSError):
+                os.remove(caminho)
+
+    def iniciar_coletor(self):
+        """Sobe a thread de coleta deste processo (de novo após um fork)."""
+        with self._lock:
+            if self._coletor_pid == os.getpid():
+                return
+            self._coletor_pid = os.getpid()
+        threading.Thread(target=self._coletor, name='coletor-uploads', daemon=True).start()
+
+    def _coletor(self):
+        while True:
+            try:
+                self.coletar()
+            except Exception as e:
+                print(f"Erro na coleta de uploads: {e}")
+            time.sleep(app.config['UPLOAD_COLETA_SEGUNDOS'])
+
+ARMAZENAMENTO_UPLOADS = ArmazenamentoUploads(app.config['UPLOAD_FOLDER'])
+
+@app.before_request
+def iniciar_coletor_uploads():
+    ARMAZENAMENTO_UPLOADS.iniciar_coletor()
+
+def pasta_upload_sessao():
+    """Pasta de trabalho da sessão atual, criada no primeiro upload."""
+    if 'pasta_upload' not in session:
+        session['pasta_upload'] = secrets.token_hex(16)
+    return ARMAZENAMENTO_UPLOADS.pasta(session['pasta_upload'])
+
+def descartar_uploads_sessao():
+    chave = session.get('pasta_upload')
+    if chave:
+        ARMAZENAMENTO_UPLOADS.descartar(chave)
+
+# ---------- PROGRESSO ---------- #
+# Uploads e análises longas publicam o andamento num registro em memória do processo, lido pelo
+# endpoint SSE /validador/<tipo>/progresso. O navegador gera o identificador e o envia na query
+# string do formulário. Os ganchos são chamados por bloco gravado, por arquivo lido e por campo
+# analisado, nunca por linha.
+# Com vários workers o SSE pode cair em outro processo: cada progresso também é gravado (no máximo
+# a cada PROGRESSO_INTERVALO, fora da trava dos leitores) num arquivo em PROGRESSO_DIR, que o SSE consulta quando a chave não é
+# do próprio processo. Isso cobre workers na mesma máquina; com várias máquinas, PROGRESSO_DIR
+# precisa ser compartilhado entre elas ou o balanceador precisa de sessão fixa (sticky). Sem
+# progresso, o navegador mantém as mensagens de espera.
+
+PADRAO_CHAVE_PROGRESSO = re.compile(r'[A-Za-z0-9_-]{8,64}')
+PROGRESSO_TTL = 300          # segundos que um progresso encerrado continua consultável
+PROGRESSO_ESPERA = 30        # segundos que o SSE aguarda a requisição correspondente começar
+PROGRESSO_HEARTBEAT = 15     # comentário periódico para manter a conexão aberta em proxies
+PROGRESSO_INTERVALO = 0.25   # intervalo mínimo entre eventos; atualizações no meio são agregadas
+PROGRESSO_DIR = os.environ.get('PROGRESSO_DIR', os.path.join(
+    '/dev/shm' if os.access('/dev/shm', os.W_OK) else tempfile.gettempdir(), 'datacheck-progresso'))
+
+_progressos = {}
+_progressos_cond = threading.Condition()
+
+def caminho_progresso(chave):
+    return os.path.join(PROGRESSO_DIR, f'{chave}.json')
+
+def ler_progresso_compartilhado(chave):
+    """Último estado gravado por outro processo, com a 'versao', ou None."""
+    try:
+        with open(caminho_progresso(chave), encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+class Progresso:
+    """Andamento de uma requisição: etapa, quantidade feita/total, campos analisados e inconsistências parciais."""
+
+    def __init__(self, chave):
+        self.chave = chave
+        self.versao = 0
+        self.encerrado_em = None
+        self._inicio_etapa = time.monotonic()
+        self._gravado_em = 0.0
+        self._versao_gravada = -1
+        self._trava_arquivo = threading.Lock()
+        self.estado = {'etapa': 'aguardando', 'feito': 0, 'total': 0, 'unidade': '', 'campos': [],
+                       'linhas_validadas': 0, 'inconsistencias': 0, 'invalidos': 0}
+
+    def _publicar(self, gravar=False):
+        """Chamado com _progressos_cond: avisa os leitores e devolve o estado a gravar (ou None)."""
+        self.versao += 1
+        _progressos_cond.notify_all()
+        # Avanços por bloco só chegam ao arquivo a cada intervalo; etapas e o encerramento sempre
+        if gravar or time.monotonic() - self._gravado_em >= PROGRESSO_INTERVALO:
+            self._gravado_em = time.monotonic()
+            return dict(self.resumo(), versao=self.versao)
+        return None
+
+    def _gravar(self, instantaneo):
+        """Grava o estado de _publicar já fora de _progressos_cond; um estado mais antigo não sobrescreve um novo."""
+        if instantaneo is None:
+            return
+        caminho = caminho_progresso(self.chave)
+        temporario = f'{caminho}.{os.getpid()}.{threading.get_ident()}'
+        with self._trava_arquivo:
+            if instantaneo['versao'] <= self._versao_gravada:
+                return
+            try:
+                os.makedirs(PROGRESSO_DIR, exist_ok=True)
+                with open(temporario, 'w', encoding='utf-8') as f:
+                    json.dump(instantaneo, f)
+                os.replace(temporario, caminho)
+                self._versao_gravada = instantaneo['versao']
+            except OSError as e:
+                print(f"Erro ao gravar o progresso {self.chave}: {e}")
+
+    def etapa(self, nome, total=0, unidade='', **info):
+        """Inicia uma etapa; `info` (arquivo, linhas...) fica no estado até ser sobrescrito."""
+        with _progressos_cond:
+            self._inicio_etapa = time.monotonic()
+            self.estado.update(info, etapa=nome, feito=0, total=total, unidade=unidade)
+            if nome == 'analise':
+                self.estado.update(campos=[], linhas_validadas=0, inconsistencias=0, invalidos=0)
+            instantaneo = self._publicar(gravar=True)
+        self._gravar(instantaneo)
+
+    def avancar(self, quantidade=1):
+        with _progressos_cond:
+            self.estado['feito'] += quantidade
+            instantaneo = self._publicar()
+        self._gravar(instantaneo)
+
+    def campo_avaliado(self, label, validos, invalidos, inconsistencias):
+        """Registra um campo concluído com suas contagens parciais."""
+        with _progressos_cond:
+            validos, invalidos = int(validos), int(invalidos)
+            self.estado['campos'].append({'campo': label, 'validos': validos, 'invalidos': invalidos,
+                                          'inconsistencias': inconsistencias})
+            self.estado['linhas_validadas'] += validos + invalidos
+            self.estado['invalidos'] += invalidos
+            self.estado['inconsistencias'] += inconsistencias
+            self.estado['feito'] += 1
+            instantaneo = self._publicar()
+        self._gravar(instantaneo)
+
+    def encerrar(self, erro=None):
+        with _progressos_cond:
+            if self.encerrado_em is not None:
+                return
+            self.encerrado_em = time.monotonic()
+            self.estado.update(etapa='erro' if erro else 'concluido', erro=erro)
+            instantaneo = self._publicar(gravar=True)
+        self._gravar(instantaneo)
+
+    def resumo(self):
+        """Cópia do estado com tempo decorrido da etapa e estimativa de término (segundos)."""
+        decorrido = time.monotonic() - self._inicio_etapa
+        feito, total = self.estado['feito'], self.estado['total']
+        eta = decorrido * (total - feito) / feito if feito and total > feito else None
+        return dict(self.estado, campos=list(self.estado['campos']), decorrido=round(decorrido, 1),
+                    eta=round(eta, 1) if eta is not None else None)
+
+def iniciar_progresso(chave):
+    with _progressos_cond:
+        agora = time.monotonic()
+        for antiga in [c for c, p in _progressos.items() if p.encerrado_em and agora - p.encerrado_em > PROGRESSO_TTL]:
+            del _progressos[antiga]
+        progresso = _progressos[chave] = Progresso(chave)
+        _progressos_cond.notify_all()
+    # Arquivos sem atualização há mais que o TTL (inclusive de processos que já morreram), fora da trava
+    with contextlib.suppress(OSError):
+        for item in os.scandir(PROGRESSO_DIR):
+            with contextlib.suppress(OSError):
+                if time.time() - item.stat().st_mtime > PROGRESSO_TTL:
+                    os.remove(item.path)
+    return progresso
+
+def progresso_requisicao():
+    """Progresso da requisição atual (parâmetro `progresso` da URL), ou None se não foi pedido."""
+    if 'progresso' not in g:
+        chave = request.args.get('progresso', '')
+        g.progresso = iniciar_progresso(chave) if PADRAO_CHAVE_PROGRESSO.fullmatch(chave) else None
+    return g.progresso
+
+@app.teardown_request
+def encerrar_progresso(e=None):
+    progresso = g.pop('progresso', None)
+    if progresso:
+        progresso.encerrar(erro=str(e) if e else None)
+
 # Configuração do Banco de Dados
 app.config['DB_HOST'] = os.environ.get('DB_HOST', 'localhost')
 app.config['DB_NAME'] = os.environ.get('DB_NAME', 'datacheck')
 app.config['DB_USER'] = os.environ.get('DB_USER', 'postgres')
 app.config['DB_PASS'] = os.environ.get('DB_PASS', 'xbala')
+# Segundos de espera ao conectar; um banco lento não deve prender o worker indefinidamente
+app.config['DB_CONNECT_TIMEOUT'] = int(os.environ.get('DB_CONNECT_TIMEOUT', 5))
+# Aplica as migrações pendentes na primeira conexão de cada processo (desligue quando o deploy rodar `flask migrar-banco`)
+app.config['DB_MIGRAR_AUTOMATICAMENTE'] = os.environ.get('DB_MIGRAR_AUTOMATICAMENTE', '1') == '1'
+# Onde fica o histórico de mapeamento: 'postgres', 'sqlite' (arquivo local) ou 'auto' (SQLite quando o PostgreSQL não responde)
+app.config['HISTORICO_BACKEND'] = os.environ.get('HISTORICO_BACKEND', 'postgres')
+app.config['HISTORICO_SQLITE'] = os.environ.get('HISTORICO_SQLITE', os.path.join(app.root_path, 'historico.sqlite3'))
+# No modo 'auto', segundos no SQLite antes de testar o PostgreSQL de novo
+app.config['HISTORICO_AUTO_RETENTATIVA'] = int(os.environ.get('HISTORICO_AUTO_RETENTATIVA', 60))
+
+def conectar_db():
+    """Nova conexão com o banco de dados, ou None se ele não estiver acessível."""
+    try:
+        return psycopg2.connect(
+            host=app.config['DB_HOST'],
+            database=app.config['DB_NAME'],
+            user=app.config['DB_USER'],
+            password=app.config['DB_PASS'],
+            connect_timeout=app.config['DB_CONNECT_TIMEOUT']
+        )
+    except psycopg2.OperationalError:
+        return None
 
 def get_db():
     """Abre uma nova conexão com o banco de dados se não houver uma no contexto da requisição."""
     if 'db' not in g:
-        try:
-            g.db = psycopg2.connect(
-                host=app.config['DB_HOST'],
-                database=app.config['DB_NAME'],
-                user=app.config['DB_USER'],
-                password=app.config['DB_PASS']
-            )
-        except psycopg2.OperationalError:
-            g.db = None
+        g.db = conectar_db()
+        if g.db is not None and app.config['DB_MIGRAR_AUTOMATICAMENTE']:
+            garantir_schema(g.db)
     return g.db
 
 @app.teardown_appcontext
 def close_db(e=None):
     """Fecha a conexão com o banco de dados ao final da requisição."""
+    historico_atual = g.pop('historico', None)
+    if historico_atual is not None:
+        historico_atual.fechar()
     db = g.pop('db', None)
     if db is not None:
         db.close()
 
-def init_db():
-    """Cria uma tabela separada para cada layout para armazenar amostras aprendidas."""
-    conn = get_db()
-    if conn is None:
-        print("ERRO: Não foi possível conectar ao banco de dados PostgreSQL.")
+# ---------- MIGRAÇÕES DO BANCO ---------- #
+
+# Chave do advisory lock que serializa as migrações entre workers que sobem ao mesmo tempo
+CHAVE_TRAVA_MIGRACOES = 4_301_001
+
+def migracao_tabelas_iniciais(cur):
+    """Cria as tabelas de amostras por layout, os perfis de campos e os mapeamentos confirmados."""
+    for table_name in LAYOUTS.keys():
+        cur.execute(f"""
+            CREATE TABLE IF NOT EXISTS {table_name} (
+                id SERIAL PRIMARY KEY,
+                field_name VARCHAR(255) NOT NULL,
+                sample_value TEXT NOT NULL,
+                hits INTEGER NOT NULL DEFAULT 1,
+                ultimo_visto TIMESTAMP NOT NULL DEFAULT NOW(),
+                CONSTRAINT unique_sample_in_{table_name} UNIQUE (field_name, sample_value)
+            );
+        """)
+        # Tabelas criadas antes da contagem de ocorrências
+        cur.execute(f"ALTER TABLE {table_name} ADD COLUMN IF NOT EXISTS hits INTEGER NOT NULL DEFAULT 1;")
+        cur.execute(f"ALTER TABLE {table_name} ADD COLUMN IF NOT EXISTS ultimo_visto TIMESTAMP NOT NULL DEFAULT NOW();")
+
+    # Perfis de formato aprendidos por campo (padrões de caracteres, comprimentos, proporções)
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS perfis_campos (
+            layout VARCHAR(100) NOT NULL,
+            field_name VARCHAR(255) NOT NULL,
+            perfil JSONB NOT NULL,
+            atualizado_em TIMESTAMP NOT NULL DEFAULT NOW(),
+            PRIMARY KEY (layout, field_name)
+        );
+    """)
+
+    # Mapeamentos confirmados pelo usuário, indexados pela assinatura do cabeçalho
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS mapeamentos_confirmados (
+            id SERIAL PRIMARY KEY,
+            layout VARCHAR(100) NOT NULL,
+            assinatura CHAR(40) NOT NULL,
+            mapeamento JSONB NOT NULL,
+            usos INTEGER NOT NULL DEFAULT 1,
+            ultimo_uso TIMESTAMP NOT NULL DEFAULT NOW(),
+            CONSTRAINT unique_assinatura_em_layout UNIQUE (layout, assinatura)
+        );
+    """)
+
+def migracao_indices_historico(cur):
+    """Índices na ordem de retenção usada pela carga do histórico e pelo descarte do excedente por campo."""
+    for table_name in LAYOUTS.keys():
+        # Um índice por política de descarte ('lfu' e 'lru'), para trocar a política sem nova migração
+        cur.execute(f"CREATE INDEX IF NOT EXISTS idx_{table_name}_retencao_lfu ON {table_name} (field_name, hits DESC, ultimo_visto DESC);")
+        cur.execute(f"CREATE INDEX IF NOT EXISTS idx_{table_name}_retencao_lru ON {table_name} (field_name, ultimo_visto DESC, hits DESC);")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_mapeamentos_confirmados_retencao ON mapeamentos_confirmados (layout, usos DESC, ultimo_uso DESC);")
+
+def migracao_busca_trigramas(cur):
+    """Índices de trigramas (pg_trgm) para a busca por trecho de amostra.
+
+    Sem permissão ou sem a extensão instalada no servidor, a migração segue sem os índices e a busca usa
+    o índice em memória; para ativá-los depois, crie a extensão e os índices idx_<layout>_amostra_trgm.
+    """
+    cur.execute("SAVEPOINT trigramas;")
+    try:
+        cur.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm;")
+    except psycopg2.Error as e:
+        cur.execute("ROLLBACK TO SAVEPOINT trigramas;")
+        print(f"Extensão pg_trgm indisponível; a busca no histórico usará o índice em memória. ({str(e).strip().splitlines()[0]})")
         return
+    for table_name in LAYOUTS.keys():
+        cur.execute(f"CREATE INDEX IF NOT EXISTS idx_{table_name}_amostra_trgm ON {table_name} USING gin (sample_value gin_trgm_ops);")
 
-    try:
-        with conn.cursor() as cur:
-            # Remove tabelas de implementações anteriores para garantir um estado limpo
-            cur.execute("DROP TABLE IF EXISTS learned_samples;")
-            for layout_name in LAYOUTS.keys():
-                cur.execute(f"DROP TABLE IF EXISTS history_{layout_name};")
-            cur.execute("DROP TABLE IF EXISTS mapping_history;")
-
-            # Cria uma tabela para cada layout
-            for layout_name in LAYOUTS.keys():
-                # Remove "s" do final para nomes como "mercadorias" -> "mercadoria"
-                # table_name = layout_name.rstrip('s') if layout_name.endswith('s') else layout_name
-                table_name = layout_name
-                cur.execute(f"""
-                    CREATE TABLE IF NOT EXISTS {table_name} (
-                        id SERIAL PRIMARY KEY,
-                        field_name VARCHAR(255) NOT NULL,
-                        sample_value TEXT NOT NULL,
-                        CONSTRAINT unique_sample_in_{table_name} UNIQUE (field_name, sample_value)
-                    );
-                """)
-        conn.commit()
-    except Exception as e:
-        print(f"Erro ao inicializar o banco de dados: {e}")
-        conn.rollback()
+# Amostras guardadas na prévia de cada campo do resumo do histórico (mudar exige nova migração)
+RESUMO_PREVIA_AMOSTRAS = 50
+
+def migracao_resumo_historico(cur):
+    """Resumo por campo (total e prévia limitada) mantido por gatilhos de inserção e remoção nas tabelas de amostras.
+
+    Os gatilhos são por comando e leem só as linhas afetadas (tabelas de transição), então qualquer caminho
+    de escrita — aprendizado, sementes, snapshot, exclusões na tela ou SQL manual — mantém o resumo. A
+    atualização de hits/ultimo_visto não muda total nem prévia e não tem gatilho.
+    """
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS resumo_historico (
+            layout VARCHAR(100) NOT NULL,
+            field_name VARCHAR(255) NOT NULL,
+            total INTEGER NOT NULL,
+            previa TEXT[] NOT NULL DEFAULT '{}',
+            atualizado_em TIMESTAMP NOT NULL DEFAULT NOW(),
+            PRIMARY KEY (layout, field_name)
+        );
+    """)
+    cur.execute(f"""
+        CREATE OR REPLACE FUNCTION resumo_historico_inserir() RETURNS trigger AS $$
+        BEGIN
+            INSERT INTO resumo_historico AS r (layout, field_name, total, previa)
+            SELECT TG_TABLE_NAME, field_name, COUNT(*), (array_agg(sample_value ORDER BY id))[1:{RESUMO_PREVIA_AMOSTRAS}]
+            FROM novas
+            GROUP BY field_name
+            ON CONFLICT (layout, field_name) DO UPDATE
+            SET total = r.total + EXCLUDED.total,
+                previa = (r.previa || EXCLUDED.previa)[1:{RESUMO_PREVIA_AMOSTRAS}],
+                atualizado_em = NOW();
+            RETURN NULL;
+        END
+        $$ LANGUAGE plpgsql;
+    """)
+    cur.execute(f"""
+        CREATE OR REPLACE FUNCTION resumo_historico_remover() RETURNS trigger AS $$
+        BEGIN
+            UPDATE resumo_historico r
+            SET total = r.total - d.quantidade,
+                previa = ARRAY(SELECT v FROM unnest(r.previa) v WHERE v <> ALL (d.valores)),
+                atualizado_em = NOW()
+            FROM (
+                SELECT field_name, COUNT(*) AS quantidade, array_agg(sample_value) AS valores
+                FROM removidas
+                GROUP BY field_name
+            ) d
+            WHERE r.layout = TG_TABLE_NAME AND r.field_name = d.field_name;
+
+            DELETE FROM resumo_historico WHERE layout = TG_TABLE_NAME AND total <= 0;
+
+            -- Completa a prévia dos campos que perderam amostras dela e ainda têm outras na tabela
+            EXECUTE format($q$
+                UPDATE resumo_historico r
+                SET previa = r.previa || ARRAY(
+                    SELECT t.sample_value FROM %I t
+                    WHERE t.field_name = r.field_name AND t.sample_value <> ALL (r.previa)
+                    ORDER BY t.id
+                    LIMIT {RESUMO_PREVIA_AMOSTRAS} - cardinality(r.previa))
+                WHERE r.layout = %L AND cardinality(r.previa) < LEAST(r.total, {RESUMO_PREVIA_AMOSTRAS})
+            $q$, TG_TABLE_NAME, TG_TABLE_NAME);
+            RETURN NULL;
+        END
+        $$ LANGUAGE plpgsql;
+    """)
+    for table_name in LAYOUTS.keys():
+        # Sem escritas concorrentes entre a criação dos gatilhos e a carga inicial do resumo
+        cur.execute(f"LOCK TABLE {table_name} IN SHARE ROW EXCLUSIVE MODE;")
+        cur.execute(f"DROP TRIGGER IF EXISTS resumo_inserir ON {table_name};")
+        cur.execute(f"""
+            CREATE TRIGGER resumo_inserir AFTER INSERT ON {table_name}
+            REFERENCING NEW TABLE AS novas
+            FOR EACH STATEMENT EXECUTE FUNCTION resumo_historico_inserir();
+        """)
+        cur.execute(f"DROP TRIGGER IF EXISTS resumo_remover ON {table_name};")
+        cur.execute(f"""
+            CREATE TRIGGER resumo_remover AFTER DELETE ON {table_name}
+            REFERENCING OLD TABLE AS removidas
+            FOR EACH STATEMENT EXECUTE FUNCTION resumo_historico_remover();
+        """)
+        cur.execute("DELETE FROM resumo_historico WHERE layout = %s;", (table_name,))
+        cur.execute(f"""
+            INSERT INTO resumo_historico (layout, field_name, total, previa)
+            SELECT %s, field_name, COUNT(*), (array_agg(sample_value ORDER BY id))[1:{RESUMO_PREVIA_AMOSTRAS}]
+            FROM {table_name}
+            GROUP BY field_name;
+        """, (table_name,))
+
+def migracao_curadoria(cur):
+    """Registro das operações de curadoria em massa e lixeira com as amostras removidas, para desfazer."""
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS curadoria_operacoes (
+            id SERIAL PRIMARY KEY,
+            layout VARCHAR(100) NOT NULL,
+            descricao TEXT NOT NULL,
+            quantidade INTEGER NOT NULL DEFAULT 0,
+            criada_em TIMESTAMP NOT NULL DEFAULT NOW(),
+            desfeita_em TIMESTAMP
+        );
+    """)
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS curadoria_lixeira (
+            operacao INTEGER NOT NULL REFERENCES curadoria_operacoes (id) ON DELETE CASCADE,
+            field_name VARCHAR(255) NOT NULL,
+            sample_value TEXT NOT NULL,
+            hits INTEGER NOT NULL,
+            ultimo_visto TIMESTAMP NOT NULL
+        );
+    """)
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_curadoria_lixeira_operacao ON curadoria_lixeira (operacao);")
+
+# Migrações em ordem: (versão, descrição, função que recebe o cursor). Nunca altere uma versão já publicada;
+# mudanças de schema (inclusive tabelas de um layout novo) entram como uma versão nova no fim da lista.
+MIGRACOES = [
+    (1, 'tabelas iniciais', migracao_tabelas_iniciais),
+    (2, 'índices do histórico', migracao_indices_historico),
+    (3, 'busca por trigramas', migracao_busca_trigramas),
+    (4, 'resumo do histórico por campo', migracao_resumo_historico),
+    (5, 'curadoria do histórico', migracao_curadoria),
+]
+
+def migrar_banco(conn):
+    """Aplica, em ordem e uma única vez, as migrações ainda não registradas em schema_versao. Devolve as versões aplicadas."""
+    aplicadas = []
+    with conn.cursor() as cur:
+        # Caminho rápido, sem trava: o schema já está na última versão
+        try:
+            cur.execute("SELECT COALESCE(MAX(versao), 0) FROM schema_versao;")
+            atual = cur.fetchone()[0]
+            conn.rollback()
+            if atual >= MIGRACOES[-1][0]:
+                return aplicadas
+        except psycopg2.errors.UndefinedTable:
+            conn.rollback()
+
+        # Workers concorrentes esperam aqui; quem entra depois encontra as versões já registradas
+        cur.execute("SELECT pg_advisory_lock(%s);", (CHAVE_TRAVA_MIGRACOES,))
+        try:
+            cur.execute("""
+                CREATE TABLE IF NOT EXISTS schema_versao (
+                    versao INTEGER PRIMARY KEY,
+                    descricao TEXT NOT NULL,
+                    aplicada_em TIMESTAMP NOT NULL DEFAULT NOW()
+                );
+            """)
+            conn.commit()
+            cur.execute("SELECT versao FROM schema_versao;")
+            registradas = {row[0] for row in cur.fetchall()}
+            for versao, descricao, aplicar in MIGRACOES:
+                if versao in registradas:
+                    continue
+                # Cada migração e seu registro na mesma transação: ou entram juntos, ou nenhum
+                aplicar(cur)
+                cur.execute("INSERT INTO schema_versao (versao, descricao) VALUES (%s, %s);", (versao, descricao))
+                conn.commit()
+                aplicadas.append(versao)
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            cur.execute("SELECT pg_advisory_unlock(%s);", (CHAVE_TRAVA_MIGRACOES,))
+            conn.commit()
+    return aplicadas
+
+# Uma migração que falha não desliga as seguintes: a próxima conexão tenta de novo depois de uma
+# espera que dobra a cada falha (de MIGRACAO_ESPERA_INICIAL até MIGRACAO_ESPERA_MAXIMA segundos).
+MIGRACAO_ESPERA_INICIAL = 5
+MIGRACAO_ESPERA_MAXIMA = 300
+
+_schema_verificado = False
+_schema_trava = threading.Lock()
+_schema_proxima_tentativa = 0.0
+_schema_espera = MIGRACAO_ESPERA_INICIAL
+
+def garantir_schema(conn):
+    """Roda as migrações pendentes uma vez por processo, na primeira conexão (fora do import do módulo)."""
+    global _schema_verificado, _schema_proxima_tentativa, _schema_espera
+    if _schema_verificado or time.monotonic() < _schema_proxima_tentativa:
+        return
+    with _schema_trava:
+        if _schema_verificado or time.monotonic() < _schema_proxima_tentativa:
+            return
+        try:
+            aplicadas = migrar_banco(conn)
+        except Exception:
+            app.logger.exception("Erro ao migrar o banco de dados; nova tentativa em %s s "
+                                 "(rode `flask migrar-banco` para detalhes).", _schema_espera)
+            _schema_proxima_tentativa = time.monotonic() + _schema_espera
+            _schema_espera = min(_schema_espera * 2, MIGRACAO_ESPERA_MAXIMA)
+            return
+        if aplicadas:
+            app.logger.info("Migrações aplicadas ao banco: %s", ', '.join(map(str, aplicadas)))
+        _schema_verificado = True
 
 # LAYOUTS and other constants...
 LAYOUT_MERCADORIA = [
@@ -196,6 +906,245 @@ LAYOUT_VEICULO_CLIENTE = [
     ('uf_inscricao_estadual', 'UF Inscrição estadual', 'Numérico', 2, False),
 ]
 
+# ---------- REGRAS DECLARATIVAS DOS LAYOUTS ---------- #
+# Cada layout descreve suas validações como dados; compilar_layout transforma a especificação
+# num plano executável uma única vez. Verificações (avaliadas em ordem; a primeira que falha
+# classifica o valor):
+#   'tamanho': [min, max]   comprimento (None = sem limite, 'layout' = tamanho do layout)
+#   'tamanhos': [...]       comprimentos aceitos
+#   'regex' / 'sem_regex'   padrão que deve / não deve ser encontrado
+#   'palavras_proibidas'    palavras que não podem aparecer isoladas
+#   'numero': {min, max, diferente}   número (decimal com vírgula ou ponto, milhar opcional) e limites
+#   'opcoes': [...]         valores aceitos, comparados normalizados
+#   'datas': [...]          formatos aceitos por strptime
+# Modificadores: 'limpar' remove caracteres antes de verificar, 'bruto' não aplica strip,
+# 'falha' / 'aviso' nomeiam a mensagem gerada. Avisos não invalidam o valor.
+# Campo: 'regras', 'avisos', 'mapa' (tradução de opções; só os códigos do mapa são aceitos,
+# falha 'fora_das_opcoes'), 'unico', 'vazio', 'mensagens' e
+# 'perfil' ('moeda' ou 'numero': resumo numérico exibido nos resultados).
+# Layout: 'campos', 'regras_por_tipo', 'mensagens', 'ultrapassa_texto', 'vazio_opcional'
+# ('valido' ou 'ignorado'), 'invalida_linha' ('obrigatorio' ou 'sempre') e 'totalizadores'
+# ({nome: campo} com a soma do perfil do campo, exibidos no cartão do arquivo).
+# Mensagens: 'chave', 'tipo', 'mensagem' ({n} = total), 'contagem' ('distintos' conta valores em vez
+# de registros; 'distintos_limpos' ignora espaços nas pontas e, no 'unico' com 'maiusculas', a caixa),
+# 'amostra' ('frequentes', 'ordenada', 'numerica', 'primeiras' ou 'nenhuma') e 'limite'.
+
+FORMATOS_DATA = ['%d/%m/%Y', '%Y-%m-%d', '%d-%m-%Y']
+FORMATOS_DATA_HORA = ['%Y-%m-%d %H:%M:%S', '%d/%m/%Y %H:%M:%S']
+OPCOES_BOOLEANO = ['1', '0', 'true', 'false', 'sim', 'não', 'nao', 'yes', 'no']
+
+MENSAGENS_PADRAO = {
+    'em_branco': {'chave': '{campo}_em_branco', 'tipo': 'em_branco', 'mensagem': 'Em branco: {n} registro(s)', 'amostra': 'nenhuma'},
+    'invalido': {'chave': '{campo}', 'tipo': 'invalido', 'mensagem': 'Valor inválido: {n} registro(s)', 'amostra': 'ordenada', 'limite': 8},
+    'duplicado': {'chave': '{campo}_duplicado', 'tipo': 'duplicado', 'mensagem': 'Duplicados: {n} registro(s)', 'contagem': 'distintos_limpos', 'amostra': 'primeiras', 'limite': 8},
+    'ultrapassa': {'chave': '{campo}_ultrapassa', 'tipo': 'ultrapassa_tamanho', 'mensagem': 'Excede o limite de caracteres: {n} registro(s)', 'contagem': 'distintos', 'amostra': 'ordenada'},
+    'fora_das_opcoes': {'chave': '{campo}_fora_das_opcoes', 'tipo': 'invalido', 'mensagem': 'Fora das opções aceitas: {n} registro(s)', 'contagem': 'distintos', 'amostra': 'ordenada'},
+}
+
+REGRAS_MERCADORIA = {
+    'ultrapassa_texto': True,
+    'mensagens': {
+        'negativo': {'chave': '{campo}', 'tipo': 'negativo', 'mensagem': 'Valor negativo: {n} registro(s)', 'amostra': 'numerica'},
+    },
+    'regras_por_tipo': {
+        'texto': {'regras': [{'tamanho': [1, 'layout']}]},
+    },
+    'campos': {
+        'codigo': {
+            'regras': [
+                {'tamanho': [4, 'layout']},
+                {'regex': r'(?i)^[A-Z0-9\s\-\/\.]+$'},
+                {'palavras_proibidas': ['de', 'da', 'do', 'com', 'para', 'em', 'um', 'uma']},
+            ],
+            'unico': {'aviso': 'duplicado'},
+            'mensagens': {'ultrapassa': {**MENSAGENS_PADRAO['ultrapassa'], 'contagem': 'distintos_limpos'}},
+        },
+        'nome': {'regras': [{'tamanho': [5, 150]}]},
+        'ncm': {'regras': [{'regex': r'^(?=[0-9.]+$)(?:.{8}|(?=.*\.).{10})$'}]},
+        'cest': {'regras': [{'regex': r'^(?=[0-9.]+$)(?:.{7}|(?=.*\.).{9})$'}]},
+        'preco_venda': {'regras': [{'numero': {}}, {'numero': {'min': 0}, 'falha': 'negativo'}], 'perfil': 'moeda'},
+        'preco_custo_aquisicao': {'regras': [{'numero': {}}, {'numero': {'min': 0}, 'falha': 'negativo'}], 'perfil': 'moeda'},
+        'preco_venda_sugerido': {'regras': [{'numero': {}}, {'numero': {'min': 0}, 'falha': 'negativo'}], 'perfil': 'moeda'},
+        'preco_garantia': {'regras': [{'numero': {}}, {'numero': {'min': 0}, 'falha': 'negativo'}], 'perfil': 'moeda'},
+        'preco_custo_fabrica': {'regras': [{'numero': {}}, {'numero': {'min': 0}, 'falha': 'negativo'}], 'perfil': 'moeda'},
+        'original': {'regras': [{'opcoes': OPCOES_BOOLEANO}]},
+        'aplicacao': {'regras': [{'tamanho': [None, 'layout']}]},
+        'origem': {'regras': [{'numero': {'min': 0}}]},
+        'anp': {'regras': [{'regex': r'^\d{9}(\.0*)?$'}]},
+        'coeficiente': {'regras': [{'tamanho': [None, 'layout']}]},
+        'qtd_embalagem': {'regras': [{'numero': {'min': 0}}], 'perfil': 'numero'},
+        'curva_abc': {'regras': [{'opcoes': ['A', 'B', 'C', 'D', 'X', 'Y', 'Z']}]},
+        'curva_xyz': {'regras': [{'opcoes': ['A', 'B', 'C', 'D', 'X', 'Y', 'Z']}]},
+        'cod_original': {'regras': [{'tamanho': [None, 'layout']}]},
+    },
+}
+
+REGRAS_MERCADORIA_SALDOS = {
+    'ultrapassa_texto': True,
+    'mensagens': {
+        'ultrapassa': {'chave': '{campo}_ultrapassa', 'tipo': 'ultrapassa_tamanho', 'mensagem': 'Excede o limite de caracteres: {n} registro(s)', 'contagem': 'distintos', 'amostra': 'ordenada', 'limite': 8},
+        'com_espaco': {'chave': '{campo}_com_espaco', 'tipo': 'com_espaco', 'mensagem': 'Possui espaço(s) indevido(s): {n} registro(s)', 'contagem': 'distintos_limpos', 'amostra': 'primeiras', 'limite': 8},
+        'nao_numerico': {'chave': '{campo}_nao_numerico', 'tipo': 'invalido', 'mensagem': 'Valor não numérico: {n} registro(s)', 'amostra': 'primeiras', 'limite': 8},
+        'negativo': {'chave': '{campo}_negativo', 'tipo': 'negativo', 'mensagem': 'Valor negativo: {n} registro(s)', 'amostra': 'numerica', 'limite': 8},
+        'zerado': {'chave': '{campo}_zerado', 'tipo': 'zerado', 'mensagem': 'Valor zerado: {n} registro(s)', 'amostra': 'nenhuma'},
+    },
+    'regras_por_tipo': {
+        # O excesso de caracteres já é relatado pelo aviso 'ultrapassa'
+        'texto': {'regras': [{'tamanho': [None, 'layout'], 'bruto': True, 'falha': 'excede'}]},
+        'numérico': {
+            'vazio': 'aviso',
+            'regras': [{'numero': {}, 'limpar': ' ', 'falha': 'nao_numerico'}],
+            'avisos': [
+                {'numero': {'min': 0}, 'limpar': ' ', 'aviso': 'negativo'},
+                {'numero': {'diferente': 0}, 'limpar': ' ', 'aviso': 'zerado'},
+            ],
+        },
+    },
+    'campos': {
+        'codigo': {
+            'avisos': [{'sem_regex': ' ', 'aviso': 'com_espaco', 'somente_validos': False}],
+            'unico': {'aviso': 'duplicado'},
+            'mensagens': {'ultrapassa': {'chave': '{campo}_ultrapassa', 'tipo': 'ultrapassa_tamanho', 'mensagem': 'Excede o limite de caracteres: {n} registro(s)', 'contagem': 'distintos_limpos', 'amostra': 'ordenada', 'limite': 8}},
+        },
+        'custo_medio': {'perfil': 'moeda'},
+        'custo_medio_contabil': {'perfil': 'moeda'},
+        'custo_ultima_compra': {'perfil': 'moeda'},
+        'base_media_icms_st': {'perfil': 'moeda'},
+        'valor_medio_icms_st': {'perfil': 'moeda'},
+        'saldo': {'perfil': 'numero'},
+        'custo_contabil_ultima_compra': {
+            'avisos': [{'numero': {'diferente': 0}, 'limpar': ' ', 'aviso': 'zerado'}],
+            'perfil': 'moeda',
+        },
+    },
+    'totalizadores': {'saldo_total': 'saldo', 'custo_medio_contabil_total': 'custo_medio_contabil'},
+}
+
+# Tradução das opções aceitas em texto para o código do layout
+MAPA_ESTADO_CIVIL = {
+    'casado': '1', 'casado(a)': '1', '1': '1',
+    'solteiro': '2', 'solteiro(a)': '2', '2': '2',
+    'separado': '3', 'separado(a)': '3', '3': '3',
+    'viuvo': '4', 'viuvo(a)': '4', '4': '4',
+    'desquitado': '5', 'desquitado(a)': '5', '5': '5',
+    'divorciado': '6', 'divorciado(a)': '6', '6': '6',
+    'outros': '7', 'outro': '7', 'outra': '7', '7': '7'
+}
+MAPA_SEXO = {
+    'f': '1', 'feminino': '1', '1': '1',
+    'm': '2', 'masculino': '2', '2': '2'
+}
+MAPA_TIPO_CONTRIBUINTE = {
+    'icms': '1', 'contribuinte': '1', '1': '1',
+    'isento': '2', 'nao contribuinte': '2', '2': '2',
+    '9': '9'
+}
+MAPA_TIPO_TELEFONE = {
+    'celular': '1', 'cel': '1', 'celular comercial': '1', '1': '1',
+    'fixo': '2', 'residencial': '2', 'telefone fixo': '2', 'comercial': '2', '2': '2',
+    'fax comercial': '3', '3': '3',
+    'fax residencial': '4', '4': '4',
+    'nextel': '5', '5': '5'
+}
+MAPA_TIPO_ENDERECO = {
+    'residencial': '1', '1': '1',
+    'comercial': '2', '2': '2',
+    'cobranca': '3', '3': '3',
+    'secundario': '4', '4': '4',
+    'entrega': '5', '5': '5',
+    'coleta': '6', '6': '6'
+}
+MAPA_TIPO_PESSOA = {
+    'pf': '1', 'f': '1', 'fisica': '1', '1': '1',
+    'pj': '2', 'j': '2', 'juridica': '2', '2': '2'
+}
+MAPA_PRODUTOR_RURAL = {
+    '1': '1', 'true': '1', 'sim': '1', 'yes': '1',
+    '0': '0', 'false': '0', 'nao': '0', 'no': '0'
+}
+
+REGRAS_PESSOAS = {
+    'vazio_opcional': 'ignorado',
+    'invalida_linha': 'sempre',
+    'mensagens': {
+        'excede': {'chave': '{campo}', 'tipo': 'invalido', 'mensagem': 'Excede o limite de caracteres. Total: {n} registro(s).', 'contagem': 'distintos', 'amostra': 'ordenada'},
+        'nao_numerico': {'chave': '{campo}', 'tipo': 'invalido', 'mensagem': 'Valor não numérico. Total: {n} registro(s).', 'contagem': 'distintos', 'amostra': 'ordenada'},
+        'nao_booleano': {'chave': '{campo}', 'tipo': 'invalido', 'mensagem': 'Valor fora do padrão booleano (1/0/Sim/Não/True/False). Total: {n} registro(s).', 'contagem': 'distintos', 'amostra': 'ordenada'},
+        'fora_das_opcoes': {'chave': '{campo}_fora_das_opcoes', 'tipo': 'invalido', 'mensagem': 'Valor fora das opções aceitas. Total: {n} registro(s).', 'contagem': 'distintos', 'amostra': 'ordenada'},
+        'data_invalida': {'chave': '{campo}', 'tipo': 'invalido', 'mensagem': 'Valor fora do padrão de data esperado (ex: dd/mm/aaaa ou yyyy-mm-dd). Total: {n} registro(s).', 'contagem': 'distintos', 'amostra': 'ordenada'},
+        'duplicado': {'chave': '{campo}_duplicado', 'tipo': 'duplicado', 'mensagem': 'Duplicados: {n} registro(s)', 'contagem': 'distintos', 'amostra': 'ordenada'},
+    },
+    'regras_por_tipo': {
+        'texto': {'regras': [{'tamanho': [None, 'layout'], 'bruto': True, 'falha': 'excede'}]},
+        'numérico': {'regras': [{'numero': {}, 'falha': 'nao_numerico'}]},
+        'booleano': {'regras': [{'opcoes': OPCOES_BOOLEANO, 'falha': 'nao_booleano'}]},
+        'data': {'regras': [{'datas': FORMATOS_DATA, 'falha': 'data_invalida'}]},
+    },
+    'campos': {
+        'cpf_cnpj': {
+            'regras': [
+                {'regex': r'^[0-9.\-\/]+$', 'falha': 'caracteres_invalidos'},
+                {'tamanhos': [11, 14], 'limpar': '.-/', 'falha': 'fora_padrao'},
+            ],
+            'unico': {'falha': 'duplicado', 'limpar': '.-/'},
+            'mensagens': {
+                'caracteres_invalidos': {'chave': '{campo}_caracteres_invalidos', 'tipo': 'caracteres_invalidos', 'mensagem': 'Caracteres inválidos: {n} registro(s)', 'contagem': 'distintos', 'amostra': 'ordenada'},
+                'fora_padrao': {'chave': '{campo}', 'tipo': 'invalido', 'mensagem': 'Fora do padrão (deve ter 11 ou 14 dígitos): {n} registro(s)', 'contagem': 'distintos', 'amostra': 'ordenada'},
+            },
+        },
+        'email': {
+            'regras': [
+                {'sem_regex': r'(?i)\s|[çãõáéíóúâêîôûàèìòùäëïöü]', 'falha': 'caractere_invalido'},
+                {'regex': r'^[A-Za-z0-9._%+-]+@[A-Za-z0-9.-]+\.[A-Za-z]{2,}$', 'falha': 'fora_padrao'},
+            ],
+            'mensagens': {
+                'caractere_invalido': {'chave': '{campo}_caractere_invalido', 'tipo': 'caractere_invalido', 'mensagem': 'Contém espaço ou caractere especial inválido', 'amostra': 'ordenada'},
+                'fora_padrao': {'chave': '{campo}', 'tipo': 'invalido', 'mensagem': 'Fora do padrão de e-mail', 'amostra': 'ordenada'},
+            },
+        },
+        'cep': {
+            'regras': [
+                {'tamanho': [8, 9], 'falha': 'tamanho_invalido'},
+                {'regex': r'^\d{5}-?\d{3}$', 'falha': 'fora_padrao'},
+            ],
+            'mensagens': {
+                'tamanho_invalido': {'chave': '{campo}_tamanho_invalido', 'tipo': 'tamanho_invalido', 'mensagem': 'Tamanho de caracteres inválido.  Total: {n} registro(s).', 'contagem': 'distintos', 'amostra': 'ordenada'},
+                'fora_padrao': {'chave': '{campo}', 'tipo': 'invalido', 'mensagem': 'Contém caracteres não numéricos ou hífen fora do lugar. Total: {n} registro(s).', 'contagem': 'distintos', 'amostra': 'ordenada'},
+            },
+        },
+        'tipo_pessoa': {'mapa': MAPA_TIPO_PESSOA},
+        'tipo_contribuinte': {'mapa': MAPA_TIPO_CONTRIBUINTE},
+        'sexo': {'mapa': MAPA_SEXO},
+        'estado_civil': {'mapa': MAPA_ESTADO_CIVIL},
+        'tipo_endereco': {'mapa': MAPA_TIPO_ENDERECO},
+        'tipo_telefone': {'mapa': MAPA_TIPO_TELEFONE},
+        'produtor_rural': {'mapa': MAPA_PRODUTOR_RURAL},
+        'valor_limite_credito': {'perfil': 'moeda'},
+    },
+}
+
+REGRAS_VEICULO_CLIENTE = {
+    'ultrapassa_texto': True,
+    'regras_por_tipo': {
+        'texto': {'regras': [{'tamanho': [None, 'layout']}]},
+        'data': {'regras': [{'datas': FORMATOS_DATA}]},
+        'timestamp': {'regras': [{'datas': FORMATOS_DATA_HORA}]},
+    },
+    'campos': {
+        'cpf_cnpj': {'regras': [{'regex': r'^(?:\d{11}|.{14})$'}]},
+        # Placa padrão Brasil (AAA9999) ou Mercosul (AAA9A99), com ou sem hífen
+        'placa': {'regras': [{'tamanho': [7, 8], 'limpar': '-'}], 'unico': {'aviso': 'duplicado', 'maiusculas': True}},
+        'modelo': {'regras': [{'tamanho': [1, 'layout']}]},
+        'cor': {'regras': [{'tamanho': [1, 'layout']}]},
+        'ano_fabricacao': {'regras': [{'regex': r'^\d{4}$'}, {'numero': {'min': 1900, 'max': 2100}}]},
+        'ano_modelo': {'regras': [{'regex': r'^\d{4}$'}, {'numero': {'min': 1900, 'max': 2100}}]},
+        # Chassi geralmente tem 17 caracteres, mas o layout permite até 20
+        'chassi': {'regras': [{'tamanho': [1, 'layout']}], 'unico': {'aviso': 'duplicado', 'maiusculas': True}},
+        'uf_rg': {'regras': [{'regex': r'^\d{2}$'}]},
+        'uf_inscricao_estadual': {'regras': [{'regex': r'^\d{2}$'}]},
+    },
+}
+
 CAMPOS_IGNORAR_HISTORY_IA = [
     'preco_venda', 'preco_custo_aquisicao', 'preco_venda_sugerido', 'preco_garantia',
     'preco_custo_fabrica', 'origem', 'qtd_embalagem', 'custo_medio', 'custo_medio_contabil','custo_ultima_compra',
@@ -206,6 +1155,7 @@ LAYOUTS = {
     "mercadorias": {
         "nome": "Cadastro de Mercadorias",
         "layout": LAYOUT_MERCADORIA,
+        "regras": REGRAS_MERCADORIA,
         "js": "mercadorias.js",
         "keywords": {
             'codigo': ['codigo', 'código', 'sku', 'product_code', 'ean', 'cod', 'código_mercadoria', 'código mercadoria'],
@@ -235,6 +1185,7 @@ LAYOUTS = {
     "mercadorias_saldos": {
         "nome": "Saldo de Mercadorias",
         "layout": LAYOUT_MERCADORIA_SALDOS,
+        "regras": REGRAS_MERCADORIA_SALDOS,
         "js": "mercadorias_saldos.js",
         "keywords": {
             'codigo': ['codigo', 'código', 'sku', 'ean', 'product_code', 'código mercadoria', 'código_mercadoria', 'cod_merc'],
@@ -252,6 +1203,7 @@ LAYOUTS = {
     "pessoas": {
         "nome": "Cadastro de Pessoas",
         "layout": LAYOUT_PESSOAS,
+        "regras": REGRAS_PESSOAS,
         "js": "pessoas.js",
         "keywords": {
             "cpf_cnpj": ["cpf", "cnpj", "documento", "cpf/cnpj", "cpf_cnpj"],
@@ -294,6 +1246,7 @@ LAYOUTS = {
     "veiculos_cliente": {
         "nome": "Cadastro de Veículos do Cliente",
         "layout": LAYOUT_VEICULO_CLIENTE,
+        "regras": REGRAS_VEICULO_CLIENTE,
         "js": "veiculos_cliente.js",
         "keywords": {
             'cpf_cnpj': ['cpf', 'cnpj', 'cpf_cnpj', 'cpf/cnpj', 'documento'],
@@ -325,9 +1278,6 @@ LAYOUTS = {
     },
 }
 
-with app.app_context():
-    init_db()
-
 def convert_decimals(obj):
     if isinstance(obj, list):
         return [convert_decimals(i) for i in obj]
@@ -337,57 +1287,1364 @@ def convert_decimals(obj):
         return str(obj)
     return obj
 
-def load_mapping_history(tipo_layout):
-    """Carrega as amostras da tabela de layout específica e as agrupa por campo."""
+# Limite de amostras guardadas por campo e política de descarte ('lfu': menos vistas; 'lru': vistas há mais tempo)
+HISTORICO_MAX_AMOSTRAS_POR_CAMPO = int(os.environ.get('HISTORICO_MAX_AMOSTRAS_POR_CAMPO', 2000))
+HISTORICO_POLITICA_DESCARTE = os.environ.get('HISTORICO_POLITICA_DESCARTE', 'lfu')
+
+def ordem_retencao_historico():
+    """Cláusula ORDER BY que coloca primeiro as amostras a manter, conforme a política de descarte."""
+    if HISTORICO_POLITICA_DESCARTE == 'lru':
+        return "ultimo_visto DESC, hits DESC"
+    return "hits DESC, ultimo_visto DESC"
+
+# ---------- SEMENTES DO HISTÓRICO ---------- #
+# Arquivos no formato de load_mapping_history ({campo: {"amostras_validas": [...], "pesos": {...},
+# "perfil": {...}}}), como os dados/ia_<layout>.json, entram no histórico em massa: o JSON é lido
+# um campo por vez, as amostras vão por COPY para uma tabela temporária e de lá para a tabela do
+# layout num único INSERT ... SELECT com deduplicação (o mesmo caminho serve ao snapshot binário).
+
+PASTA_SEMENTES = os.path.join(app.root_path, 'dados')
+SEMENTE_LOTE = 50000           # linhas por COPY
+SEMENTE_BLOCO_LEITURA = 1024 * 1024
+
+def caminho_semente(tipo_layout):
+    return os.path.join(PASTA_SEMENTES, f'ia_{tipo_layout}.json')
+
+def ler_semente_historico(arquivo, ao_ler=None):
+    """Percorre um JSON {campo: {...}} (arquivo binário) devolvendo (campo, dados) um campo por vez.
+
+    Só o campo atual fica em memória: o objeto de cada campo é decodificado de um buffer reabastecido
+    em blocos. Arquivo vazio não devolve nada. `ao_ler(n)` recebe os bytes lidos a cada bloco.
+    """
+    decodificador = json.JSONDecoder()
+    leitor = codecs.getincrementaldecoder('utf-8-sig')()
+    buffer, pos, fim = '', 0, False
+
+    def abastecer(tamanho=SEMENTE_BLOCO_LEITURA):
+        nonlocal buffer, pos, fim
+        bloco = arquivo.read(tamanho)
+        fim = not bloco
+        if ao_ler and bloco:
+            ao_ler(len(bloco))
+        buffer = buffer[pos:] + leitor.decode(bloco, final=fim)
+        pos = 0
+
+    def simbolo():
+        """Próximo caractere não branco, sem consumi-lo ('' no fim do arquivo)."""
+        nonlocal pos
+        while True:
+            while pos < len(buffer) and buffer[pos] in ' \t\r\n':
+                pos += 1
+            if pos < len(buffer) or fim:
+                return buffer[pos:pos + 1]
+            abastecer()
+
+    def valor():
+        nonlocal pos
+        simbolo()
+        tamanho = SEMENTE_BLOCO_LEITURA
+        while True:
+            try:
+                obj, pos = decodificador.raw_decode(buffer, pos)
+                return obj
+            except json.JSONDecodeError:
+                # Valor cortado no fim do buffer: lê mais (dobrando, para não redecodificar um campo
+                # grande a cada bloco) e tenta de novo
+                if fim:
+                    raise
+                abastecer(tamanho)
+                tamanho *= 2
+
+    def esperar(caractere):
+        nonlocal pos
+        if simbolo() != caractere:
+            raise ValueError(f"JSON inválido: esperado '{caractere}' na posição {pos}.")
+        pos += 1
+
+    if simbolo() == '':
+        return
+    esperar('{')
+    if simbolo() == '}':
+        return
+    while True:
+        campo = valor()
+        esperar(':')
+        dados = valor()
+        if not isinstance(campo, str) or not isinstance(dados, dict):
+            raise ValueError(f"JSON inválido: o campo '{campo}' deve conter um objeto.")
+        yield campo, dados
+        if simbolo() == '}':
+            return
+        esperar(',')
+
+def _linha_copy(*valores):
+    """Linha no formato texto do COPY (tabulação entre colunas, barras e quebras escapadas)."""
+    return '\t'.join(str(v).replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+                     for v in valores) + '\n'
+
+def criar_tabela_carga(cur):
+    """Tabela temporária que recebe as amostras por COPY antes de irem para a tabela do layout."""
+    cur.execute("""
+        CREATE TEMP TABLE carga_historico (
+            field_name VARCHAR(255) NOT NULL,
+            sample_value TEXT NOT NULL,
+            hits INTEGER NOT NULL,
+            ultimo_visto TIMESTAMP
+        ) ON COMMIT DROP;
+    """)
+
+def mesclar_carga_historico(cur, tipo_layout, campos):
+    """Leva a carga para a tabela do layout e aplica o limite por campo. Devolve (novas, atualizadas, descartadas).
+
+    Cada (campo, amostra) fica uma vez só, com o maior peso e a visita mais recente entre a carga e o
+    banco. A tabela temporária é esvaziada para a carga do próximo layout.
+    """
+    cur.execute(f"""
+        WITH gravadas AS (
+            INSERT INTO {tipo_layout} (field_name, sample_value, hits, ultimo_visto)
+            SELECT field_name, sample_value, MAX(hits), COALESCE(MAX(ultimo_visto), NOW())
+            FROM carga_historico
+            GROUP BY field_name, sample_value
+            ON CONFLICT (field_name, sample_value)
+            DO UPDATE SET hits = GREATEST({tipo_layout}.hits, EXCLUDED.hits),
+                          ultimo_visto = GREATEST({tipo_layout}.ultimo_visto, EXCLUDED.ultimo_visto)
+            RETURNING (xmax = 0) AS nova
+        )
+        SELECT COUNT(*) FILTER (WHERE nova), COUNT(*) FILTER (WHERE NOT nova) FROM gravadas;
+    """)
+    novas, atualizadas = cur.fetchone()
+    cur.execute(f"""
+        DELETE FROM {tipo_layout}
+        WHERE id IN (
+            SELECT id FROM (
+                SELECT id, ROW_NUMBER() OVER (PARTITION BY field_name ORDER BY {ordem_retencao_historico()}) AS posicao
+                FROM {tipo_layout}
+                WHERE field_name = ANY(%s)
+            ) ordenadas
+            WHERE posicao > %s
+        );
+    """, (sorted(campos), HISTORICO_MAX_AMOSTRAS_POR_CAMPO))
+    descartadas = cur.rowcount
+    cur.execute("TRUNCATE carga_historico;")
+    return novas, atualizadas, descartadas
+
+def nova_carga_semente():
+    """Contagens de uma carga de semente e o dicionário que recebe os perfis lidos."""
+    return {'campos': 0, 'lidas': 0, 'novas': 0, 'atualizadas': 0, 'descartadas': 0, 'ignorados': []}, {}
+
+def linhas_semente(tipo_layout, arquivo, stats, perfis, tamanho=0, progresso=None):
+    """Gera (campo, amostra, hits) de um arquivo de semente, contando em `stats` e guardando os perfis."""
+    campos_layout = PLANOS[tipo_layout].campos
+    if progresso:
+        progresso.etapa('semente', total=tamanho, unidade='bytes', layout=tipo_layout)
+    for campo, dados in ler_semente_historico(arquivo, progresso.avancar if progresso else None):
+        if campo not in campos_layout:
+            stats['ignorados'].append(campo)
+            continue
+        stats['campos'] += 1
+        # Chaves de peso que só diferem por espaços nas pontas ficam com o maior peso
+        pesos = {}
+        for amostra, peso in (dados.get('pesos') or {}).items():
+            if not is_vazio(amostra):
+                amostra = str(amostra).strip()
+                pesos[amostra] = max(pesos.get(amostra, 1), int(peso))
+        # Cada amostra sai uma vez, esteja em amostras_validas, em pesos ou nos dois
+        amostras = dict.fromkeys(str(a).strip() for a in dados.get('amostras_validas') or [] if not is_vazio(a))
+        for amostra in dict.fromkeys(itertools.chain(amostras, pesos)):
+            stats['lidas'] += 1
+            yield campo, amostra, max(1, pesos.get(amostra, 1))
+        if dados.get('perfil'):
+            perfis[campo] = dados['perfil']
+
+def carregar_semente_historico(tipo_layout, arquivo, tamanho=0, progresso=None, ao_avancar=None):
+    """Carrega um arquivo de semente no histórico do layout. Devolve as contagens da carga.
+
+    Amostras repetidas (no arquivo ou já no histórico) ficam uma vez só, com o maior peso conhecido; por
+    isso recarregar o mesmo arquivo não altera o histórico. Campos fora do layout são ignorados e o
+    excedente por campo é descartado conforme a política de retenção.
+    """
+    return historico().carregar_semente(tipo_layout, arquivo, tamanho, progresso, ao_avancar)
+
+def descrever_carga_semente(stats):
+    texto = (f"{stats['lidas']} amostra(s) lida(s) em {stats['campos']} campo(s): {stats['novas']} nova(s), "
+             f"{stats['atualizadas']} já existente(s), {stats['descartadas']} descartada(s) pelo limite por campo")
+    if stats['ignorados']:
+        texto += f"; campos fora do layout ignorados: {', '.join(stats['ignorados'])}"
+    return texto + '.'
+
+# ---------- SNAPSHOT DO HISTÓRICO ---------- #
+# Cópia binária do histórico inteiro para levar de um ambiente a outro: um stream Arrow IPC com
+# lotes comprimidos (zstd), layout e campo codificados por dicionário e as amostras em colunas.
+# Perfis de campos e mapeamentos confirmados, pequenos, vão em JSON nos metadados do schema.
+# Exportação e importação andam lote a lote, sem montar o histórico em memória.
+
+SNAPSHOT_LOTE = 65536
+SNAPSHOT_VERSAO = '1'
+SNAPSHOT_TIPO = 'application/vnd.apache.arrow.stream'
+SNAPSHOT_MODOS = ('mesclar', 'substituir')
+
+def schema_snapshot(metadados):
+    return pa.schema([
+        ('layout', pa.dictionary(pa.int32(), pa.string())),
+        ('field_name', pa.dictionary(pa.int32(), pa.string())),
+        ('sample_value', pa.string()),
+        ('hits', pa.int32()),
+        ('ultimo_visto', pa.timestamp('us')),
+    ], metadata=metadados)
+
+def exigir_pyarrow():
+    if pa is None:
+        raise RuntimeError("O snapshot do histórico exige o pacote pyarrow.")
+
+class _SaidaEmPartes:
+    """Destino de escrita que só acumula os bytes, para um gerador devolvê-los aos pedaços."""
+
+    closed = False
+
+    def __init__(self):
+        self.partes = []
+
+    def write(self, dados):
+        self.partes.append(bytes(dados))
+        return len(dados)
+
+    def flush(self):
+        pass
+
+    def esvaziar(self):
+        dados, self.partes = b''.join(self.partes), []
+        return dados
+
+def gerar_snapshot_historico(layouts=None):
+    """Gera o snapshot em pedaços de bytes (um por lote de amostras), lendo o banco por cursor no servidor.
+
+    Usa uma conexão própria, fechada ao fim do gerador, porque uma resposta em streaming continua
+    depois que a requisição (e a conexão de get_db) já terminou.
+    """
+    exigir_pyarrow()
+    conn = conectar_db()
+    if conn is None:
+        raise RuntimeError("Não foi possível conectar ao banco de dados.")
+    try:
+        yield from _escrever_snapshot(conn, [layout for layout in (layouts or LAYOUTS) if layout in LAYOUTS])
+    finally:
+        conn.close()
+
+def _escrever_snapshot(conn, layouts):
+    with conn.cursor() as cur:
+        contagens = {}
+        for layout in layouts:
+            cur.execute(f"SELECT COUNT(*) FROM {layout};")
+            contagens[layout] = cur.fetchone()[0]
+        cur.execute("SELECT layout, field_name, perfil FROM perfis_campos WHERE layout = ANY(%s);", (layouts,))
+        perfis = {}
+        for layout, campo, perfil in cur.fetchall():
+            perfis.setdefault(layout, {})[campo] = perfil
+        cur.execute("""
+            SELECT layout, assinatura, mapeamento, usos, ultimo_uso FROM mapeamentos_confirmados
+            WHERE layout = ANY(%s);
+        """, (layouts,))
+        mapeamentos = [{'layout': layout, 'assinatura': assinatura, 'mapeamento': mapeamento, 'usos': usos,
+                        'ultimo_uso': ultimo_uso.isoformat()}
+                       for layout, assinatura, mapeamento, usos, ultimo_uso in cur.fetchall()]
+    conn.commit()
+
+    schema = schema_snapshot({
+        'versao': SNAPSHOT_VERSAO,
+        'gerado_em': datetime.datetime.now().isoformat(timespec='seconds'),
+        'amostras': json.dumps(contagens),
+        'perfis': json.dumps(perfis, ensure_ascii=False),
+        'mapeamentos': json.dumps(mapeamentos, ensure_ascii=False),
+    })
+    saida = _SaidaEmPartes()
+    opcoes = pa.ipc.IpcWriteOptions(compression='zstd' if pa.Codec.is_available('zstd') else None)
+    with pa.ipc.new_stream(saida, schema, options=opcoes) as escritor:
+        yield saida.esvaziar()
+        for layout in layouts:
+            with conn.cursor(name=f'snapshot_{layout}') as cur:
+                cur.itersize = SNAPSHOT_LOTE
+                cur.execute(f"""
+                    SELECT field_name, sample_value, hits, ultimo_visto FROM {layout}
+                    ORDER BY field_name, {ordem_retencao_historico()};
+                """)
+                while True:
+                    linhas = cur.fetchmany(SNAPSHOT_LOTE)
+                    if not linhas:
+                        break
+                    campos, valores, hits, vistos = zip(*linhas)
+                    escritor.write_batch(pa.record_batch([
+                        pa.DictionaryArray.from_arrays(pa.array(np.zeros(len(linhas), dtype=np.int32)), pa.array([layout])),
+                        pa.array(campos, pa.string()).dictionary_encode(),
+                        pa.array(valores, pa.string()),
+                        pa.array(hits, pa.int32()),
+                        pa.array(vistos, pa.timestamp('us')),
+                    ], schema=schema))
+                    yield saida.esvaziar()
+            conn.commit()
+    yield saida.esvaziar()
+
+def importar_snapshot_historico(fonte, modo='mesclar', progresso=None, ao_avancar=None):
+    """Lê um snapshot (arquivo binário) e o aplica ao histórico numa única transação. Devolve as contagens por layout.
+
+    'mesclar' soma o snapshot ao que já existe (sem duplicar amostras, mesclando perfis); 'substituir'
+    apaga antes o histórico, os perfis e os mapeamentos dos layouts presentes no snapshot.
+    """
+    exigir_pyarrow()
+    if modo not in SNAPSHOT_MODOS:
+        raise ValueError(f"Modo inválido: {modo}.")
     conn = get_db()
     if conn is None:
-        return {}
-
-    table_name = tipo_layout
-    history_data = {}
-    query = f"""
-        SELECT field_name, array_agg(sample_value)
-        FROM {table_name}
-        GROUP BY field_name;
+        raise RuntimeError("Não foi possível conectar ao banco de dados.")
+
+    try:
+        leitor = pa.ipc.open_stream(fonte)
+    except pa.ArrowInvalid as e:
+        raise ValueError(f"O arquivo não é um snapshot do histórico ({e}).")
+    metadados = {k.decode(): v.decode() for k, v in (leitor.schema.metadata or {}).items()}
+    if metadados.get('versao') != SNAPSHOT_VERSAO:
+        raise ValueError("Versão de snapshot não suportada.")
+    contagens = json.loads(metadados.get('amostras', '{}'))
+    perfis = json.loads(metadados.get('perfis', '{}'))
+    mapeamentos = json.loads(metadados.get('mapeamentos', '[]'))
+    presentes = [layout for layout in contagens if layout in LAYOUTS]
+    stats = {layout: {'lidas': 0, 'novas': 0, 'atualizadas': 0, 'descartadas': 0, 'ignorados': set()}
+             for layout in presentes}
+    if progresso:
+        progresso.etapa('snapshot', total=sum(contagens[layout] for layout in presentes), unidade='amostras')
+
+    pendentes = {}  # layout -> campos carregados na tabela temporária e ainda não mesclados
+    atual = None
+
+    def mesclar_pendente(cur):
+        if atual in pendentes:
+            novas, atualizadas, descartadas = mesclar_carga_historico(cur, atual, pendentes.pop(atual))
+            stats[atual]['novas'] += novas
+            stats[atual]['atualizadas'] += atualizadas
+            stats[atual]['descartadas'] += descartadas
+
+    try:
+        with conn.cursor() as cur:
+            criar_tabela_carga(cur)
+            if modo == 'substituir':
+                for layout in presentes:
+                    cur.execute(f"DELETE FROM {layout};")
+                cur.execute("DELETE FROM perfis_campos WHERE layout = ANY(%s);", (presentes,))
+                cur.execute("DELETE FROM mapeamentos_confirmados WHERE layout = ANY(%s);", (presentes,))
+
+            for lote in leitor:
+                layouts_lote = lote.column('layout').dictionary_decode()
+                for layout in pa_compute.unique(layouts_lote).to_pylist():
+                    if layout not in stats:
+                        continue
+                    parte = lote.filter(pa_compute.equal(layouts_lote, layout))
+                    campos_lote = set(pa_compute.unique(parte.column('field_name').dictionary_decode()).to_pylist())
+                    validos = campos_lote & set(PLANOS[layout].campos)
+                    stats[layout]['ignorados'] |= campos_lote - validos
+                    if validos != campos_lote:
+                        parte = parte.filter(pa_compute.is_in(parte.column('field_name').dictionary_decode(),
+                                                              value_set=pa.array(sorted(validos), pa.string())))
+                    # Os lotes vêm agrupados por layout; ao mudar de layout, o anterior é mesclado
+                    if layout != atual:
+                        mesclar_pendente(cur)
+                        atual = layout
+                    if parte.num_rows:
+                        csv_lote = io.BytesIO()
+                        pa_csv.write_csv(parte.select(['field_name', 'sample_value', 'hits', 'ultimo_visto']), csv_lote,
+                                         pa_csv.WriteOptions(include_header=False))
+                        csv_lote.seek(0)
+                        cur.copy_expert("COPY carga_historico (field_name, sample_value, hits, ultimo_visto) "
+                                        "FROM STDIN WITH (FORMAT csv)", csv_lote)
+                        pendentes.setdefault(layout, set()).update(validos)
+                    stats[layout]['lidas'] += parte.num_rows
+                if progresso:
+                    progresso.avancar(lote.num_rows)
+                if ao_avancar:
+                    ao_avancar(stats)
+            mesclar_pendente(cur)
+
+            for mapeamento in mapeamentos:
+                if mapeamento['layout'] not in stats:
+                    continue
+                cur.execute("""
+                    INSERT INTO mapeamentos_confirmados (layout, assinatura, mapeamento, usos, ultimo_uso)
+                    VALUES (%s, %s, %s, %s, %s)
+                    ON CONFLICT (layout, assinatura)
+                    DO UPDATE SET usos = GREATEST(mapeamentos_confirmados.usos, EXCLUDED.usos),
+                                  mapeamento = CASE WHEN EXCLUDED.ultimo_uso > mapeamentos_confirmados.ultimo_uso
+                                                    THEN EXCLUDED.mapeamento ELSE mapeamentos_confirmados.mapeamento END,
+                                  ultimo_uso = GREATEST(mapeamentos_confirmados.ultimo_uso, EXCLUDED.ultimo_uso);
+                """, (mapeamento['layout'], mapeamento['assinatura'], psycopg2.extras.Json(mapeamento['mapeamento']),
+                      mapeamento['usos'], mapeamento['ultimo_uso']))
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    for layout in presentes:
+        salvar_perfis_campos(layout, perfis.get(layout, {}))
+    for info in stats.values():
+        info['ignorados'] = sorted(info['ignorados'])
+    return stats
+
+def descrever_importacao_snapshot(stats):
+    if not stats:
+        return "O snapshot não contém layouts conhecidos."
+    partes = []
+    for layout, info in stats.items():
+        texto = (f"{LAYOUTS[layout]['nome']}: {info['lidas']} amostra(s), {info['novas']} nova(s), "
+                 f"{info['atualizadas']} já existente(s), {info['descartadas']} descartada(s)")
+        if info['ignorados']:
+            texto += f" (campos ignorados: {', '.join(info['ignorados'])})"
+        partes.append(texto)
+    return '; '.join(partes) + '.'
+
+# ---------- BUSCA NO HISTÓRICO ---------- #
+# A busca por trecho de amostra da tela /history_ia usa o índice de trigramas do Postgres (pg_trgm)
+# quando ele existe para o layout e, senão, um índice de n-gramas em memória por campo, refeito só
+# quando o campo muda. Em ambos as páginas seguem por keyset (a partir da última amostra mostrada) e
+# a contagem é exata até BUSCA_CONTAGEM_EXATA; acima disso vale a estimativa do planejador.
+
+BUSCA_POR_PAGINA = 100
+BUSCA_MAX_POR_PAGINA = 500
+BUSCA_CONTAGEM_EXATA = 10000
+
+_indices_trigramas = {}
+_indices_busca = {}
+
+def tem_indice_trigramas(cur, tipo_layout):
+    if tipo_layout not in _indices_trigramas:
+        cur.execute("SELECT 1 FROM pg_indexes WHERE tablename = %s AND indexname = %s;",
+                    (tipo_layout, f'idx_{tipo_layout}_amostra_trgm'))
+        _indices_trigramas[tipo_layout] = cur.fetchone() is not None
+    return _indices_trigramas[tipo_layout]
+
+class IndiceNgramas:
+    """Índice invertido de trigramas (sem diferenciar maiúsculas) sobre as amostras de um campo."""
+
+    N = 3
+
+    def __init__(self, valores):
+        self.valores = sorted(valores)
+        self.minusculos = [valor.lower() for valor in self.valores]
+        self.postings = {}
+        for i, valor in enumerate(self.minusculos):
+            for ngrama in self.ngramas(valor):
+                self.postings.setdefault(ngrama, []).append(i)
+
+    @classmethod
+    def ngramas(cls, texto):
+        return {texto[i:i + cls.N] for i in range(len(texto) - cls.N + 1)}
+
+    def buscar(self, termo, depois=None, limite=BUSCA_POR_PAGINA):
+        """Devolve (amostras da página, total de acertos, há mais páginas)."""
+        termo = termo.lower()
+        ngramas = self.ngramas(termo)
+        if ngramas:
+            # Interseção começando pela lista mais curta; o teste de substring confirma os candidatos
+            listas = sorted((self.postings.get(ngrama, ()) for ngrama in ngramas), key=len)
+            candidatos = sorted(set(listas[0]).intersection(*listas[1:])) if listas[0] else []
+        else:
+            candidatos = range(len(self.valores))
+        acertos = [i for i in candidatos if termo in self.minusculos[i]]
+        inicio = bisect.bisect_left(acertos, bisect.bisect_right(self.valores, depois)) if depois is not None else 0
+        pagina = acertos[inicio:inicio + limite]
+        return [self.valores[i] for i in pagina], len(acertos), inicio + limite < len(acertos)
+
+def indice_busca(chave, assinatura, ler_valores):
+    """Índice em memória de um campo, reconstruído quando a assinatura (contagem, maior id) do campo muda."""
+    atual = _indices_busca.get(chave)
+    if atual is None or atual[0] != assinatura:
+        atual = _indices_busca[chave] = (assinatura, IndiceNgramas(ler_valores()))
+    return atual[1]
+
+def padrao_ilike(termo):
+    return '%' + termo.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
+
+def buscar_amostras_historico(conn, tipo_layout, campo, termo, depois=None, limite=BUSCA_POR_PAGINA, contar=True):
+    """Busca amostras do campo que contêm `termo`, em ordem, a partir de `depois` (keyset).
+
+    Devolve {'amostras', 'proximo' (cursor da página seguinte ou None), 'total', 'estimado'}; o total
+    só é calculado com `contar` (a primeira página), as seguintes reaproveitam o da primeira.
+    """
+    with conn.cursor() as cur:
+        if not tem_indice_trigramas(cur, tipo_layout):
+            cur.execute(f"SELECT COUNT(*), COALESCE(MAX(id), 0) FROM {tipo_layout} WHERE field_name = %s;", (campo,))
+            assinatura = cur.fetchone()
+
+            def ler_valores():
+                cur.execute(f"SELECT sample_value FROM {tipo_layout} WHERE field_name = %s;", (campo,))
+                return (row[0] for row in cur.fetchall())
+
+            indice = indice_busca((tipo_layout, campo), assinatura, ler_valores)
+            amostras, total, mais = indice.buscar(termo, depois, limite)
+            conn.commit()
+            return {'amostras': amostras, 'proximo': amostras[-1] if mais else None,
+                    'total': total if contar else None, 'estimado': False}
+
+        filtro = "field_name = %s AND sample_value ILIKE %s"
+        parametros = [campo, padrao_ilike(termo)]
+        cur.execute(f"""
+            SELECT sample_value FROM {tipo_layout}
+            WHERE {filtro}{" AND sample_value > %s" if depois is not None else ""}
+            ORDER BY sample_value
+            LIMIT %s;
+        """, parametros + ([depois] if depois is not None else []) + [limite + 1])
+        amostras = [row[0] for row in cur.fetchall()]
+        mais = len(amostras) > limite
+        amostras = amostras[:limite]
+
+        total, estimado = None, False
+        if contar:
+            cur.execute(f"SELECT COUNT(*) FROM (SELECT 1 FROM {tipo_layout} WHERE {filtro} LIMIT %s) limitadas;",
+                        parametros + [BUSCA_CONTAGEM_EXATA + 1])
+            total = cur.fetchone()[0]
+            if total > BUSCA_CONTAGEM_EXATA:
+                cur.execute(f"EXPLAIN (FORMAT JSON) SELECT 1 FROM {tipo_layout} WHERE {filtro};", parametros)
+                total, estimado = max(int(cur.fetchone()[0][0]['Plan']['Plan Rows']), total), True
+    conn.commit()
+    return {'amostras': amostras, 'proximo': amostras[-1] if mais else None, 'total': total, 'estimado': estimado}
+
+# ---------- CURADORIA DO HISTÓRICO ---------- #
+# Remoções em massa na tela /history_ia: uma lista de valores, um padrão (expressão regular do
+# Postgres), o campo inteiro ou as amostras que falham nas regras atuais do campo. Cada operação
+# roda numa transação só; as linhas removidas vão para a lixeira pelo próprio DELETE ... RETURNING
+# e a operação pode ser desfeita enquanto estiver entre as CURADORIA_MAX_OPERACOES mais recentes.
+
+CURADORIA_MODOS = ('valores', 'padrao', 'campo', 'revalidar')
+CURADORIA_MAX_OPERACOES = int(os.environ.get('CURADORIA_MAX_OPERACOES', 50))
+CURADORIA_LOTE = 50000
+CURADORIA_EXEMPLOS = 20
+
+def _remover_para_lixeira(cur, tipo_layout, operacao, condicao, parametros):
+    """Remove as amostras que atendem à condição guardando-as na lixeira da operação. Devolve quantas saíram."""
+    cur.execute(f"""
+        WITH removidas AS (
+            DELETE FROM {tipo_layout} WHERE {condicao}
+            RETURNING field_name, sample_value, hits, ultimo_visto
+        )
+        INSERT INTO curadoria_lixeira (operacao, field_name, sample_value, hits, ultimo_visto)
+        SELECT %s, field_name, sample_value, hits, ultimo_visto FROM removidas;
+    """, [*parametros, operacao])
+    return cur.rowcount
+
+def _ids_invalidos(cur, tipo_layout, campos, progresso=None):
+    """Ids das amostras que não passam mais em validar() do campo, lidas em lotes por cursor no servidor."""
+    ids = []
+    for campo in campos:
+        plano = PLANOS[tipo_layout].campos[campo]
+        with cur.connection.cursor(name=f'revalidar_{tipo_layout}') as leitura:
+            leitura.itersize = CURADORIA_LOTE
+            leitura.execute(f"SELECT id, sample_value FROM {tipo_layout} WHERE field_name = %s;", (campo,))
+            while True:
+                linhas = leitura.fetchmany(CURADORIA_LOTE)
+                if not linhas:
+                    break
+                lote_ids, valores = zip(*linhas)
+                validos = plano.validar_distintos(list(valores))
+                ids.extend(np.asarray(lote_ids, dtype=np.int64)[~validos].tolist())
+                if progresso:
+                    progresso.avancar(len(linhas))
+    return ids
+
+def curar_historico(conn, tipo_layout, modo, campo=None, valores=None, padrao=None, ignorar_maiusculas=False,
+                    simular=False, progresso=None):
+    """Remove em massa amostras do histórico do layout (todos os campos, se `campo` não for informado).
+
+    Com `simular`, só conta e mostra exemplos, sem alterar nada. Devolve {'operacao', 'quantidade',
+    'exemplos', 'descricao'}; 'operacao' é o id para desfazer (None se nada foi removido).
     """
+    if modo not in CURADORIA_MODOS:
+        raise ValueError(f"Modo inválido: {modo}.")
+    plano = PLANOS[tipo_layout]
+    # Campos fora do plano atual (sobras de versões antigas do layout) só não podem ser revalidados
+    if modo == 'revalidar' and campo and campo not in plano.campos:
+        raise ValueError(f"Campo desconhecido no layout: {campo}.")
+    campos = [campo] if campo else list(plano.campos)
+    alvo = f"campo '{campo}'" if campo else "todos os campos"
+    filtro_campo, parametros = ("field_name = %s", [campo]) if campo else ("TRUE", [])
+
+    if modo == 'valores':
+        valores = list(dict.fromkeys(v for v in valores or [] if v.strip()))
+        if not valores:
+            raise ValueError("Informe ao menos um valor.")
+        condicao = f"{filtro_campo} AND sample_value = ANY(%s)"
+        parametros.append(valores)
+        descricao = f"{len(valores)} valor(es) informado(s) em {alvo}"
+    elif modo == 'padrao':
+        if not padrao:
+            raise ValueError("Informe o padrão (expressão regular).")
+        condicao = f"{filtro_campo} AND sample_value {'~*' if ignorar_maiusculas else '~'} %s"
+        parametros.append(padrao)
+        descricao = f"amostras com o padrão /{padrao}/{'i' if ignorar_maiusculas else ''} em {alvo}"
+    elif modo == 'campo':
+        if not campo:
+            raise ValueError("Informe o campo a limpar.")
+        condicao = filtro_campo
+        descricao = f"todas as amostras do {alvo}"
+    else:
+        condicao, parametros = None, None
+        descricao = f"amostras reprovadas nas regras atuais em {alvo}"
 
     try:
         with conn.cursor() as cur:
-            cur.execute(query)
-            results = cur.fetchall()
-            for row in results:
-                field_name, samples = row
-                history_data[field_name] = {"amostras_validas": samples or []}
-        return history_data
-    except psycopg2.errors.UndefinedTable:
-        # A tabela pode não existir ainda, o que é normal na primeira execução.
+            if modo == 'revalidar':
+                if progresso:
+                    cur.execute("SELECT COALESCE(SUM(total), 0) FROM resumo_historico WHERE layout = %s AND field_name = ANY(%s);",
+                                (tipo_layout, campos))
+                    progresso.etapa('curadoria', total=cur.fetchone()[0], unidade='amostras', layout=tipo_layout)
+                ids = _ids_invalidos(cur, tipo_layout, campos, progresso)
+                condicao, parametros = "id = ANY(%s)", [ids]
+
+            if simular:
+                cur.execute(f"""
+                    SELECT COUNT(*), (array_agg(sample_value ORDER BY sample_value))[1:{CURADORIA_EXEMPLOS}]
+                    FROM {tipo_layout} WHERE {condicao};
+                """, parametros)
+                quantidade, exemplos = cur.fetchone()
+                conn.rollback()
+                return {'operacao': None, 'quantidade': quantidade, 'exemplos': exemplos or [], 'descricao': descricao}
+
+            cur.execute("INSERT INTO curadoria_operacoes (layout, descricao) VALUES (%s, %s) RETURNING id;",
+                        (tipo_layout, descricao))
+            operacao = cur.fetchone()[0]
+            if modo == 'revalidar':
+                # Em lotes de ids, para não montar um único comando gigante
+                quantidade = sum(_remover_para_lixeira(cur, tipo_layout, operacao, condicao, [ids[i:i + CURADORIA_LOTE]])
+                                 for i in range(0, len(ids), CURADORIA_LOTE))
+            else:
+                quantidade = _remover_para_lixeira(cur, tipo_layout, operacao, condicao, parametros)
+            cur.execute(f"""
+                SELECT (array_agg(sample_value ORDER BY sample_value))[1:{CURADORIA_EXEMPLOS}]
+                FROM curadoria_lixeira WHERE operacao = %s;
+            """, (operacao,))
+            exemplos = cur.fetchone()[0] or []
+            if quantidade:
+                cur.execute("UPDATE curadoria_operacoes SET quantidade = %s WHERE id = %s;", (quantidade, operacao))
+                cur.execute("""
+                    DELETE FROM curadoria_operacoes
+                    WHERE id IN (SELECT id FROM curadoria_operacoes ORDER BY id DESC OFFSET %s);
+                """, (CURADORIA_MAX_OPERACOES,))
+            else:
+                cur.execute("DELETE FROM curadoria_operacoes WHERE id = %s;", (operacao,))
+                operacao = None
+        conn.commit()
+    except Exception:
         conn.rollback()
-        return {}
-    except Exception as e:
-        print(f"Erro ao carregar histórico de '{table_name}': {e}")
-        return {}
+        raise
+    return {'operacao': operacao, 'quantidade': quantidade, 'exemplos': exemplos, 'descricao': descricao}
+
+def desfazer_curadoria(conn, operacao):
+    """Devolve ao histórico as amostras removidas pela operação. Devolve (layout, quantidade restaurada)."""
+    try:
+        with conn.cursor() as cur:
+            cur.execute("SELECT layout, desfeita_em FROM curadoria_operacoes WHERE id = %s FOR UPDATE;", (operacao,))
+            row = cur.fetchone()
+            if row is None:
+                raise ValueError("Operação não encontrada (pode ter saído do limite das mais recentes).")
+            tipo_layout, desfeita_em = row
+            if desfeita_em is not None or tipo_layout not in LAYOUTS:
+                raise ValueError("Esta operação já foi desfeita.")
+            # Amostras reaprendidas depois da remoção ficam uma vez só, com o maior peso
+            cur.execute(f"""
+                INSERT INTO {tipo_layout} (field_name, sample_value, hits, ultimo_visto)
+                SELECT field_name, sample_value, hits, ultimo_visto FROM curadoria_lixeira WHERE operacao = %s
+                ON CONFLICT (field_name, sample_value)
+                DO UPDATE SET hits = GREATEST({tipo_layout}.hits, EXCLUDED.hits),
+                              ultimo_visto = GREATEST({tipo_layout}.ultimo_visto, EXCLUDED.ultimo_visto);
+            """, (operacao,))
+            quantidade = cur.rowcount
+            cur.execute("DELETE FROM curadoria_lixeira WHERE operacao = %s;", (operacao,))
+            cur.execute("UPDATE curadoria_operacoes SET desfeita_em = NOW() WHERE id = %s;", (operacao,))
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    return tipo_layout, quantidade
+
+def operacoes_curadoria(conn, limite=CURADORIA_MAX_OPERACOES):
+    with conn.cursor() as cur:
+        cur.execute("""
+            SELECT id, layout, descricao, quantidade, criada_em, desfeita_em FROM curadoria_operacoes
+            ORDER BY id DESC LIMIT %s;
+        """, (limite,))
+        linhas = cur.fetchall()
+    conn.commit()
+    return [{'operacao': id_, 'layout': layout, 'nome_layout': LAYOUTS.get(layout, {}).get('nome', layout),
+             'descricao': descricao, 'quantidade': quantidade, 'criada_em': criada_em.isoformat(timespec='seconds'),
+             'desfeita': desfeita_em is not None}
+            for id_, layout, descricao, quantidade, criada_em, desfeita_em in linhas]
+
+# ---------- ARMAZENAMENTO DO HISTÓRICO ---------- #
+# O histórico de mapeamento (amostras por campo com hits e última visita, e os perfis dos campos) fica
+# atrás de uma interface com duas implementações de mesma semântica: HistoricoPostgres, a de sempre, e
+# HistoricoSQLite, um arquivo local para instalações de um nó só e máquinas de teste, sem ida e volta
+# pela rede. load_mapping_history, save_mapping_history e as rotas /history_ia usam historico(), que
+# escolhe conforme HISTORICO_BACKEND. Curadoria e snapshot dependem de recursos do PostgreSQL.
+
+HISTORICO_SQLITE_ESPERA = 30   # segundos aguardando outro processo liberar a escrita no arquivo
+SQLITE_AGORA = "strftime('%Y-%m-%d %H:%M:%f', 'now')"
+MENSAGEM_SO_POSTGRES = "Disponível apenas com o histórico no PostgreSQL (HISTORICO_BACKEND=postgres)."
+
+class HistoricoPostgres:
+    """Histórico nas tabelas do PostgreSQL; sem conexão, lê vazio e não grava (como antes)."""
+
+    nome = 'postgres'
+
+    def __init__(self, conn):
+        self.conn = conn
+
+    def fechar(self):
+        pass  # a conexão é de get_db() e fecha com a requisição
+
+    def carregar(self, tipo_layout):
+        """Carrega as amostras da tabela de layout específica e as agrupa por campo, com seus pesos (hits)."""
+        conn = self.conn
+        if conn is None:
+            return {}
+
+        table_name = tipo_layout
+        history_data = {}
+        query = f"""
+            SELECT field_name,
+                   array_agg(sample_value ORDER BY {ordem_retencao_historico()}),
+                   array_agg(hits ORDER BY {ordem_retencao_historico()})
+            FROM {table_name}
+            GROUP BY field_name;
+        """
+
+        try:
+            with conn.cursor() as cur:
+                cur.execute(query)
+                results = cur.fetchall()
+                for row in results:
+                    field_name, samples, hits = row
+                    samples = (samples or [])[:HISTORICO_MAX_AMOSTRAS_POR_CAMPO]
+                    history_data[field_name] = {
+                        "amostras_validas": samples,
+                        "pesos": dict(zip(samples, hits or [])),
+                    }
+                cur.execute("SELECT field_name, perfil FROM perfis_campos WHERE layout = %s;", (tipo_layout,))
+                for field_name, perfil in cur.fetchall():
+                    history_data.setdefault(field_name, {"amostras_validas": [], "pesos": {}})["perfil"] = perfil
+            return history_data
+        except psycopg2.errors.UndefinedTable:
+            # A tabela pode não existir ainda, o que é normal na primeira execução.
+            conn.rollback()
+            return {}
+        except Exception as e:
+            print(f"Erro ao carregar histórico de '{table_name}': {e}")
+            return {}
+
+    def registrar(self, tipo_layout, novas_amostras_data):
+        """Registra as amostras vistas (somando hits) e descarta o excedente de cada campo conforme a política."""
+        conn = self.conn
+        if conn is None or not novas_amostras_data:
+            return
+
+        table_name = tipo_layout
+        query = f"""
+            INSERT INTO {table_name} (field_name, sample_value)
+            VALUES %s
+            ON CONFLICT (field_name, sample_value)
+            DO UPDATE SET hits = {table_name}.hits + 1, ultimo_visto = NOW();
+        """
+        query_descarte = f"""
+            DELETE FROM {table_name}
+            WHERE id IN (
+                SELECT id FROM {table_name}
+                WHERE field_name = %s
+                ORDER BY {ordem_retencao_historico()}
+                OFFSET %s
+            );
+        """
+
+        try:
+            with conn.cursor() as cur:
+                for field, data in novas_amostras_data.items():
+                    amostras = list(dict.fromkeys(data.get("amostras_validas", [])))
+                    if not amostras:
+                        continue
+                    psycopg2.extras.execute_values(cur, query, [(field, sample) for sample in amostras], page_size=1000)
+                    cur.execute(query_descarte, (field, HISTORICO_MAX_AMOSTRAS_POR_CAMPO))
+            conn.commit()
+        except Exception as e:
+            print(f"Erro ao salvar amostra em '{table_name}': {e}")
+            conn.rollback()
+
+    def salvar_perfis(self, tipo_layout, perfis):
+        """Mescla os perfis aprendidos neste mapeamento com os já salvos para o layout."""
+        conn = self.conn
+        if conn is None or not perfis:
+            return
+
+        try:
+            with conn.cursor() as cur:
+                cur.execute("""
+                    SELECT field_name, perfil FROM perfis_campos
+                    WHERE layout = %s AND field_name = ANY(%s)
+                    FOR UPDATE;
+                """, (tipo_layout, list(perfis)))
+                existentes = dict(cur.fetchall())
+                for campo, perfil in perfis.items():
+                    if campo in existentes:
+                        perfil = mesclar_perfis(existentes[campo], perfil)
+                    cur.execute("""
+                        INSERT INTO perfis_campos (layout, field_name, perfil)
+                        VALUES (%s, %s, %s)
+                        ON CONFLICT (layout, field_name)
+                        DO UPDATE SET perfil = EXCLUDED.perfil, atualizado_em = NOW();
+                    """, (tipo_layout, campo, psycopg2.extras.Json(perfil)))
+            conn.commit()
+        except Exception as e:
+            print(f"Erro ao salvar perfis de '{tipo_layout}': {e}")
+            conn.rollback()
+
+    def resumo(self, layouts):
+        """Lista (layout, campo, total de amostras) dos layouts, em ordem."""
+        if self.conn is None:
+            return []
+        # O resumo é mantido pelos gatilhos das tabelas de amostras: uma linha por campo, sem agregar amostras
+        try:
+            with self.conn.cursor() as cur:
+                cur.execute("""
+                    SELECT layout, field_name, total FROM resumo_historico
+                    WHERE layout = ANY(%s)
+                    ORDER BY layout, field_name;
+                """, (list(layouts),))
+                linhas = cur.fetchall()
+            self.conn.commit()
+        except Exception:
+            self.conn.rollback()
+            raise
+        return linhas
+
+    def previa(self, tipo_layout, campo):
+        """(até RESUMO_PREVIA_AMOSTRAS amostras do campo, total do campo)."""
+        if self.conn is None:
+            return [], 0
+        try:
+            with self.conn.cursor() as cur:
+                cur.execute("SELECT previa, total FROM resumo_historico WHERE layout = %s AND field_name = %s;",
+                            (tipo_layout, campo))
+                row = cur.fetchone()
+            self.conn.commit()
+        except Exception:
+            self.conn.rollback()
+            raise
+        return (row[0], row[1]) if row else ([], 0)
+
+    def buscar(self, tipo_layout, campo, termo, depois=None, limite=BUSCA_POR_PAGINA, contar=True):
+        if self.conn is None:
+            return {'amostras': [], 'proximo': None, 'total': 0, 'estimado': False}
+        try:
+            return buscar_amostras_historico(self.conn, tipo_layout, campo, termo, depois, limite, contar)
+        except Exception:
+            self.conn.rollback()
+            raise
+
+    def remover(self, tipo_layout, campo, valor=None):
+        """Remove um valor do campo (ou o campo inteiro, sem `valor`). Devolve (quantidade, operação para desfazer)."""
+        if self.conn is None:
+            raise RuntimeError("Não foi possível conectar ao banco de dados.")
+        # Passa pela curadoria para que a exclusão fique na lixeira e possa ser desfeita
+        if valor is None:
+            resultado = curar_historico(self.conn, tipo_layout, 'campo', campo=campo)
+        else:
+            resultado = curar_historico(self.conn, tipo_layout, 'valores', campo=campo, valores=[valor])
+        return resultado['quantidade'], resultado['operacao']
+
+    def carregar_semente(self, tipo_layout, arquivo, tamanho=0, progresso=None, ao_avancar=None):
+        conn = self.conn
+        if conn is None:
+            raise RuntimeError("Não foi possível conectar ao banco de dados.")
+
+        stats, perfis = nova_carga_semente()
+        campos = set()
+        lote, linhas_lote = io.StringIO(), 0
+
+        def enviar_lote(cur):
+            nonlocal lote, linhas_lote
+            if linhas_lote:
+                lote.seek(0)
+                cur.copy_expert("COPY carga_historico (field_name, sample_value, hits) FROM STDIN", lote)
+            lote, linhas_lote = io.StringIO(), 0
+
+        try:
+            with conn.cursor() as cur:
+                criar_tabela_carga(cur)
+                for campo, amostra, hits in linhas_semente(tipo_layout, arquivo, stats, perfis, tamanho, progresso):
+                    campos.add(campo)
+                    lote.write(_linha_copy(campo, amostra, hits))
+                    linhas_lote += 1
+                    if linhas_lote >= SEMENTE_LOTE:
+                        enviar_lote(cur)
+                        if ao_avancar:
+                            ao_avancar(stats)
+                enviar_lote(cur)
+
+                if campos:
+                    stats['novas'], stats['atualizadas'], stats['descartadas'] = mesclar_carga_historico(cur, tipo_layout, campos)
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        self.salvar_perfis(tipo_layout, perfis)
+        return stats
+
+class HistoricoSQLite:
+    """Histórico num arquivo SQLite local: mesmas tabelas, hits, retenção por campo e perfis do PostgreSQL."""
+
+    nome = 'sqlite'
+    _preparados = set()
+
+    def __init__(self, caminho):
+        self.caminho = caminho
+        self.conn = sqlite3.connect(caminho, timeout=HISTORICO_SQLITE_ESPERA)
+        # WAL: leituras não esperam a escrita de outro worker; NORMAL basta para um histórico de amostras
+        self.conn.execute("PRAGMA journal_mode = WAL;")
+        self.conn.execute("PRAGMA synchronous = NORMAL;")
+        if caminho not in self._preparados:
+            self.criar_tabelas()
+            self._preparados.add(caminho)
+
+    def fechar(self):
+        self.conn.close()
+
+    def criar_tabelas(self):
+        with self.conn:
+            for table_name in LAYOUTS:
+                self.conn.execute(f"""
+                    CREATE TABLE IF NOT EXISTS {table_name} (
+                        id INTEGER PRIMARY KEY,
+                        field_name TEXT NOT NULL,
+                        sample_value TEXT NOT NULL,
+                        hits INTEGER NOT NULL DEFAULT 1,
+                        ultimo_visto TEXT NOT NULL DEFAULT ({SQLITE_AGORA}),
+                        UNIQUE (field_name, sample_value)
+                    );
+                """)
+                self.conn.execute(f"CREATE INDEX IF NOT EXISTS idx_{table_name}_retencao_lfu ON {table_name} (field_name, hits DESC, ultimo_visto DESC);")
+                self.conn.execute(f"CREATE INDEX IF NOT EXISTS idx_{table_name}_retencao_lru ON {table_name} (field_name, ultimo_visto DESC, hits DESC);")
+            self.conn.execute("""
+                CREATE TABLE IF NOT EXISTS perfis_campos (
+                    layout TEXT NOT NULL,
+                    field_name TEXT NOT NULL,
+                    perfil TEXT NOT NULL,
+                    atualizado_em TEXT NOT NULL,
+                    PRIMARY KEY (layout, field_name)
+                );
+            """)
+
+    def _descartar_excedente(self, tipo_layout, campos):
+        """Aplica o limite por campo (política de retenção) e devolve quantas amostras saíram."""
+        marcadores = ', '.join('?' * len(campos))
+        cursor = self.conn.execute(f"""
+            DELETE FROM {tipo_layout}
+            WHERE id IN (
+                SELECT id FROM (
+                    SELECT id, ROW_NUMBER() OVER (PARTITION BY field_name ORDER BY {ordem_retencao_historico()}) AS posicao
+                    FROM {tipo_layout}
+                    WHERE field_name IN ({marcadores})
+                )
+                WHERE posicao > ?
+            );
+        """, [*campos, HISTORICO_MAX_AMOSTRAS_POR_CAMPO])
+        return cursor.rowcount
+
+    def carregar(self, tipo_layout):
+        history_data = {}
+        try:
+            linhas = self.conn.execute(f"""
+                SELECT field_name, sample_value, hits FROM (
+                    SELECT field_name, sample_value, hits,
+                           ROW_NUMBER() OVER (PARTITION BY field_name ORDER BY {ordem_retencao_historico()}) AS posicao
+                    FROM {tipo_layout}
+                )
+                WHERE posicao <= ?
+                ORDER BY field_name, posicao;
+            """, (HISTORICO_MAX_AMOSTRAS_POR_CAMPO,))
+            for field_name, grupo in itertools.groupby(linhas, key=lambda linha: linha[0]):
+                grupo = list(grupo)
+                history_data[field_name] = {
+                    "amostras_validas": [linha[1] for linha in grupo],
+                    "pesos": {linha[1]: linha[2] for linha in grupo},
+                }
+            for field_name, perfil in self.conn.execute("SELECT field_name, perfil FROM perfis_campos WHERE layout = ?;",
+                                                        (tipo_layout,)):
+                history_data.setdefault(field_name, {"amostras_validas": [], "pesos": {}})["perfil"] = json.loads(perfil)
+            return history_data
+        except sqlite3.Error as e:
+            print(f"Erro ao carregar histórico de '{tipo_layout}': {e}")
+            return {}
+
+    def registrar(self, tipo_layout, novas_amostras_data):
+        if not novas_amostras_data:
+            return
+        query = f"""
+            INSERT INTO {tipo_layout} (field_name, sample_value)
+            VALUES (?, ?)
+            ON CONFLICT (field_name, sample_value)
+            DO UPDATE SET hits = hits + 1, ultimo_visto = {SQLITE_AGORA};
+        """
+        try:
+            with self.conn:
+                for field, data in novas_amostras_data.items():
+                    amostras = list(dict.fromkeys(data.get("amostras_validas", [])))
+                    if not amostras:
+                        continue
+                    self.conn.executemany(query, [(field, sample) for sample in amostras])
+                    self._descartar_excedente(tipo_layout, [field])
+        except sqlite3.Error as e:
+            print(f"Erro ao salvar amostra em '{tipo_layout}': {e}")
+
+    def salvar_perfis(self, tipo_layout, perfis):
+        if not perfis:
+            return
+        try:
+            with self.conn:
+                marcadores = ', '.join('?' * len(perfis))
+                existentes = dict(self.conn.execute(
+                    f"SELECT field_name, perfil FROM perfis_campos WHERE layout = ? AND field_name IN ({marcadores});",
+                    [tipo_layout, *perfis]))
+                for campo, perfil in perfis.items():
+                    if campo in existentes:
+                        perfil = mesclar_perfis(json.loads(existentes[campo]), perfil)
+                    self.conn.execute(f"""
+                        INSERT INTO perfis_campos (layout, field_name, perfil, atualizado_em)
+                        VALUES (?, ?, ?, {SQLITE_AGORA})
+                        ON CONFLICT (layout, field_name)
+                        DO UPDATE SET perfil = excluded.perfil, atualizado_em = excluded.atualizado_em;
+                    """, (tipo_layout, campo, json.dumps(perfil)))
+        except sqlite3.Error as e:
+            print(f"Erro ao salvar perfis de '{tipo_layout}': {e}")
+
+    def resumo(self, layouts):
+        # Sem gatilhos: a contagem por campo percorre só o índice único (field_name, sample_value)
+        return [(layout, field_name, total)
+                for layout in sorted(layouts)
+                for field_name, total in self.conn.execute(
+                    f"SELECT field_name, COUNT(*) FROM {layout} GROUP BY field_name ORDER BY field_name;")]
+
+    def previa(self, tipo_layout, campo):
+        amostras = [row[0] for row in self.conn.execute(
+            f"SELECT sample_value FROM {tipo_layout} WHERE field_name = ? ORDER BY id LIMIT ?;",
+            (campo, RESUMO_PREVIA_AMOSTRAS))]
+        total = self.conn.execute(f"SELECT COUNT(*) FROM {tipo_layout} WHERE field_name = ?;", (campo,)).fetchone()[0]
+        return amostras, total
+
+    def buscar(self, tipo_layout, campo, termo, depois=None, limite=BUSCA_POR_PAGINA, contar=True):
+        assinatura = self.conn.execute(
+            f"SELECT COUNT(*), COALESCE(MAX(id), 0) FROM {tipo_layout} WHERE field_name = ?;", (campo,)).fetchone()
+        indice = indice_busca(
+            (self.caminho, tipo_layout, campo), assinatura,
+            lambda: (row[0] for row in self.conn.execute(
+                f"SELECT sample_value FROM {tipo_layout} WHERE field_name = ?;", (campo,))))
+        amostras, total, mais = indice.buscar(termo, depois, limite)
+        return {'amostras': amostras, 'proximo': amostras[-1] if mais else None,
+                'total': total if contar else None, 'estimado': False}
+
+    def remover(self, tipo_layout, campo, valor=None):
+        with self.conn:
+            if valor is None:
+                cursor = self.conn.execute(f"DELETE FROM {tipo_layout} WHERE field_name = ?;", (campo,))
+            else:
+                cursor = self.conn.execute(f"DELETE FROM {tipo_layout} WHERE field_name = ? AND sample_value = ?;",
+                                           (campo, valor))
+        return cursor.rowcount, None
+
+    def carregar_semente(self, tipo_layout, arquivo, tamanho=0, progresso=None, ao_avancar=None):
+        stats, perfis = nova_carga_semente()
+        campos = set()
+        with self.conn:
+            self.conn.execute("""
+                CREATE TEMP TABLE IF NOT EXISTS carga_historico (
+                    field_name TEXT NOT NULL,
+                    sample_value TEXT NOT NULL,
+                    hits INTEGER NOT NULL,
+                    ultimo_visto TEXT
+                );
+            """)
+            linhas = linhas_semente(tipo_layout, arquivo, stats, perfis, tamanho, progresso)
+            while lote := list(itertools.islice(linhas, SEMENTE_LOTE)):
+                self.conn.executemany("INSERT INTO carga_historico (field_name, sample_value, hits) VALUES (?, ?, ?);", lote)
+                campos.update(linha[0] for linha in lote)
+                if ao_avancar:
+                    ao_avancar(stats)
+
+            if campos:
+                distintas, atualizadas = self.conn.execute(f"""
+                    SELECT COUNT(*), COUNT(t.id) FROM (SELECT DISTINCT field_name, sample_value FROM carga_historico) c
+                    LEFT JOIN {tipo_layout} t USING (field_name, sample_value);
+                """).fetchone()
+                # "WHERE true" desfaz a ambiguidade do ON CONFLICT depois de um SELECT no SQLite
+                self.conn.execute(f"""
+                    INSERT INTO {tipo_layout} (field_name, sample_value, hits, ultimo_visto)
+                    SELECT field_name, sample_value, MAX(hits), COALESCE(MAX(ultimo_visto), {SQLITE_AGORA})
+                    FROM carga_historico
+                    WHERE true
+                    GROUP BY field_name, sample_value
+                    ON CONFLICT (field_name, sample_value)
+                    DO UPDATE SET hits = MAX(hits, excluded.hits), ultimo_visto = MAX(ultimo_visto, excluded.ultimo_visto);
+                """)
+                stats['novas'], stats['atualizadas'] = distintas - atualizadas, atualizadas
+                stats['descartadas'] = self._descartar_excedente(tipo_layout, sorted(campos))
+            self.conn.execute("DELETE FROM carga_historico;")
+        self.salvar_perfis(tipo_layout, perfis)
+        return stats
+
+# O modo 'auto' decide por processo: quando o PostgreSQL não responde, passa ao SQLite e só volta a
+# testar o banco depois de HISTORICO_AUTO_RETENTATIVA segundos, sem esperar o timeout de conexão a cada
+# requisição; cada troca é registrada uma vez no log. O que foi gravado no SQLite nesse intervalo não
+# é levado ao PostgreSQL quando ele volta (nem o contrário), então os dois históricos divergem e cada
+# worker pode estar de um lado. Use 'postgres' ou 'sqlite' quando o histórico precisa ser um só.
+
+_historico_local_ate = None
+_historico_auto_trava = threading.Lock()
+
+def historico_auto_local():
+    """No modo 'auto': True enquanto o processo estiver no SQLite aguardando a próxima tentativa."""
+    return _historico_local_ate is not None and time.monotonic() < _historico_local_ate
+
+def registrar_postgres_auto(disponivel):
+    global _historico_local_ate
+    with _historico_auto_trava:
+        if disponivel:
+            if _historico_local_ate is not None:
+                app.logger.warning("PostgreSQL disponível de novo: o histórico volta ao banco; o que foi gravado "
+                                   "em %s enquanto isso fica só no arquivo local.", app.config['HISTORICO_SQLITE'])
+            _historico_local_ate = None
+            return
+        if _historico_local_ate is None:
+            app.logger.warning("PostgreSQL indisponível: usando o histórico local em %s (nova tentativa a cada %s s).",
+                               app.config['HISTORICO_SQLITE'], app.config['HISTORICO_AUTO_RETENTATIVA'])
+        _historico_local_ate = time.monotonic() + app.config['HISTORICO_AUTO_RETENTATIVA']
+
+def historico():
+    """Armazenamento do histórico da requisição atual, conforme HISTORICO_BACKEND."""
+    if 'historico' not in g:
+        backend = app.config['HISTORICO_BACKEND']
+        conn = None
+        if backend == 'postgres' or (backend == 'auto' and not historico_auto_local()):
+            conn = get_db()
+            if backend == 'auto':
+                registrar_postgres_auto(conn is not None)
+        if backend == 'sqlite' or (backend == 'auto' and conn is None):
+            try:
+                g.historico = HistoricoSQLite(app.config['HISTORICO_SQLITE'])
+                return g.historico
+            except sqlite3.Error as e:
+                print(f"Erro ao abrir o histórico local em {app.config['HISTORICO_SQLITE']}: {e}")
+        elif conn is None:
+            print("PostgreSQL indisponível: o histórico de mapeamento não será lido nem atualizado.")
+        g.historico = HistoricoPostgres(conn)
+    return g.historico
+
+def load_mapping_history(tipo_layout):
+    """Amostras do histórico do layout agrupadas por campo, com seus pesos (hits) e perfis."""
+    return historico().carregar(tipo_layout)
 
 def save_mapping_history(tipo_layout, novas_amostras_data):
-    """Insere novas amostras na tabela de layout apropriada, uma por uma."""
-    conn = get_db()
-    if conn is None or not novas_amostras_data:
-        return
+    """Registra as amostras vistas (somando hits) e descarta o excedente de cada campo conforme a política."""
+    historico().registrar(tipo_layout, novas_amostras_data)
+
+def pontuar_coluna_por_historico(valores_validos, historico_campo):
+    """Proporção ponderada dos valores da coluna já vistos no histórico do campo.
 
-    table_name = tipo_layout
-    query = f"""
-        INSERT INTO {table_name} (field_name, sample_value)
-        VALUES (%s, %s)
-        ON CONFLICT (field_name, sample_value) DO NOTHING;
+    Cada valor conhecido pesa 1 + log(hits), então amostras recorrentes contam mais; valores
+    desconhecidos pesam 1. Com todos os hits iguais a 1 equivale à proporção simples de interseção.
     """
+    pesos = historico_campo.get("pesos") or dict.fromkeys(historico_campo.get("amostras_validas", []), 1)
+    peso_conhecidos, desconhecidos = 0.0, 0
+    for v in valores_validos:
+        hits = pesos.get(v)
+        if hits is None:
+            desconhecidos += 1
+        else:
+            peso_conhecidos += 1 + math.log(max(hits, 1))
+    total = peso_conhecidos + desconhecidos
+    return peso_conhecidos / total if total else 0
+
+def amostras_para_historico(serie, campo, validator):
+    """Valores válidos da coluna, dos mais frequentes para os menos, limitados ao máximo por campo."""
+    amostras = []
+    contagens = serie.value_counts()
+    for v in contagens[contagens > 0].index:
+        if str(v) and validator(campo, v):
+            amostras.append(str(v))
+            if len(amostras) >= HISTORICO_MAX_AMOSTRAS_POR_CAMPO:
+                break
+    return amostras
+
+# ---------- PERFIS DE FORMATO ---------- #
+# Em vez de depender só de valores literais já vistos, cada campo guarda um perfil compacto
+# do formato dos seus valores, comparável com uma pequena amostra de qualquer coluna nova.
+
+PERFIL_MAX_PADROES = 30
+PERFIL_MAX_OBSERVACOES = 10000
+PERFIL_TAMANHO_AMOSTRA = 200
+LIMIAR_PERFIL = 0.8
+
+def padrao_valor(valor):
+    """Assinatura de formato do valor: dígitos viram '9' e letras 'A' (ex.: 999.999.999-99, AAA9A99)."""
+    padrao = re.sub(r'[^\W\d_]', 'A', re.sub(r'\d', '9', str(valor).strip()))
+    if len(padrao) > 20:
+        # Textos longos: colapsa repetições para o padrão não ficar único por valor
+        padrao = re.sub(r'(.)\1+', r'\1+', padrao)
+    return padrao
+
+def amostra_coluna(serie, tamanho=PERFIL_TAMANHO_AMOSTRA):
+    """Até `tamanho` valores não vazios, espaçados ao longo da coluna."""
+    passo = max(1, len(serie) // (tamanho * 5))
+    valores = []
+    for v in serie.iloc[::passo]:
+        if not is_vazio(v):
+            valores.append(str(v).strip())
+            if len(valores) >= tamanho:
+                break
+    return valores
+
+def perfil_valores(valores):
+    """Perfil compacto: contagem de padrões, histograma de comprimentos e proporção de dígitos/letras."""
+    padroes, comprimentos = {}, {}
+    digitos = letras = caracteres = 0
+    for v in valores:
+        p = padrao_valor(v)
+        padroes[p] = padroes.get(p, 0) + 1
+        n = str(min(len(v), 100))
+        comprimentos[n] = comprimentos.get(n, 0) + 1
+        digitos += sum(c.isdigit() for c in v)
+        letras += sum(c.isalpha() for c in v)
+        caracteres += len(v)
+    return {
+        'n': len(valores),
+        'padroes': dict(sorted(padroes.items(), key=lambda x: -x[1])[:PERFIL_MAX_PADROES]),
+        'comprimentos': comprimentos,
+        'prop_digitos': digitos / caracteres if caracteres else 0,
+        'prop_letras': letras / caracteres if caracteres else 0,
+    }
+
+def mesclar_perfis(antigo, novo):
+    """Soma dois perfis; acima de PERFIL_MAX_OBSERVACOES as contagens são reescaladas para o perfil acompanhar dados recentes."""
+    n = antigo['n'] + novo['n']
+    if not n:
+        return novo
+    fator = min(1.0, PERFIL_MAX_OBSERVACOES / n)
+
+    def somar(h1, h2):
+        total = {k: h1.get(k, 0) + h2.get(k, 0) for k in set(h1) | set(h2)}
+        return {k: round(v * fator, 3) for k, v in total.items() if v * fator >= 0.5}
+
+    padroes = somar(antigo['padroes'], novo['padroes'])
+    return {
+        'n': round(n * fator),
+        'padroes': dict(sorted(padroes.items(), key=lambda x: -x[1])[:PERFIL_MAX_PADROES]),
+        'comprimentos': somar(antigo['comprimentos'], novo['comprimentos']),
+        'prop_digitos': (antigo['prop_digitos'] * antigo['n'] + novo['prop_digitos'] * novo['n']) / n,
+        'prop_letras': (antigo['prop_letras'] * antigo['n'] + novo['prop_letras'] * novo['n']) / n,
+    }
+
+def similaridade_perfis(a, b):
+    """Similaridade entre 0 e 1: interseção dos histogramas de padrões e comprimentos e distância das proporções."""
+    def intersecao(h1, h2):
+        t1, t2 = sum(h1.values()), sum(h2.values())
+        if not t1 or not t2:
+            return 0
+        return sum(min(c / t1, h2.get(k, 0) / t2) for k, c in h1.items())
+
+    proporcoes = 1 - (abs(a['prop_digitos'] - b['prop_digitos']) + abs(a['prop_letras'] - b['prop_letras'])) / 2
+    return 0.5 * intersecao(a['padroes'], b['padroes']) + 0.3 * intersecao(a['comprimentos'], b['comprimentos']) + 0.2 * proporcoes
+
+def perfil_para_historico(serie, campo, validator):
+    """Perfil dos valores válidos de uma amostra da coluna mapeada, ou None se não houver nenhum."""
+    valores = [v for v in amostra_coluna(serie, PERFIL_TAMANHO_AMOSTRA * 10) if validator(campo, v)]
+    return perfil_valores(valores) if valores else None
+
+def melhor_coluna_por_perfil(df, campo, perfil, validator, perfis_colunas, colunas_usadas):
+    """Coluna cuja amostra mais se parece com o perfil do campo (acima de LIMIAR_PERFIL), ou None."""
+    melhor_col, melhor_score = None, LIMIAR_PERFIL
+    for col in df.columns:
+        if col in colunas_usadas:
+            continue
+        if col not in perfis_colunas:
+            amostra = amostra_coluna(df[col])
+            perfis_colunas[col] = (amostra, perfil_valores(amostra))
+        amostra, perfil_col = perfis_colunas[col]
+        if not amostra or sum(1 for v in amostra if validator(campo, v)) < len(amostra) / 2:
+            continue
+        score = similaridade_perfis(perfil_col, perfil)
+        if score >= melhor_score:
+            melhor_col, melhor_score = col, score
+    return melhor_col
+
+def salvar_perfis_campos(tipo_layout, perfis):
+    """Mescla os perfis aprendidos neste mapeamento com os já salvos para o layout."""
+    historico().salvar_perfis(tipo_layout, perfis)
+
+# Máximo de mapeamentos memorizados por layout; os menos usados (e mais antigos) são descartados
+MAPEAMENTOS_MAX_POR_LAYOUT = int(os.environ.get('MAPEAMENTOS_MAX_POR_LAYOUT', 200))
+
+def assinatura_cabecalho(colunas):
+    """Gera a impressão digital do cabeçalho (nomes normalizados, na ordem) para reconhecer o layout de origem."""
+    normalizadas = '\x1f'.join(normalizar(c) for c in colunas)
+    return hashlib.sha1(normalizadas.encode('utf-8')).hexdigest()
+
+def buscar_mapeamento_confirmado(tipo_layout, assinatura, colunas):
+    """Devolve o mapeamento já confirmado para a assinatura (ajustado às colunas atuais) ou None."""
+    conn = get_db()
+    if conn is None:
+        return None
+
+    try:
+        with conn.cursor() as cur:
+            cur.execute("""
+                UPDATE mapeamentos_confirmados
+                SET usos = usos + 1, ultimo_uso = NOW()
+                WHERE layout = %s AND assinatura = %s
+                RETURNING mapeamento;
+            """, (tipo_layout, assinatura))
+            row = cur.fetchone()
+        conn.commit()
+    except Exception as e:
+        print(f"Erro ao buscar mapeamento memorizado de '{tipo_layout}': {e}")
+        conn.rollback()
+        return None
+
+    if not row:
+        return None
+    colunas_atuais = {normalizar(c): c for c in colunas}
+    mapeamento = {}
+    for campo, col in row[0].items():
+        col_atual = colunas_atuais.get(normalizar(col))
+        if col_atual is None:
+            return None
+        mapeamento[campo] = col_atual
+    return mapeamento
+
+def salvar_mapeamento_confirmado(tipo_layout, assinatura, mapeamento):
+    """Memoriza o mapeamento confirmado pelo usuário e descarta os excedentes menos usados do layout."""
+    conn = get_db()
+    if conn is None or not assinatura or not mapeamento:
+        return
 
     try:
         with conn.cursor() as cur:
-            for field, data in novas_amostras_data.items():
-                for sample in data.get("amostras_validas", []):
-                    cur.execute(query, (field, sample))
+            cur.execute("""
+                INSERT INTO mapeamentos_confirmados (layout, assinatura, mapeamento)
+                VALUES (%s, %s, %s)
+                ON CONFLICT (layout, assinatura)
+                DO UPDATE SET mapeamento = EXCLUDED.mapeamento, ultimo_uso = NOW();
+            """, (tipo_layout, assinatura, psycopg2.extras.Json(mapeamento)))
+            cur.execute("""
+                DELETE FROM mapeamentos_confirmados
+                WHERE id IN (
+                    SELECT id FROM mapeamentos_confirmados
+                    WHERE layout = %s
+                    ORDER BY usos DESC, ultimo_uso DESC
+                    OFFSET %s
+                );
+            """, (tipo_layout, MAPEAMENTOS_MAX_POR_LAYOUT))
         conn.commit()
     except Exception as e:
-        print(f"Erro ao salvar amostra em '{table_name}': {e}")
+        print(f"Erro ao memorizar mapeamento de '{tipo_layout}': {e}")
         conn.rollback()
 
 # ... (rest of the file remains the same, so it's omitted for brevity)
@@ -398,22 +2655,282 @@ def normalizar_nome(nome):
 def similaridade(a, b):
     return fuzz.ratio(a, b) / 100.0
 
-def limpar_uploads():
-    pasta = app.config['UPLOAD_FOLDER']
-    for f in os.listdir(pasta):
-        caminho_f = os.path.join(pasta, f)
+class LeitorBytes(io.RawIOBase):
+    """Leitor somente-leitura sobre bytes ou mmap que entrega o conteúdo em blocos, sem copiá-lo inteiro."""
+
+    def __init__(self, dados):
+        self._dados = dados
+        self._pos = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def seek(self, pos, whence=io.SEEK_SET):
+        base = {io.SEEK_SET: 0, io.SEEK_CUR: self._pos, io.SEEK_END: len(self._dados)}[whence]
+        self._pos = max(base + pos, 0)
+        return self._pos
+
+    def tell(self):
+        return self._pos
+
+    def readinto(self, buffer):
+        trecho = self._dados[self._pos:self._pos + len(buffer)]
+        buffer[:len(trecho)] = trecho
+        self._pos += len(trecho)
+        return len(trecho)
+
+class LeitorLimitado(io.RawIOBase):
+    """Repassa um fluxo descompactado contando bytes e linhas expandidos e aplicando os limites de upload."""
+
+    def __init__(self, fluxo, fonte):
+        self._fluxo = fluxo
+        self._fonte = fonte
+        self._ultimo_byte = b''
+        self.tamanho = 0
+        self.linhas = 0
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        n = self._fluxo.readinto(buffer)
+        if n:
+            trecho = bytes(buffer[:n])
+            self.tamanho += n
+            self.linhas += trecho.count(b'\n')
+            self._ultimo_byte = trecho[-1:]
+            verificar_limites_upload(self.tamanho, self.linhas)
+        elif self._fonte.tamanho is None:
+            # Fim do conteúdo: tamanho e linhas expandidos ficam conhecidos para o relatório
+            self._fonte.tamanho = self.tamanho
+            self._fonte.linhas = self.linhas + (1 if self.tamanho and self._ultimo_byte != b'\n' else 0)
+        return n
+
+    def close(self):
+        self._fluxo.close()
+        super().close()
+
+class FonteCompactada:
+    """Conteúdo de um arquivo compactado (ou de um membro de .zip) lido em fluxo.
+
+    Cada abrir() descompacta de novo desde o início, então as várias passadas da detecção de
+    encoding e delimitador não gravam nem mantêm em memória o conteúdo expandido.
+    """
+
+    def __init__(self, caminho, formato, membro=None):
+        self.caminho = caminho
+        self.formato = formato
+        self.membro = membro
+        self.tamanho = None
+        self.linhas = None
+
+    def _abrir_fluxo(self):
+        if self.formato == 'zip':
+            # O membro aberto mantém o arquivo do zip aberto até ser fechado
+            with zipfile.ZipFile(self.caminho) as zf:
+                return zf.open(self.membro)
+        return {'gzip': gzip.open, 'bz2': bz2.open, 'xz': lzma.open}[self.formato](self.caminho, 'rb')
+
+    def abrir(self):
+        return io.BufferedReader(LeitorLimitado(self._abrir_fluxo(), self), TAMANHO_BLOCO_UPLOAD)
+
+    def abrir_arrow(self):
+        # gzip e bz2 são descompactados pelo próprio Arrow, fora do GIL
+        if self.formato in ('gzip', 'bz2'):
+            return pa.CompressedInputStream(pa.OSFile(self.caminho), self.formato)
+        return pa.PythonFile(self.abrir(), mode='r')
+
+def membros_compactados(caminho, nome):
+    """(nome, FonteCompactada ou None se o formato não é suportado, extensão) de cada conteúdo do arquivo."""
+    base, ext = os.path.splitext(nome)
+    formato = EXTENSOES_COMPACTADAS[ext.lower()]
+    if formato != 'zip':
+        ext_membro = os.path.splitext(base)[1].lower()
+        return [(base, FonteCompactada(caminho, formato), ext_membro if ext_membro in EXTENSOES_MEMBRO else '.csv')]
+    membros = []
+    with zipfile.ZipFile(caminho) as zf:
+        for info in zf.infolist():
+            partes = info.filename.split('/')
+            if info.is_dir() or partes[0] == '__MACOSX' or partes[-1].startswith('.'):
+                continue
+            nome_membro = secure_filename(info.filename)
+            ext_membro = os.path.splitext(nome_membro)[1].lower()
+            fonte = FonteCompactada(caminho, formato, info.filename) if ext_membro in EXTENSOES_MEMBRO else None
+            membros.append((nome_membro, fonte, ext_membro))
+    if len(membros) > ZIP_MAX_MEMBROS:
+        raise RequestEntityTooLarge(f'O arquivo compactado contém mais de {ZIP_MAX_MEMBROS} arquivos.')
+    return membros
+
+def abrir_binario(dados):
+    """Fluxo binário sobre bytes/mmap ou sobre uma FonteCompactada (descompactando sob demanda)."""
+    if isinstance(dados, FonteCompactada):
+        return dados.abrir()
+    return io.BufferedReader(LeitorBytes(dados), TAMANHO_BLOCO_UPLOAD)
+
+def abrir_texto(dados, encoding):
+    """Abre bytes/mmap (ou uma FonteCompactada) como fluxo de texto decodificado sob demanda."""
+    return io.TextIOWrapper(abrir_binario(dados), encoding=encoding, newline='')
+
+def encoding_valido(dados, encoding):
+    """Verifica em blocos se todo o conteúdo decodifica com o encoding informado."""
+    decoder = codecs.getincrementaldecoder(encoding)()
+    try:
+        with abrir_binario(dados) as f:
+            while bloco := f.read(TAMANHO_BLOCO_UPLOAD):
+                decoder.decode(bloco)
+        decoder.decode(b'', final=True)
+        return True
+    except UnicodeDecodeError:
+        return False
+
+@contextlib.contextmanager
+def abrir_mmap(caminho):
+    """Mapeia o arquivo em memória (somente leitura) para o parser."""
+    with open(caminho, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            yield b''
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as dados:
+            yield dados
+
+def ler_csv_python(dados, encoding, sep):
+    """Leitor de reserva: csv.reader remonta os registros com quebra de linha entre aspas, descarta
+    os com número de colunas divergente e regrava os válidos num buffer para o pandas.
+    Retorna (df, intervalos de linhas ignorados, intervalos de registros com várias linhas)."""
+    linhas_ignoradas = []
+    registros_multilinha = []
+    header = None
+    n_cols = None
+    ultima_linha = 0
+    output = io.StringIO()
+    writer = csv.writer(output, delimiter=sep, quotechar='"', quoting=csv.QUOTE_MINIMAL)
+    with abrir_texto(dados, encoding) as f:
+        leitor = csv.reader(f, delimiter=sep, quotechar='"')
+        for row in leitor:
+            intervalo = (ultima_linha + 1, leitor.line_num)
+            ultima_linha = leitor.line_num
+            if header is None and any(str(c).strip() != '' for c in row):
+                header = row
+                n_cols = len(header)
+                writer.writerow(row)
+            elif not row or all([str(c).strip() == '' for c in row]):
+                continue
+            elif len(row) != n_cols:
+                linhas_ignoradas.append(intervalo)
+            else:
+                writer.writerow(row)
+                if intervalo[1] > intervalo[0]:
+                    registros_multilinha.append(intervalo)
+    output.seek(0)
+
+    df = pd.read_csv(
+        output,
+        sep=sep,
+        quotechar='"',
+        engine='python',
+        keep_default_na=False,
+        dtype=TIPO_TEXTO,
+        on_bad_lines='skip'
+    )
+    output.close()
+    return df, linhas_ignoradas, registros_multilinha
+
+def ler_csv_arrow(dados, encoding, sep):
+    """Leitura multithread com o leitor CSV do Arrow, todas as colunas como texto.
+
+    Campos entre aspas com quebra de linha são remontados pelo próprio leitor; registros com número
+    de colunas divergente são descartados pelo invalid_row_handler. Retorna (df, intervalos de linhas
+    ignorados, intervalos de registros com várias linhas) ou None quando o Arrow não está disponível
+    ou não consegue ler o arquivo.
+    """
+    if pa is None:
+        return None
+    with abrir_texto(dados, encoding) as f:
+        primeira_linha = f.readline()
+    # Cabeçalho vazio ou com quebra de linha entre aspas fica com o leitor de reserva
+    if not primeira_linha.strip() or primeira_linha.count('"') % 2:
+        return None
+    # Nomes de coluna pelo próprio pandas, para repetir o tratamento de duplicados e vazios
+    colunas = pd.read_csv(io.StringIO(primeira_linha), sep=sep, quotechar='"', engine='python', nrows=0).columns
+    nomes = [f'c{i}' for i in range(len(colunas))]
+
+    def ler(use_threads):
+        ignoradas = []
+
+        def linha_invalida(linha):
+            ignoradas.append((linha.number, linha.text))
+            return 'skip'
+
+        fonte = dados.abrir_arrow() if isinstance(dados, FonteCompactada) else pa.BufferReader(pa.py_buffer(dados))
         try:
-            if os.path.isfile(caminho_f):
-                os.remove(caminho_f)
-        except Exception:
-            pass
+            tabela = pa_csv.read_csv(
+                fonte,
+                read_options=pa_csv.ReadOptions(column_names=nomes, skip_rows=1, encoding=encoding,
+                                                use_threads=use_threads, block_size=TAMANHO_BLOCO_UPLOAD),
+                # Linhas vazias viram registros em branco, para contarem na numeração das linhas
+                parse_options=pa_csv.ParseOptions(delimiter=sep, quote_char='"', newlines_in_values=True,
+                                                  ignore_empty_lines=False, invalid_row_handler=linha_invalida),
+                convert_options=pa_csv.ConvertOptions(column_types={n: pa.string() for n in nomes},
+                                                      strings_can_be_null=False, quoted_strings_can_be_null=False),
+            )
+        finally:
+            # Libera a referência ao mmap antes que o chamador feche o arquivo
+            fonte.close()
+            del fonte
+        return tabela, ignoradas
+
+    try:
+        tabela, ignoradas = ler(True)
+        if ignoradas:
+            # Com várias threads o Arrow não numera as linhas; só arquivos com linhas
+            # descartadas pagam uma segunda leitura sequencial para o alerta.
+            tabela, ignoradas = ler(False)
+    except (pa.ArrowException, UnicodeDecodeError):
+        return None
+
+    # Linhas físicas de cada registro (1 + quebras dentro dos campos), na ordem do arquivo:
+    # os descartados entram na posição indicada pelo handler, os lidos ocupam as demais.
+    quebras = np.zeros(tabela.num_rows, dtype=np.int64)
+    for coluna in tabela.columns:
+        quebras += pa_compute.count_substring(coluna, '\n').to_numpy()
+    linhas_por_registro = np.ones(tabela.num_rows + len(ignoradas), dtype=np.int64)
+    posicoes_ignoradas = np.array([numero - 2 for numero, _ in ignoradas], dtype=np.int64)
+    lidos = np.ones(len(linhas_por_registro), dtype=bool)
+    lidos[posicoes_ignoradas] = False
+    linhas_por_registro[posicoes_ignoradas] += np.array([texto.count('\n') for _, texto in ignoradas], dtype=np.int64)
+    linhas_por_registro[lidos] += quebras
+    inicio = 2 + np.concatenate(([0], np.cumsum(linhas_por_registro)[:-1]))
+    fim = inicio + linhas_por_registro - 1
+    linhas_ignoradas = [(int(inicio[p]), int(fim[p])) for p, (_, texto) in zip(posicoes_ignoradas, ignoradas) if texto.strip()]
+    multilinha = np.flatnonzero(lidos)[quebras > 0]
+    registros_multilinha = [(int(inicio[p]), int(fim[p])) for p in multilinha]
+
+    # Como no leitor de reserva, registros só com campos em branco são ignorados
+    if tabela.num_rows:
+        vazias = None
+        for coluna in tabela.columns:
+            em_branco = pa_compute.equal(pa_compute.utf8_trim_whitespace(coluna), '')
+            vazias = em_branco if vazias is None else pa_compute.and_(vazias, em_branco)
+        tabela = tabela.filter(pa_compute.invert(vazias))
+
+    df = tabela.to_pandas(types_mapper=lambda t: pd.StringDtype('pyarrow') if pa.types.is_string(t) else None)
+    df.columns = colunas
+    return df, sorted(linhas_ignoradas), registros_multilinha
+
+def formatar_intervalos(intervalos, limite=8):
+    """Ex.: [(3, 3), (10, 12)] -> '3, 10-12' (só os primeiros `limite`)."""
+    return ', '.join(str(a) if a == b else f'{a}-{b}' for a, b in intervalos[:limite])
 
 def detectar_encoding_e_linhas_validas(file_bytes, extensao='.csv', filename='arquivo'):
+    """Lê o conteúdo (bytes, mmap ou FonteCompactada) detectando encoding e delimitador e descartando linhas malformadas."""
     if extensao == '.xlsx':
         try:
-            df = pd.read_excel(io.BytesIO(file_bytes), engine='openpyxl')
+            df = pd.read_excel(abrir_binario(file_bytes), engine='openpyxl', dtype=str).fillna('')
             df = normalizar_colunas_vazias(df)
-            return df, None, None, []
+            return compactar_dataframe(df), None, None, []
         except Exception:
             return None, None, None, []
 
@@ -423,99 +2940,45 @@ def detectar_encoding_e_linhas_validas(file_bytes, extensao='.csv', filename='ar
     linhas_ignoradas_indices = []
 
     for enc in encodings:
-        try:
-            texto = file_bytes.decode(enc)
-        except Exception:
+        if not encoding_valido(file_bytes, enc):
             continue
 
+        with abrir_texto(file_bytes, enc) as f:
+            sample = f.read(2048)
         try:
             sniffer = csv.Sniffer()
-            sample = texto[:2048]
             dialect = sniffer.sniff(sample, delimiters=delimiters)
             sep_heur = dialect.delimiter
         except Exception:
-            first_lines = "\n".join(texto.splitlines()[:10])
+            with abrir_texto(file_bytes, enc) as f:
+                first_lines = "\n".join(linha.rstrip('\r\n') for linha in itertools.islice(f, 10))
             sep_counts = {sep: first_lines.count(sep) for sep in delimiters}
             sep_heur = max(sep_counts, key=sep_counts.get)
         seps_to_try = [sep_heur] + [s for s in delimiters if s != sep_heur]
 
         for sep in seps_to_try:
             try:
-                multiline_lines = []
-                in_quotes = False
-                line_num = 0
-                with io.StringIO(texto) as f:
-                    for raw_line in f:
-                        line_num += 1
-                        quote_count = len(re.findall(r'(?<!")"(?!")', raw_line))
-                        if quote_count % 2 == 1:
-                            in_quotes = not in_quotes
-                            multiline_lines.append(line_num)
-                        elif in_quotes:
-                            multiline_lines.append(line_num)
-                multiline_lines = sorted(set(multiline_lines))
-
-                reader = csv.reader(io.StringIO(texto), delimiter=sep, quotechar='"')
-                all_lines = texto.splitlines(keepends=True)
-                rows = []
-                linhas_ignoradas = set()
-                header = None
-                n_cols = None
-                idx_linha_arq = 0
-                for row in csv.reader(io.StringIO(texto), delimiter=sep, quotechar='"'):
-                    idx_linha_arq += 1
-                    if header is None and any(str(f).strip() != '' for f in row):
-                        header = row
-                        n_cols = len(header)
-                        rows.append(row)
-                    elif not row or all([str(f).strip() == '' for f in row]):
-                        continue
-                    elif len(row) != n_cols:
-                        linhas_ignoradas.add(idx_linha_arq)
-                    else:
-                        rows.append(row)
-
-                linhas_validas = []
-                current_line = 0
-                for row in csv.reader(io.StringIO(texto), delimiter=sep, quotechar='"'):
-                    current_line += 1
-                    if current_line in linhas_ignoradas:
-                        continue
-                    linhas_validas.append(row)
-                output = io.StringIO()
-                writer = csv.writer(output, delimiter=sep, quotechar='"', quoting=csv.QUOTE_MINIMAL)
-                for row in linhas_validas:
-                    writer.writerow(row)
-                texto_validado = output.getvalue()
-
-                df = pd.read_csv(
-                    io.StringIO(texto_validado),
-                    sep=sep,
-                    quotechar='"',
-                    engine='python',
-                    keep_default_na=False,
-                    dtype=str,
-                    on_bad_lines='skip'
-                )
+                lido = ler_csv_arrow(file_bytes, enc, sep)
+                if lido is None:
+                    lido = ler_csv_python(file_bytes, enc, sep)
+                df, linhas_ignoradas, registros_multilinha = lido
                 df = normalizar_colunas_vazias(df)
 
                 if df.shape[1] > maior_colunas and df.shape[1] > 1 and len(df) > 0:
-                    melhor_df = df
+                    melhor_df = compactar_dataframe(df)
                     melhor_sep = sep
                     melhor_enc = enc
                     maior_colunas = df.shape[1]
                     alertas = []
-                    if multiline_lines:
-                        exemplo = ', '.join(str(x) for x in multiline_lines[:8])
+                    if registros_multilinha:
                         alertas.append(
-                            f'Atenção: O arquivo "{filename}" contém {len(multiline_lines)} linha(s) com quebra de linha. '
-                            f'Essas linhas foram ignoradas na análise para evitar inconsistências. Linhas: {exemplo}.'
+                            f'Atenção: O arquivo "{filename}" contém {len(registros_multilinha)} registro(s) com quebra de linha dentro de campos entre aspas. '
+                            f'Esses registros foram lidos normalmente. Linhas: {formatar_intervalos(registros_multilinha)}.'
                         )
                     if linhas_ignoradas:
-                        exemplo = ', '.join(str(x) for x in list(linhas_ignoradas)[:8])
                         alertas.append(
-                            f'Atenção: O arquivo "{filename}" contém {len(linhas_ignoradas)} linha(s) com quebra de linha. '
-                            f'Essas linhas foram ignoradas na análise para evitar inconsistências. Linhas: {exemplo}.'
+                            f'Atenção: O arquivo "{filename}" contém {len(linhas_ignoradas)} registro(s) com número de colunas diferente do cabeçalho. '
+                            f'Esses registros foram ignorados na análise para evitar inconsistências. Linhas: {formatar_intervalos(linhas_ignoradas)}.'
                         )
                     linhas_ignoradas_indices = alertas
             except Exception:
@@ -538,1398 +3001,748 @@ def normalizar_colunas_vazias(df):
     df.columns = new_cols
     return df
 
+def compactar_dataframe(df):
+    """Converte as colunas para texto compacto (Arrow) ou categórico quando há poucos valores distintos."""
+    total = len(df)
+    for i in range(df.shape[1]):
+        serie = df.iloc[:, i]
+        if isinstance(serie.dtype, pd.CategoricalDtype):
+            continue
+        serie = serie.astype(TIPO_TEXTO)
+        if total >= MIN_LINHAS_CATEGORIA and serie.nunique(dropna=False) <= total * FRACAO_MAX_CATEGORIA:
+            serie = serie.astype('category')
+        df.isetitem(i, serie)
+    return df
 
-# --------- MERCADORIAS CADASTRO --------- #
+# O DataFrame lido no upload fica num arquivo Arrow na pasta da sessão; a sessão guarda só o nome.
+# O mapeamento e as amostras abrem o arquivo por memory map com os mesmos tipos compactos do upload
+# (texto Arrow e categóricos), sem reprocessar o arquivo original nem copiar os dados para a sessão.
 
-def validar_campo_mercadorias(campo, valor):
-    if isinstance(valor, str):
-        valor_limpo = valor.strip()
-    else:
-        valor_limpo = valor
-    layout_info = next((item for item in LAYOUT_MERCADORIA if item[0] == campo), None)
-    if layout_info and layout_info[4] and (pd.isna(valor_limpo) or str(valor_limpo).strip() == ''):
-        return False
-    if not layout_info[4] and (pd.isna(valor_limpo) or str(valor_limpo).strip() == ''):
-        return True
-    max_len = layout_info[3] if layout_info and isinstance(layout_info[3], int) else float('inf')
-    if campo == 'codigo':
-        try:
-            s = str(valor_limpo)
-            if not (4 <= len(s) <= max_len and re.match(r'^[A-Z0-9\s\-\/\.]+$', s, re.I)):
-                return False
-            common_words = ['de', 'da', 'do', 'com', 'para', 'em', 'um', 'uma']
-            if any(word in s.lower().split() for word in common_words):
-                return False
-            return True
-        except Exception:
-            return False
-    if campo == 'nome':
-        return isinstance(valor_limpo, str) and 5 <= len(str(valor_limpo)) <= 150
-    if campo == 'unidade':
-        return isinstance(valor_limpo, str) and 1 <= len(str(valor_limpo)) <= max_len
-    if campo == 'marca':
-        return isinstance(valor_limpo, str) and 1 <= len(str(valor_limpo)) <= max_len
-    if campo == 'tipo':
-        return isinstance(valor_limpo, str) and 1 <= len(str(valor_limpo)) <= max_len
-    if campo == 'ncm':
-        if isinstance(valor_limpo, (int, float)):
-            valor_limpo = str(int(valor_limpo))
-        return (isinstance(valor_limpo, str)
-            and (len(str(valor_limpo)) == 8 or (len(str(valor_limpo)) == 10 and '.' in str(valor_limpo)))
-            and re.match(r'^[0-9\.]+$', str(valor_limpo)))
-    if campo == 'tributacao':
-        return isinstance(valor_limpo, str) and 1 <= len(str(valor_limpo)) <= max_len
-    if campo in ['preco_venda', 'preco_custo_aquisicao', 'preco_venda_sugerido', 'preco_garantia', 'preco_custo_fabrica']:
-        try:
-            num = float(str(valor_limpo).replace(',', '.'))
-            return num >= 0
-        except ValueError:
-            return False
-    if campo == 'original':
-        return str(valor_limpo).strip().lower() in ['1', '0', 'true', 'false', 'sim', 'não', 'nao', 'yes', 'no']
-    if campo in ['curva_abc', 'curva_xyz']:
-        return str(valor_limpo).strip().upper() in ['A', 'B', 'C', 'D', 'X', 'Y', 'Z']
-    if campo == 'aplicacao':
-        return isinstance(valor_limpo, str) and len(str(valor_limpo)) <= max_len
-    if campo in ['origem', 'anp', 'qtd_embalagem']:
-        if campo == 'anp':
-            v = str(valor_limpo).strip()
-            if v == "":
-                return True
-            if v.isdigit() and len(v) == 9:
-                return True
-            try:
-                v_int = int(float(v))
-                return len(str(v_int)) == 9
-            except Exception:
-                return False
-        else:
-            try:
-                return str(valor_limpo).strip() == "" or float(str(valor_limpo).replace(',', '.')) >= 0
-            except ValueError:
-                return False
-    if campo == 'coeficiente':
-        return isinstance(valor_limpo, str) and len(str(valor_limpo)) <= max_len
-    if campo == 'cod_original':
-        return isinstance(valor_limpo, str) and len(str(valor_limpo)) <= max_len
-    if campo == 'cest':
-        if isinstance(valor_limpo, (int, float)):
-            valor_limpo = str(int(valor_limpo))
-        return (isinstance(valor_limpo, str)
-            and (len(str(valor_limpo)) == 7 or (len(str(valor_limpo)) == 9 and '.' in str(valor_limpo)))
-            and re.match(r'^[0-9\.]+$', str(valor_limpo)))
-    return True
-
-def auto_map_header_mercadorias(df, layout, keywords):
-    auto_map = {}
-    for campo, *_ in layout:
-        melhor_col, melhor_score = None, 0
-        for col in df.columns:
-            col_norm = normalizar_nome(col)
-            for key in keywords.get(campo, [campo]):
-                key_norm = normalizar_nome(key)
-                score = similaridade(col_norm, key_norm)
-                if score > melhor_score and score >= 0.82:
-                    melhor_col, melhor_score = col, score
-        if melhor_col:
-            auto_map[campo] = melhor_col
-    return auto_map
-
-def auto_map_by_data_mercadorias(df, layout, mapping_history):
-    auto_map = {}
-    for campo, *_ in layout:
-        if campo in mapping_history and mapping_history[campo].get("amostras_validas"):
-            campo_amostras = set(mapping_history[campo]["amostras_validas"])
-            melhor_col, melhor_score = None, 0
-            for col in df.columns:
-                serie = df[col].dropna().astype(str)
-                serie_validas = set([v for v in serie if validar_campo_mercadorias(campo, v)])
-                if not serie_validas:
-                    continue
-                intersecao = campo_amostras.intersection(serie_validas)
-                score = len(intersecao) / max(len(serie_validas), 1)
-                if score > melhor_score and score >= 0.5:
-                    melhor_col, melhor_score = col, score
-            if melhor_col:
-                auto_map[campo] = melhor_col
-    return auto_map
-
-def is_vazio(v):
-    if v is None:
-        return True
-    if isinstance(v, float):
-        try:
-            if math.isnan(v):
-                return True
-        except Exception:
-            pass
-
-    if isinstance(v, str):
-        if v.strip() == "" or v.strip().lower() == "nan":
-            return True
-    try:
-        if pd.isna(v):
-            return True
-    except Exception:
-        pass
-    return False
-
-def aprender_metadados_coluna_mercadorias(serie, campo_layout, old_samples=None):
-    if campo_layout in CAMPOS_IGNORAR_HISTORY_IA:
-        return old_samples or []
-    valid_samples = set(s for s in (old_samples or []) if s != "")
-    for val in pd.Series(serie.dropna().astype(str).unique()):
-        if validar_campo_mercadorias(campo_layout, val) and val != "":
-            valid_samples.add(val)
-    return list(valid_samples)
-
-def analisar_dados_mercadorias(df, layout, mapeamento):
-    inconsistencias = {}
-    stats = []
-    total_linhas = len(df)
-    linha_valida = [True] * total_linhas
-
-    def is_vazio(v):
-        if v is None:
-            return True
-        if isinstance(v, float):
-            try:
-                if math.isnan(v):
-                    return True
-            except Exception:
-                pass
-        if isinstance(v, str):
-            if v.strip() == "" or v.strip().lower() == "nan":
-                return True
-        try:
-            if pd.isna(v):
-                return True
-        except Exception:
-            pass
-        return False
-
-    codigos_em_branco = []
-    exemplos_codigo_em_branco = []
-    codigos_duplicados = set()
-    codigos_com_espaco = set()
-    codigos_ultrapassa_tamanho = set()
-    codigos_vistos = set()
-    exemplos_codigo_duplicados = []
-    exemplos_codigo_espaco = []
-    exemplos_codigo_ultrapassa = []
-
-    codigo_col = mapeamento.get('codigo')
-    if codigo_col and codigo_col in df.columns:
-        maxlen_codigo = [x[3] for x in layout if x[0] == 'codigo'][0] if [x[3] for x in layout if x[0] == 'codigo'] else 20
-
-        for idx, v in enumerate(df[codigo_col]):
-            if is_vazio(v):
-                codigos_em_branco.append("")
-                if len(exemplos_codigo_em_branco) < 8:
-                    exemplos_codigo_em_branco.append("")
-                linha_valida[idx] = False
-            else:
-                valor = str(v).strip()
-                if valor in codigos_vistos:
-                    codigos_duplicados.add(valor)
-                    if len(exemplos_codigo_duplicados) < 8:
-                        exemplos_codigo_duplicados.append(valor)
-                    linha_valida[idx] = False
-                else:
-                    codigos_vistos.add(valor)
-                if ' ' in valor:
-                    codigos_com_espaco.add(valor)
-                    if len(exemplos_codigo_espaco) < 8:
-                        exemplos_codigo_espaco.append(valor)
-                if len(valor) > maxlen_codigo:
-                    codigos_ultrapassa_tamanho.add(valor)
-                    if len(exemplos_codigo_ultrapassa) < 8:
-                        exemplos_codigo_ultrapassa.append(valor)
-                    linha_valida[idx] = False
-
-    if codigos_em_branco:
-        inconsistencias['codigo_em_branco'] = {
-            "label": "Código",
-            "tipo": "em_branco",
-            "mensagem": f"Em branco: {len(codigos_em_branco)} registro(s)",
-            "amostra": []
-        }
-    if codigos_duplicados:
-        inconsistencias['codigo_duplicado'] = {
-            "label": "Código",
-            "tipo": "duplicado",
-            "mensagem": f"Duplicados: {len(codigos_duplicados)} registro(s)",
-            "amostra": exemplos_codigo_duplicados
-        }
-    if codigos_ultrapassa_tamanho:
-        inconsistencias['codigo_ultrapassa'] = {
-            "label": "Código",
-            "tipo": "ultrapassa_tamanho",
-            "mensagem": f"Excede o limite de caracteres: {len(codigos_ultrapassa_tamanho)} registro(s)",
-            "amostra": exemplos_codigo_ultrapassa
-        }
-
-    texto_ultrapassa = {}
-    texto_nao_texto = {}
-    negativos = {}
-
-    for campo, label, tipo, tamanho, obrigatorio in layout:
-        col = mapeamento.get(campo)
-        if obrigatorio and (not col or col not in df.columns):
-            inconsistencias[campo] = {
-                "label": label,
-                "tipo": "invalido",
-                "mensagem": "Campo obrigatório não mapeado ou não encontrado.",
-                "amostra": []
-            }
-            stats.append({'campo': label, 'validos': 0, 'invalidos': total_linhas})
-            linha_valida = [False] * total_linhas
-            continue
-        if not col or col not in df.columns:
-            stats.append({'campo': label, 'validos': 0, 'invalidos': 0})
-            continue
-
-        serie = df[col].astype(str)
-        validos, invalidos = 0, 0
-        em_branco_qtd = 0
-        exemplos_em_branco = []
-        exemplos_outros_invalidos = []
-        is_numeric = campo in ['preco_venda', 'preco_custo_aquisicao', 'preco_venda_sugerido',
-                              'preco_garantia', 'preco_custo_fabrica']
-
-        for idx, v in enumerate(serie):
-            vazio = is_vazio(v)
-            if tipo.lower() == 'texto':
-                maxlen = [x[3] for x in layout if x[0] == campo][0]
-                if not isinstance(v, str):
-                    texto_nao_texto.setdefault(campo, set()).add(v)
-                if maxlen and isinstance(v, str) and v.strip() != "" and len(str(v)) > int(maxlen):
-                    texto_ultrapassa.setdefault(campo, set()).add(v)
-
-            valido = validar_campo_mercadorias(campo, v)
-            if is_numeric:
-                try:
-                    num = float(str(v).replace(',', '.'))
-                    if num < 0:
-                        if campo not in negativos:
-                            negativos[campo] = []
-                        negativos[campo].append(v)
-                except Exception:
-                    pass
-
-            if not valido:
-                invalidos += 1
-                if vazio:
-                    em_branco_qtd += 1
-                    if len(exemplos_em_branco) < 8:
-                        exemplos_em_branco.append(v)
-                else:
-                    if len(exemplos_outros_invalidos) < 8 and not is_vazio(v):
-                        exemplos_outros_invalidos.append(v)
-                if obrigatorio:
-                    linha_valida[idx] = False
-            else:
-                validos += 1
-
-        stats.append({'campo': label, 'validos': validos, 'invalidos': invalidos})
-
-        if is_numeric and campo in negativos:
-            exemplos_negativos_ordenados = sorted(
-                set([v for v in negativos[campo] if not is_vazio(v)]),
-                key=lambda x: float(str(x).replace(',', '.'))
-            )
-            inconsistencias[campo] = {
-                "label": label,
-                "tipo": "negativo",
-                "mensagem": f"Valor negativo: {len(negativos[campo])} registro(s)",
-                "amostra": exemplos_negativos_ordenados
-            }
-        elif invalidos - em_branco_qtd > 0:
-            exemplos_distintos_ordenados = sorted(
-                set([v for v in exemplos_outros_invalidos if not is_vazio(v)]),
-                key=lambda x: (str(x).lower(), str(x))
-            )
-            inconsistencias[campo] = {
-                "label": label,
-                "tipo": "invalido",
-                "mensagem": f"Valor inválido: {invalidos - em_branco_qtd} registro(s)",
-                "amostra": exemplos_distintos_ordenados
-            }
-
-        if em_branco_qtd > 0:
-            inconsistencias[f'{campo}_em_branco'] = {
-                "label": label,
-                "tipo": "em_branco",
-                "mensagem": f"Em branco: {em_branco_qtd} registro(s)",
-                "amostra": []
-            }
-
-    for campo, valores in texto_ultrapassa.items():
-        label = [x[1] for x in layout if x[0] == campo][0]
-        inconsistencias[f'{campo}_ultrapassa'] = {
-            "label": label,
-            "tipo": "ultrapassa_tamanho",
-            "mensagem": f"Excede o limite de caracteres: {len(valores)} registro(s)",
-            "amostra": sorted(
-                [v for v in valores if not is_vazio(v)],
-                key=lambda x: (str(x).lower(), str(x))
-            )
-        }
-
-    for campo, valores in texto_nao_texto.items():
-        label = [x[1] for x in layout if x[0] == campo][0]
-        inconsistencias[f'{campo}_nao_texto'] = {
-            "label": label,
-            "tipo": "nao_texto",
-            "mensagem": f"Valor não é texto: {len(valores)} registro(s)",
-            "amostra": sorted(
-                [v for v in valores if not is_vazio(v)],
-                key=lambda x: (str(x).lower(), str(x))
-            )
-        }
-
-    inconsistencias_ordenadas = dict(sorted(inconsistencias.items(), key=lambda x: x[1]['label'].lower()))
-    total_validos_geral = sum(linha_valida)
-    total_invalidos_geral = total_linhas - total_validos_geral
-
-    return inconsistencias_ordenadas, stats, total_linhas, total_validos_geral, total_invalidos_geral
-
-# --------------- MERCADORIAS SALDOS --------------- #
-
-def validar_campo_mercadorias_saldos(campo, valor):
-    if isinstance(valor, str):
-        valor_limpo = valor.strip()
-    else:
-        valor_limpo = valor
-    layout_info = next((item for item in LAYOUT_MERCADORIA_SALDOS if item[0] == campo), None)
-    if layout_info and layout_info[4] and (pd.isna(valor_limpo) or str(valor_limpo).strip() == ''):
-        return False
-    if not layout_info[4] and (pd.isna(valor_limpo) or str(valor_limpo).strip() == ''):
-        return True
-    max_len = layout_info[3] if layout_info and isinstance(layout_info[3], int) else float('inf')
-    if campo == 'codigo':
-        return isinstance(valor_limpo, str) and 1 <= len(str(valor_limpo)) <= max_len
-    if campo in ['tipo_localizacao', 'localizacao']:
-        return isinstance(valor_limpo, str) and len(str(valor_limpo)) <= max_len
-    if campo in ['custo_medio', 'custo_medio_contabil', 'custo_ultima_compra', 'base_media_icms_st', 'valor_medio_icms_st', 'saldo', 'custo_contabil_ultima_compra']:
-        try:
-            float(str(valor_limpo).replace(',', '.'))
-            return True
-        except:
-            return False
-    return True
-
-def auto_map_header_mercadorias_saldos(df, layout, keywords):
-    auto_map = {}
-    for campo, *_ in layout:
-        melhor_col, melhor_score = None, 0
-        for col in df.columns:
-            col_norm = normalizar_nome(col)
-            for key in keywords.get(campo, [campo]):
-                key_norm = normalizar_nome(key)
-                score = similaridade(col_norm, key_norm)
-                if score > melhor_score and score >= 0.82:
-                    melhor_col, melhor_score = col, score
-        if melhor_col:
-            auto_map[campo] = melhor_col
-    return auto_map
-
-def auto_map_by_data_mercadorias_saldos(df, layout, mapping_history):
-    auto_map = {}
-    for campo, *_ in layout:
-        if campo in mapping_history and mapping_history[campo].get("amostras_validas"):
-            campo_amostras = set(mapping_history[campo]["amostras_validas"])
-            melhor_col, melhor_score = None, 0
-            for col in df.columns:
-                serie = df[col].dropna().astype(str)
-                serie_validas = set([v for v in serie if validar_campo_mercadorias_saldos(campo, v)])
-                if not serie_validas:
-                    continue
-                intersecao = campo_amostras.intersection(serie_validas)
-                score = len(intersecao) / max(len(serie_validas), 1)
-                if score > melhor_score and score >= 0.5:
-                    melhor_col, melhor_score = col, score
-            if melhor_col:
-                auto_map[campo] = melhor_col
-    return auto_map
-
-def aprender_metadados_coluna_mercadorias_saldos(serie, campo_layout, old_samples=None):
-    if campo_layout in CAMPOS_IGNORAR_HISTORY_IA:
-        return old_samples or []
-    valid_samples = set(s for s in (old_samples or []) if s != "")
-    for val in pd.Series(serie.dropna().astype(str).unique()):
-        if validar_campo_mercadorias_saldos(campo_layout, val) and val != "":
-            valid_samples.add(val)
-    return list(valid_samples)
-
-def analisar_dados_mercadorias_saldos(df, layout, mapeamento):
-    def is_vazio(v):
-        if v is None:
-            return True
-        if isinstance(v, float):
-            try:
-                if math.isnan(v):
-                    return True
-            except Exception:
-                pass
-        if isinstance(v, str):
-            if v.strip() == "" or v.strip().lower() == "nan":
-                return True
-        try:
-            if pd.isna(v):
-                return True
-        except Exception:
-            pass
-        return False
-
-    def is_numero_valido(valor):
-        valor = str(valor).strip().replace(" ", "")
-        regex = r'^[+-]?(\d+([.,]\d*)?|[.,]\d+)$'
-        return bool(re.match(regex, valor))
-
-    inconsistencias = {}
-    stats = []
-    total_linhas = len(df)
-    linha_valida = [True] * total_linhas
-
-    codigos_em_branco = []
-    exemplos_codigo_em_branco = []
-    codigos_duplicados = set()
-    codigos_ultrapassa_tamanho = set()
-    codigos_com_espaco = set()
-    exemplos_codigo_duplicados = []
-    exemplos_codigo_ultrapassa = []
-    exemplos_codigo_espaco = []
-
-    codigos_vistos = set()
-    codigo_col = mapeamento.get('codigo')
-    if codigo_col and codigo_col in df.columns:
-        maxlen_codigo = [x[3] for x in layout if x[0] == 'codigo'][0]
-        for idx, v in enumerate(df[codigo_col]):
-            if is_vazio(v):
-                codigos_em_branco.append("")
-                if len(exemplos_codigo_em_branco) < 8:
-                    exemplos_codigo_em_branco.append("")
-                linha_valida[idx] = False
-            else:
-                valor = str(v).strip()
-                if valor in codigos_vistos:
-                    codigos_duplicados.add(valor)
-                    if len(exemplos_codigo_duplicados) < 8:
-                        exemplos_codigo_duplicados.append(valor)
-                    linha_valida[idx] = False
-                else:
-                    codigos_vistos.add(valor)
-                if ' ' in valor:
-                    codigos_com_espaco.add(valor)
-                    if len(exemplos_codigo_espaco) < 8:
-                        exemplos_codigo_espaco.append(valor)
-                if len(valor) > maxlen_codigo:
-                    codigos_ultrapassa_tamanho.add(valor)
-                    if len(exemplos_codigo_ultrapassa) < 8:
-                        exemplos_codigo_ultrapassa.append(valor)
-                    linha_valida[idx] = False
-
-    # Mensagens padronizadas
-    if codigos_em_branco:
-        inconsistencias['codigo_em_branco'] = {
-            "label": "Código",
-            "tipo": "em_branco",
-            "mensagem": f"Em branco: {len(codigos_em_branco)} registro(s)",
-            "amostra": []
-        }
-    if codigos_duplicados:
-        inconsistencias['codigo_duplicado'] = {
-            "label": "Código",
-            "tipo": "duplicado",
-            "mensagem": f"Duplicados: {len(codigos_duplicados)} registro(s)",
-            "amostra": exemplos_codigo_duplicados
-        }
-    if codigos_ultrapassa_tamanho:
-        inconsistencias['codigo_ultrapassa'] = {
-            "label": "Código",
-            "tipo": "ultrapassa_tamanho",
-            "mensagem": f"Excede o limite de caracteres: {len(codigos_ultrapassa_tamanho)} registro(s)",
-            "amostra": exemplos_codigo_ultrapassa
-        }
-    if codigos_com_espaco:
-        inconsistencias['codigo_com_espaco'] = {
-            "label": "Código",
-            "tipo": "com_espaco",
-            "mensagem": f"Possui espaço(s) indevido(s): {len(codigos_com_espaco)} registro(s)",
-            "amostra": exemplos_codigo_espaco
-        }
-
-    texto_ultrapassa = {}
-    negativos = {}
-    nao_numericos = {}
-    zerados = {}
-
-    for campo, label, tipo, tamanho, obrigatorio in layout:
-        col = mapeamento.get(campo)
-        if obrigatorio and (not col or col not in df.columns):
-            inconsistencias[campo] = {
-                "label": label,
-                "tipo": "invalido",
-                "mensagem": "Campo obrigatório não mapeado ou não encontrado.",
-                "amostra": []
-            }
-            stats.append({'campo': label, 'validos': 0, 'invalidos': total_linhas})
-            linha_valida = [False] * total_linhas
-            continue
-        if not col or col not in df.columns:
-            stats.append({'campo': label, 'validos': 0, 'invalidos': 0})
-            continue
-
-        serie = df[col].astype(str)
-        validos, invalidos = 0, 0
-        em_branco_qtd = 0
-        exemplos_em_branco = []
-        exemplos_outros_invalidos = []
-        exemplos_zerados = []
-        exemplos_nao_numericos = []
-        is_numeric = tipo.lower() == 'numérico' or campo in [
-            'custo_medio', 'custo_medio_contabil', 'custo_ultima_compra',
-            'base_media_icms_st', 'valor_medio_icms_st', 'saldo', 'custo_contabil_ultima_compra'
-        ]
-
-        for idx, v in enumerate(serie):
-            vazio = is_vazio(v)
-            if tipo.lower() == 'texto':
-                maxlen = [x[3] for x in layout if x[0] == campo][0]
-                if maxlen and isinstance(v, str) and v.strip() != "" and len(str(v)) > int(maxlen):
-                    texto_ultrapassa.setdefault(campo, set()).add(v)
-            if is_numeric:
-                if vazio:
-                    em_branco_qtd += 1
-                    if len(exemplos_em_branco) < 8:
-                        exemplos_em_branco.append(v)
-                    continue
-                if not is_numero_valido(v):
-                    invalidos += 1
-                    nao_numericos.setdefault(campo, []).append(v)
-                    exemplos_nao_numericos.append(v)
-                    if obrigatorio:
-                        linha_valida[idx] = False
-                    continue
-                try:
-                    num = float(str(v).replace(',', '.'))
-                    if num == 0:
-                        zerados.setdefault(campo, []).append(v)
-                        if len(exemplos_zerados) < 8:
-                            exemplos_zerados.append(v)
-                        validos += 1
-                        continue
-                    if campo not in ['custo_contabil_ultima_compra']:
-                        if num < 0:
-                            negativos.setdefault(campo, []).append(v)
-                    validos += 1
-                except Exception:
-                    invalidos += 1
-                    nao_numericos.setdefault(campo, []).append(v)
-                    exemplos_nao_numericos.append(v)
-                    if obrigatorio:
-                        linha_valida[idx] = False
-                continue
-
-            valido = True
-            if tipo.lower() == 'texto':
-                maxlen = [x[3] for x in layout if x[0] == campo][0]
-                if maxlen and len(str(v)) > int(maxlen):
-                    valido = False
-
-            if not valido:
-                invalidos += 1
-                if vazio:
-                    em_branco_qtd += 1
-                    if len(exemplos_em_branco) < 8:
-                        exemplos_em_branco.append(v)
-                else:
-                    if len(exemplos_outros_invalidos) < 8 and not is_vazio(v):
-                        exemplos_outros_invalidos.append(v)
-                if obrigatorio:
-                    linha_valida[idx] = False
-            else:
-                validos += 1
-
-        stats.append({'campo': label, 'validos': validos, 'invalidos': invalidos})
-
-        # Mensagens padronizadas para inconsistências
-        if is_numeric and campo in nao_numericos and nao_numericos[campo]:
-            inconsistencias[f'{campo}_nao_numerico'] = {
-                "label": label,
-                "tipo": "invalido",
-                "mensagem": f"Valor não numérico: {len(nao_numericos[campo])} registro(s)",
-                "amostra": nao_numericos[campo][:8]
-            }
-
-        if is_numeric and campo in negativos and negativos[campo]:
-            exemplos_negativos_ordenados = sorted(
-                set([v for v in negativos[campo] if not is_vazio(v)]),
-                key=lambda x: float(str(x).replace(',', '.')) if str(x).replace(',', '.').replace('.', '', 1).isdigit() else str(x)
-            )
-            inconsistencias[f'{campo}_negativo'] = {
-                "label": label,
-                "tipo": "negativo",
-                "mensagem": f"Valor negativo: {len(negativos[campo])} registro(s)",
-                "amostra": exemplos_negativos_ordenados[:8]
-            }
-
-        if campo in texto_ultrapassa and texto_ultrapassa[campo]:
-            label_ = [x[1] for x in layout if x[0] == campo][0]
-            inconsistencias[f'{campo}_ultrapassa'] = {
-                "label": label_,
-                "tipo": "ultrapassa_tamanho",
-                "mensagem": f"Excede o limite de caracteres: {len(texto_ultrapassa[campo])} registro(s)",
-                "amostra": sorted(
-                    [v for v in texto_ultrapassa[campo] if not is_vazio(v)],
-                    key=lambda x: (str(x).lower(), str(x))
-                )[:8]
-            }
-
-        if em_branco_qtd > 0:
-            inconsistencias[f'{campo}_em_branco'] = {
-                "label": label,
-                "tipo": "em_branco",
-                "mensagem": f"Em branco: {em_branco_qtd} registro(s)",
-                "amostra": []
-            }
-
-        if is_numeric and campo in zerados and zerados[campo]:
-            exemplos_zerados_visiveis = [
-                v for v in zerados[campo][:8]
-                if str(v).replace('.', '').replace(',', '').strip('0') != ''
-            ]
-            inconsistencias[f'{campo}_zerado'] = {
-                "label": label,
-                "tipo": "zerado",
-                "mensagem": f"Valor zerado: {len(zerados[campo])} registro(s)",
-                "amostra": exemplos_zerados_visiveis
-            }
-
-    inconsistencias_ordenadas = dict(sorted(inconsistencias.items(), key=lambda x: x[1]['label'].lower()))
-    total_validos_geral = sum(linha_valida)
-    total_invalidos_geral = total_linhas - total_validos_geral
-
-    return inconsistencias_ordenadas, stats, total_linhas, total_validos_geral, total_invalidos_geral
-
-
-# ---------------- PESSOAS ---------------- #
-
-def remover_acentos(txt):
-    return ''.join(
-        c for c in unicodedata.normalize('NFD', str(txt))
-        if unicodedata.category(c) != 'Mn'
-    )
-
-def normalizar(txt):
-    return remover_acentos(str(txt)).strip().lower()
-
-def normalizar_tipo_pessoa(valor):
-    s = remover_acentos(str(valor)).strip().upper()
-    if s in ["1", "PF", "F", "FISICA"]:
-        return "1"
-    if s in ["2", "PJ", "J", "JURIDICA"]:
-        return "2"
-    return s
-
-def validar_opcoes(valor, opcoes):
-    s = normalizar(valor)
-    todas_opcoes = set()
-    for nomes in opcoes.values():
-        for n in nomes:
-            todas_opcoes.add(normalizar(n))
-    return s in todas_opcoes
-
-def validar_campo_pessoas(campo, valor):
-    if isinstance(valor, str):
-        valor_limpo = valor.strip()
-    else:
-        valor_limpo = valor
-    layout_info = next((item for item in LAYOUT_PESSOAS if item[0] == campo), None)
-    if layout_info is None:
-        return True
-    tipo = layout_info[2].lower()
-    tamanho = layout_info[3]
-    obrigatorio = layout_info[4]
-
-    # Obrigatoriedade
-    if obrigatorio and (pd.isna(valor_limpo) or str(valor_limpo).strip() == ''):
-        return False
-    if not obrigatorio and (pd.isna(valor_limpo) or str(valor_limpo).strip() == ''):
-        return True
-
-    # Validações específicas
-
-    if campo == "cpf_cnpj":
-        s = str(valor_limpo).replace('.', '').replace('-', '').replace('/', '')
-        return len(s) == 11 or len(s) == 14
-
-    # Os campos abaixo já serão convertidos para número no DataFrame. Aqui só aceita número.
-    if campo in ["tipo_pessoa", "tipo_contribuinte", "sexo", "estado_civil", "tipo_endereco", "tipo_telefone", "produtor_rural"]:
-        return str(valor_limpo).strip() in [str(i) for i in range(1, 8)] + ['0', '9']
-
-    # Tipo Numérico padrão
-    if tipo == 'numérico':
-        try:
-            float(str(valor_limpo).replace(',', '.'))
-            return True
-        except:
-            return False
-
-    # Booleano padrão
-    if tipo == 'booleano':
-        return normalizar(valor_limpo) in ['1', '0', 'true', 'false', 'sim', 'nao', 'não', 'yes', 'no']
-
-    # Data padrão
-    if tipo == 'data':
-        try:
-            if not valor_limpo or valor_limpo == '':
-                return True
-            for fmt in ('%d/%m/%Y', '%Y-%m-%d', '%d-%m-%Y'):
-                try:
-                    datetime.datetime.strptime(str(valor_limpo).strip(), fmt)
-                    return True
-                except:
-                    continue
-            return False
-        except:
-            return False
-
-    # Texto padrão
-    if tipo == 'texto':
-        if tamanho and isinstance(tamanho, int) and len(str(valor_limpo)) > int(tamanho):
-            return False
-        return True
-    return True
-
-def analisar_dados_pessoas(df, layout, mapeamento):
-    inconsistencias = {}
-    stats = []
-    total_linhas = len(df)
-    linha_valida = [True] * total_linhas
-
-    def is_vazio(v):
-        if v is None: return True
-        if isinstance(v, float):
-            try:
-                if math.isnan(v): return True
-            except Exception: pass
-        if isinstance(v, str):
-            if v.strip() == "" or v.strip().lower() == "nan": return True
-        try:
-            if pd.isna(v): return True
-        except Exception: pass
-        return False
-
-    # --- MAPS PARA TODOS OS CAMPOS DE OPÇÃO ---
-    estado_civil_map = {
-        'casado': '1', 'casado(a)': '1', '1': '1',
-        'solteiro': '2', 'solteiro(a)': '2', '2': '2',
-        'separado': '3', 'separado(a)': '3', '3': '3',
-        'viuvo': '4', 'viúvo': '4', 'viuvo(a)': '4', 'viúvo(a)': '4', '4': '4',
-        'desquitado': '5', 'desquitado(a)': '5', '5': '5',
-        'divorciado': '6', 'divorciado(a)': '6', '6': '6',
-        'outros': '7', 'outro': '7', 'outra': '7', '7': '7'
-    }
-    sexo_map = {
-        'f': '1', 'feminino': '1', '1': '1',
-        'm': '2', 'masculino': '2', '2': '2'
-    }
-    tipo_contribuinte_map = {
-        'icms': '1', 'contribuinte': '1', '1': '1',
-        'isento': '2', 'não contribuinte': '2', 'nao contribuinte': '2', '2': '2',
-        '9': '9'
-    }
-    tipo_telefone_map = {
-        'celular': '1', 'cel': '1', 'celular comercial': '1', '1': '1',
-        'fixo': '2', 'residencial': '2', 'telefone fixo': '2', 'comercial': '2', '2': '2',
-        'fax comercial': '3', '3': '3',
-        'fax residencial': '4', '4': '4',
-        'nextel': '5', '5': '5'
-    }
-    tipo_endereco_map = {
-        'residencial': '1', '1': '1',
-        'comercial': '2', '2': '2',
-        'cobranca': '3', 'cobrança': '3', '3': '3',
-        'secundario': '4', 'secundário': '4', '4': '4',
-        'entrega': '5', '5': '5',
-        'coleta': '6', '6': '6'
-    }
-    tipo_pessoa_map = {
-        'pf': '1', 'f': '1', 'fisica': '1', 'física': '1', '1': '1',
-        'pj': '2', 'j': '2', 'juridica': '2', 'jurídica': '2', '2': '2'
-    }
-    produtor_rural_map = {
-        '1': '1', 'true': '1', 'sim': '1', 'yes': '1',
-        '0': '0', 'false': '0', 'nao': '0', 'não': '0', 'no': '0'
-    }
-
-    # --- NORMALIZAÇÃO DOS CAMPOS DE OPÇÃO NO DATAFRAME (RESPEITA o mapeamento ATUAL) ---
-    # Sempre sobrescreve as colunas do mapeamento atual, seja automático ou manual
-    for campo, label, tipo, tamanho, obrigatorio in layout:
-        col = mapeamento.get(campo)
-        if not col or col not in df.columns:
-            continue
-        if campo == "tipo_telefone":
-            df[col] = df[col].astype(str).apply(normalizar).replace(tipo_telefone_map)
-        elif campo == "tipo_endereco":
-            df[col] = df[col].astype(str).apply(normalizar).replace(tipo_endereco_map)
-        elif campo == "tipo_pessoa":
-            df[col] = df[col].astype(str).apply(normalizar).replace(tipo_pessoa_map)
-        elif campo == "estado_civil":
-            df[col] = df[col].astype(str).apply(normalizar).replace(estado_civil_map)
-        elif campo == "sexo":
-            df[col] = df[col].astype(str).apply(normalizar).replace(sexo_map)
-        elif campo == "tipo_contribuinte":
-            df[col] = df[col].astype(str).apply(normalizar).replace(tipo_contribuinte_map)
-        elif campo == "produtor_rural":
-            df[col] = df[col].astype(str).apply(normalizar).replace(produtor_rural_map)
-
-    # --- VALIDAÇÃO PADRÃO ---
-    for campo, label, tipo, tamanho, obrigatorio in layout:
-        col = mapeamento.get(campo)
-        if obrigatorio and (not col or col not in df.columns):
-            inconsistencias[campo] = {
-                "label": label,
-                "tipo": "invalido",
-                "mensagem": "Campo obrigatório não mapeado ou não encontrado.",
-                "amostra": []
-            }
-            stats.append({'campo': label, 'validos': 0, 'invalidos': total_linhas})
-            linha_valida = [False] * total_linhas
-            continue
-        if not col or col not in df.columns:
-            stats.append({'campo': label, 'validos': 0, 'invalidos': 0})
-            continue
-
-        serie = df[col].astype(str)
-        validos, invalidos = 0, 0
-        em_branco_count = 0
-        duplicados = set()
-        fora_padrao = set()
-        tamanho_maior = set()
-        tamanho_menor = set()
-        valor_invalido = set()
-        # Para amostra, pode-se guardar até 5 valores de cada tipo se quiser
-
-        # CPF/CNPJ
-        if campo == "cpf_cnpj":
-            valores_vistos = set()
-            duplicados_cpf = set()
-            caracteres_invalidos = set()
-            em_branco_count = 0
-            for idx, v in enumerate(serie):
-                s_original = str(v).strip()
-                if is_vazio(s_original):
-                    invalidos += 1
-                    em_branco_count += 1
-                    linha_valida[idx] = False
-                    continue
-                if not re.fullmatch(r"[0-9.\-\/]+", s_original):
-                    invalidos += 1
-                    caracteres_invalidos.add(v)
-                    linha_valida[idx] = False
-                    continue
-                s = s_original.replace('.', '').replace('-', '').replace('/', '')
-                if not (len(s) == 11 or len(s) == 14):
-                    invalidos += 1
-                    fora_padrao.add(v)
-                    linha_valida[idx] = False
-                    continue
-                if s in valores_vistos:
-                    invalidos += 1
-                    duplicados_cpf.add(v)
-                    linha_valida[idx] = False
-                    continue
-                valores_vistos.add(s)
-                validos += 1
-            if em_branco_count:
-                inconsistencias[f"{campo}_em_branco"] = {
-                    "label": label,
-                    "tipo": "em_branco",
-                    "mensagem": f"Em branco: {em_branco_count} registro(s)",
-                    "amostra": []
-                }
-            if caracteres_invalidos:
-                inconsistencias[f"{campo}_caracteres_invalidos"] = {
-                    "label": label,
-                    "tipo": "caracteres_invalidos",
-                    "mensagem": f"Caracteres inválidos: {len(caracteres_invalidos)} registro(s)",
-                    "amostra": sorted(caracteres_invalidos)
-                }
-            if duplicados_cpf:
-                inconsistencias[f"{campo}_duplicado"] = {
-                    "label": label,
-                    "tipo": "duplicado",
-                    "mensagem": f"Duplicados: {len(duplicados_cpf)} registro(s)",
-                    "amostra": sorted(duplicados_cpf)
-                }
-            if fora_padrao:
-                inconsistencias[campo] = {
-                    "label": label,
-                    "tipo": "invalido",
-                    "mensagem": f"Fora do padrão (deve ter 11 ou 14 dígitos): {len(fora_padrao)} registro(s)",
-                    "amostra": sorted(fora_padrao)
-                }
-            stats.append({'campo': label, 'validos': validos, 'invalidos': invalidos})
-            continue
-
-        # E-mail
-        if campo == "email":
-            em_branco_count = 0
-            for idx, v in enumerate(serie):
-                s = str(v).strip()
-                if is_vazio(s):
-                    if obrigatorio:
-                        invalidos += 1
-                        em_branco_count += 1
-                        linha_valida[idx] = False
-                    continue
-                if re.search(r"\s", s) or re.search(r"[çãõáéíóúâêîôûàèìòùäëïöü]", s, re.IGNORECASE):
-                    invalidos += 1
-                    valor_invalido.add(v)
-                    linha_valida[idx] = False
-                    continue
-                if not re.match(r"^[A-Za-z0-9._%+-]+@[A-Za-z0-9.-]+\.[A-Za-z]{2,}$", s):
-                    invalidos += 1
-                    fora_padrao.add(v)
-                    linha_valida[idx] = False
-                    continue
-                validos += 1
-            if em_branco_count:
-                inconsistencias[f"{campo}_em_branco"] = {
-                    "label": label,
-                    "tipo": "em_branco",
-                    "mensagem": f"Em branco: {em_branco_count} registro(s)",
-                    "amostra": []
-                }
-            if valor_invalido:
-                inconsistencias[f"{campo}_caractere_invalido"] = {
-                    "label": label,
-                    "tipo": "caractere_invalido",
-                    "mensagem": "Contém espaço ou caractere especial inválido",
-                    "amostra": sorted(valor_invalido)
-                }
-            if fora_padrao:
-                inconsistencias[campo] = {
-                    "label": label,
-                    "tipo": "invalido",
-                    "mensagem": "Fora do padrão de e-mail",
-                    "amostra": sorted(fora_padrao)
-                }
-            stats.append({'campo': label, 'validos': validos, 'invalidos': invalidos})
-            continue
-
-        #CEP
-        if campo == "cep":
-            em_branco_count = 0
-            for idx, v in enumerate(serie):
-                s = str(v).strip()
-                if is_vazio(s):
-                    if obrigatorio:
-                        invalidos += 1
-                        em_branco_count += 1
-                        linha_valida[idx] = False
-                    continue
-                s_limpo = s.replace("-", "")
-                if len(s) < 8 or len(s) > 9:
-                    invalidos += 1
-                    fora_padrao.add(v)
-                    linha_valida[idx] = False
-                    continue
-                if not re.match(r"^\d{5}-?\d{3}$", s):
-                    invalidos += 1
-                    valor_invalido.add(v)
-                    linha_valida[idx] = False
-                    continue
-                validos += 1
-            if em_branco_count:
-                inconsistencias[f"{campo}_em_branco"] = {
-                    "label": label,
-                    "tipo": "em_branco",
-                    "mensagem": f"Em branco: {em_branco_count} registro(s)",
-                    "amostra": []
-                }
-            if fora_padrao:
-                inconsistencias[f"{campo}_tamanho_invalido"] = {
-                    "label": label,
-                    "tipo": "tamanho_invalido",
-                    "mensagem": f"Tamanho de caracteres inválido.  Total: {len(fora_padrao)} registro(s).",
-                    "amostra": sorted(fora_padrao)
-                }
-            if valor_invalido:
-                inconsistencias[campo] = {
-                    "label": label,
-                    "tipo": "invalido",
-                    "mensagem": f"Contém caracteres não numéricos ou hífen fora do lugar. Total: {len(valor_invalido)} registro(s).",
-                    "amostra": sorted(valor_invalido)
-                }
-            stats.append({'campo': label, 'validos': validos, 'invalidos': invalidos})
-            continue
-
-        # Texto (logradouro, número endereço, etc)
-        if tipo.lower() == "texto":
-            em_branco_count = 0
-            for idx, v in enumerate(serie):
-                s = str(v)
-                if is_vazio(s):
-                    if obrigatorio:
-                        invalidos += 1
-                        em_branco_count += 1
-                        linha_valida[idx] = False
-                    continue
-                if tamanho and len(s) > int(tamanho):
-                    invalidos += 1
-                    tamanho_maior.add(v)
-                    linha_valida[idx] = False
-                    continue
-                if tamanho and len(s) < 1:
-                    invalidos += 1
-                    tamanho_menor.add(v)
-                    linha_valida[idx] = False
-                    continue
-                validos += 1
-            if em_branco_count:
-                inconsistencias[f"{campo}_em_branco"] = {
-                    "label": label,
-                    "tipo": "em_branco",
-                    "mensagem": f"Em branco: {em_branco_count} registro(s)",
-                    "amostra": []
-                }
-            if tamanho_maior or tamanho_menor:
-                desc = []
-                if tamanho_maior: desc.append("Excede o limite de caracteres")
-                if tamanho_menor: desc.append("Abaixo do limite de caracteres")
-                inconsistencias[campo] = {
-                    "label": label,
-                    "tipo": "invalido",
-                    "mensagem": "; ".join(desc) + f". Total: {len(tamanho_maior | tamanho_menor)} registro(s).",
-                    "amostra": sorted(tamanho_maior | tamanho_menor)
-                }
-            stats.append({'campo': label, 'validos': validos, 'invalidos': invalidos})
-            continue
-
-        # Numérico
-        if tipo.lower() == "numérico":
-            em_branco_count = 0
-            for idx, v in enumerate(serie):
-                s = str(v).replace(',', '.')
-                if is_vazio(s):
-                    if obrigatorio:
-                        invalidos += 1
-                        em_branco_count += 1
-                        linha_valida[idx] = False
-                    continue
-                try:
-                    float(s)
-                    validos += 1
-                except:
-                    invalidos += 1
-                    valor_invalido.add(v)
-                    linha_valida[idx] = False
-            if em_branco_count:
-                inconsistencias[f"{campo}_em_branco"] = {
-                    "label": label,
-                    "tipo": "em_branco",
-                    "mensagem": f"Em branco: {em_branco_count} registro(s)",
-                    "amostra": []
-                }
-            if valor_invalido:
-                inconsistencias[campo] = {
-                    "label": label,
-                    "tipo": "invalido",
-                    "mensagem": f"Valor não numérico. Total: {len(valor_invalido)} registro(s).",
-                    "amostra": sorted(valor_invalido)
-                }
-            stats.append({'campo': label, 'validos': validos, 'invalidos': invalidos})
-            continue
-
-        # Booleano
-        if tipo.lower() == "booleano":
-            em_branco_count = 0
-            for idx, v in enumerate(serie):
-                if is_vazio(v):
-                    if obrigatorio:
-                        invalidos += 1
-                        em_branco_count += 1
-                        linha_valida[idx] = False
-                    continue
-                if not normalizar(v) in ['1', '0', 'true', 'false', 'sim', 'nao', 'não', 'yes', 'no']:
-                    invalidos += 1
-                    valor_invalido.add(v)
-                    linha_valida[idx] = False
-                    continue
-                validos += 1
-            if em_branco_count:
-                inconsistencias[f"{campo}_em_branco"] = {
-                    "label": label,
-                    "tipo": "em_branco",
-                    "mensagem": f"Em branco: {em_branco_count} registro(s)",
-                    "amostra": []
-                }
-            if valor_invalido:
-                inconsistencias[campo] = {
-                    "label": label,
-                    "tipo": "invalido",
-                    "mensagem": f"Valor fora do padrão booleano (1/0/Sim/Não/True/False). Total: {len(valor_invalido)} registro(s).",
-                    "amostra": sorted(valor_invalido)
-                }
-            stats.append({'campo': label, 'validos': validos, 'invalidos': invalidos})
-            continue
-
-        # Data
-        if tipo.lower() == "data":
-            em_branco_count = 0
-            for idx, v in enumerate(serie):
-                s = str(v).strip()
-                if is_vazio(s):
-                    if obrigatorio:
-                        invalidos += 1
-                        em_branco_count += 1
-                        linha_valida[idx] = False
-                    continue
-                ok = False
-                for fmt in ('%d/%m/%Y', '%Y-%m-%d', '%d-%m-%Y'):
-                    try:
-                        datetime.datetime.strptime(s, fmt)
-                        ok = True
-                        break
-                    except:
-                        continue
-                if not ok:
-                    invalidos += 1
-                    valor_invalido.add(v)
-                    linha_valida[idx] = False
-                else:
-                    validos += 1
-            if em_branco_count:
-                inconsistencias[f"{campo}_em_branco"] = {
-                    "label": label,
-                    "tipo": "em_branco",
-                    "mensagem": f"Em branco: {em_branco_count} registro(s)",
-                    "amostra": []
-                }
-            if valor_invalido:
-                inconsistencias[campo] = {
-                    "label": label,
-                    "tipo": "invalido",
-                    "mensagem": f"Valor fora do padrão de data esperado (ex: dd/mm/aaaa ou yyyy-mm-dd). Total: {len(valor_invalido)} registro(s).",
-                    "amostra": sorted(valor_invalido)
-                }
-            stats.append({'campo': label, 'validos': validos, 'invalidos': invalidos})
-            continue
-
-    inconsistencias_ordenadas = dict(sorted(inconsistencias.items(), key=lambda x: x[1]['label'].lower()))
-    total_validos_geral = sum(linha_valida)
-    total_invalidos_geral = total_linhas - total_validos_geral
-
-    return inconsistencias_ordenadas, stats, total_linhas, total_validos_geral, total_invalidos_geral
-
-def auto_map_header_pessoas(df, layout, keywords):
-    auto_map = {}
-    for campo, *_ in layout:
-        melhor_col, melhor_score = None, 0
-        for col in df.columns:
-            col_norm = normalizar_nome(col)
-            for key in keywords.get(campo, [campo]):
-                key_norm = normalizar_nome(key)
-                score = similaridade(col_norm, key_norm)
-                if score > melhor_score and score >= 0.82:
-                    melhor_col, melhor_score = col, score
-        if melhor_col:
-            auto_map[campo] = melhor_col
-    return auto_map
-
-def auto_map_by_data_pessoas(df, layout, mapping_history):
-    auto_map = {}
-    for campo, *_ in layout:
-        if campo in mapping_history and mapping_history[campo].get("amostras_validas"):
-            campo_amostras = set(mapping_history[campo]["amostras_validas"])
-            melhor_col, melhor_score = None, 0
-            for col in df.columns:
-                serie = df[col].dropna().astype(str)
-                serie_validas = set([v for v in serie if validar_campo_pessoas(campo, v)])
-                if not serie_validas:
-                    continue
-                intersecao = campo_amostras.intersection(serie_validas)
-                score = len(intersecao) / max(len(serie_validas), 1)
-                if score > melhor_score and score >= 0.5:
-                    melhor_col, melhor_score = col, score
-            if melhor_col:
-                auto_map[campo] = melhor_col
-    return auto_map
-
-def aprender_metadados_coluna_pessoas(serie, campo_layout, old_samples=None):
-    valid_samples = set(s for s in (old_samples or []) if s != "")
-    for val in pd.Series(serie.dropna().astype(str).unique()):
-        if validar_campo_pessoas(campo_layout, val) and val != "":
-            valid_samples.add(val)
-    return list(valid_samples)
-
-
-# --------------- VEÍCULO DO CLIENTE --------------- #
-
-def validar_campo_veiculos_cliente(campo, valor):
-    if isinstance(valor, str):
-        valor_limpo = valor.strip()
-    else:
-        valor_limpo = valor
-
-    layout_info = next((item for item in LAYOUT_VEICULO_CLIENTE if item[0] == campo), None)
-    if layout_info and layout_info[4] and (pd.isna(valor_limpo) or str(valor_limpo).strip() == ''):
-        return False
-    if layout_info and not layout_info[4] and (pd.isna(valor_limpo) or str(valor_limpo).strip() == ''):
-        return True
-    max_len = layout_info[3] if layout_info and isinstance(layout_info[3], int) else float('inf')
-
-    if campo == 'cpf_cnpj':
-        s = str(valor_limpo).strip()
-        return s.isdigit() and len(s) == 11 or len(s) == 14
-
-    if campo == 'placa':
-        # Placa padrão Brasil: 3 letras + 4 números ou Mercosul: 3 letras + 1 número + 1 letra + 2 números
-        s = str(valor_limpo).strip().upper().replace("-", "")
-        return len(s) == 7 or len(s) == 8
-
-    if campo == 'modelo':
-        return isinstance(valor_limpo, str) and 1 <= len(str(valor_limpo)) <= max_len
-
-    if campo == 'cor':
-        return isinstance(valor_limpo, str) and 1 <= len(str(valor_limpo)) <= max_len
-
-    if campo in ['ano_fabricacao', 'ano_modelo']:
-        s = str(valor_limpo).strip()
-        return s.isdigit() and len(s) == 4 and 1900 <= int(s) <= 2100
-
-    if campo == 'chassi':
-        # Chassi geralmente 17, mas layout permite até 20
-        s = str(valor_limpo).strip().upper()
-        return 1 <= len(s) <= max_len
+def gravar_dataframe_sessao(df):
+    """Grava o DataFrame na pasta da sessão e devolve o nome do arquivo para guardar na sessão."""
+    nome = f".dados_{secrets.token_hex(8)}{'.arrow' if pa is not None else '.pkl'}"
+    caminho = os.path.join(pasta_upload_sessao(), nome)
+    try:
+        if pa is not None:
+            tabela = pa.Table.from_arrays([pa.array(df.iloc[:, i]) for i in range(df.shape[1])],
+                                          names=[str(c) for c in df.columns])
+            with pa.OSFile(caminho, 'wb') as destino, pa.ipc.new_file(destino, tabela.schema) as escritor:
+                escritor.write_table(tabela)
+        else:
+            df.to_pickle(caminho)
+        ARMAZENAMENTO_UPLOADS.reservar(os.path.getsize(caminho))
+    except BaseException:
+        with contextlib.suppress(OSError):
+            os.remove(caminho)
+        raise
+    return nome
+
+def carregar_dataframe_sessao(nome):
+    """DataFrame gravado por gravar_dataframe_sessao; None se o arquivo já foi coletado."""
+    caminho = os.path.join(pasta_upload_sessao(), os.path.basename(nome))
+    if not os.path.exists(caminho):
+        return None
+    if not caminho.endswith('.arrow'):
+        return pd.read_pickle(caminho)
+    tabela = pa.ipc.open_file(pa.memory_map(caminho)).read_all()
+    df = tabela.to_pandas(types_mapper=lambda t: pd.StringDtype('pyarrow') if pa.types.is_string(t) else None)
+    df.columns = tabela.column_names
+    return df
 
-    if campo in ['motor', 'renavam', 'crlv', 'bateria', 'valor_bem', 'revendedora', 'codigo_revendedora', 'ultima_concessionaria_exec',
-                 'numero_produtor_rural', 'id_estrangeiro', 'inscricao_estadual']:
-        return isinstance(valor_limpo, str) and len(str(valor_limpo).strip()) <= max_len
+def descartar_dataframes_sessao():
+    for nome in session.pop('dataframes', {}).values():
+        with contextlib.suppress(OSError):
+            os.remove(os.path.join(pasta_upload_sessao(), os.path.basename(nome)))
+
+def relatorio_memoria(df, tamanho_arquivo):
+    """Resume o consumo de memória do DataFrame em relação ao tamanho do arquivo enviado."""
+    bytes_dataframe = int(df.memory_usage(index=True, deep=True).sum())
+    return {
+        'bytes_arquivo': tamanho_arquivo,
+        'bytes_dataframe': bytes_dataframe,
+        'proporcao': round(bytes_dataframe / tamanho_arquivo, 2) if tamanho_arquivo else None,
+        'colunas_categoricas': sum(1 for d in df.dtypes if isinstance(d, pd.CategoricalDtype)),
+        'total_colunas': df.shape[1],
+    }
 
-    if campo in ['rg']:
-        return isinstance(valor_limpo, str) and len(str(valor_limpo).strip()) <= max_len
+# ---------- PERFIL DAS COLUNAS ---------- #
+# Resumo de cada coluna do arquivo para a tela de mapeamento: vazios, distintos, valores mais
+# frequentes e faixa de tamanhos. A coluna é lida uma vez, em lotes, e cada lote é reduzido aos
+# seus valores distintos com a contagem; os distintos alimentam esboços de memória fixa
+# (HyperLogLog para a cardinalidade, Count-Min para as frequências), então o custo não cresce
+# com o número de linhas repetidas e a memória não cresce com o de valores distintos.
+
+HLL_PRECISAO = 12                 # 4096 registradores, erro padrão ~1,6%
+CONTAGEM_LARGURA = 4096           # colunas do Count-Min
+CONTAGEM_PROFUNDIDADE = 4         # linhas (hashes independentes) do Count-Min
+PERFIL_COLUNA_TOP = 5
+PERFIL_COLUNA_LOTE = 256 * 1024   # linhas por lote
+FAIXAS_TAMANHO = [1, 2, 5, 10, 20, 50, 100, 255]  # limites inferiores das faixas do histograma (0 = vazio)
+
+class EsbocoColuna:
+    """Esboços de uma coluna alimentados por lotes de (valores distintos, contagens)."""
+
+    def __init__(self):
+        self.linhas = 0
+        self.vazios = 0
+        self.registradores = np.zeros(1 << HLL_PRECISAO, dtype=np.uint8)
+        self.contagem = np.zeros((CONTAGEM_PROFUNDIDADE, CONTAGEM_LARGURA), dtype=np.int64)
+        self.candidatos = {}  # valor -> hash, para reestimar pelo Count-Min ao fim de cada lote
+        self.tamanhos = np.zeros(len(FAIXAS_TAMANHO) + 1, dtype=np.int64)
+        self.tamanho_min = None
+        self.tamanho_max = 0
+
+    def _posicoes(self, hashes):
+        # Hashes duplos (h1 + i*h2) dão as CONTAGEM_PROFUNDIDADE posições a partir de um hash de 64 bits
+        h1, h2 = hashes & 0xFFFFFFFF, hashes >> np.uint64(32)
+        return [((h1 + np.uint64(i) * h2) % np.uint64(CONTAGEM_LARGURA)).astype(np.intp)
+                for i in range(CONTAGEM_PROFUNDIDADE)]
+
+    def estimar(self, hashes):
+        """Frequência estimada pelo Count-Min: nunca abaixo da real e, com alta probabilidade, até e·N/largura acima."""
+        return np.min([self.contagem[i][p] for i, p in enumerate(self._posicoes(hashes))], axis=0)
+
+    def adicionar(self, valores, contagens):
+        """Um lote já reduzido: `valores` distintos (nulos contam como vazios) e quantas vezes cada um aparece."""
+        contagens = np.asarray(contagens, dtype=np.int64)
+        self.linhas += int(contagens.sum())
+        textos = pd.Series(valores, dtype=TIPO_TEXTO).reset_index(drop=True).fillna('')
+        tamanhos = textos.str.len().to_numpy(dtype=np.int64)
+        vazio = (textos.str.strip() == '').to_numpy(dtype=bool)
+        self.vazios += int(contagens[vazio].sum())
+        faixas = np.where(vazio, 0, np.searchsorted(FAIXAS_TAMANHO, tamanhos, side='right'))
+        self.tamanhos += np.bincount(faixas, weights=contagens, minlength=len(self.tamanhos)).astype(np.int64)
+        if (~vazio).any():
+            preenchidos = tamanhos[~vazio]
+            self.tamanho_min = int(min(preenchidos.min(), self.tamanho_min if self.tamanho_min is not None else preenchidos.min()))
+            self.tamanho_max = int(max(preenchidos.max(), self.tamanho_max))
+        valores = textos[~vazio].to_numpy(dtype=object)
+        contagens = contagens[~vazio]
+        if not len(valores):
+            return
+
+        hashes = pd.util.hash_array(valores, categorize=False)
+        # HyperLogLog: os primeiros bits escolhem o registrador, que guarda a maior posição do primeiro bit 1 do resto
+        bits_resto = 64 - HLL_PRECISAO
+        indices = (hashes >> np.uint64(bits_resto)).astype(np.intp)
+        resto = hashes & np.uint64((1 << bits_resto) - 1)
+        posicao = (bits_resto + 1 - np.frexp(resto.astype(np.float64))[1]).astype(np.uint8)
+        np.maximum.at(self.registradores, indices, posicao)
+
+        for i, p in enumerate(self._posicoes(hashes)):
+            np.add.at(self.contagem[i], p, contagens)
+
+        # Candidatos a mais frequentes: os maiores do lote disputam com os já guardados pela estimativa atual
+        maiores = np.argsort(-contagens, kind='stable')[:PERFIL_COLUNA_TOP * 4]
+        for i in maiores:
+            self.candidatos.setdefault(valores[i], hashes[i])
+        if len(self.candidatos) > PERFIL_COLUNA_TOP * 4:
+            nomes = list(self.candidatos)
+            estimativas = self.estimar(np.array([self.candidatos[n] for n in nomes], dtype=np.uint64))
+            manter = np.argsort(-estimativas, kind='stable')[:PERFIL_COLUNA_TOP * 4]
+            self.candidatos = {nomes[i]: self.candidatos[nomes[i]] for i in manter}
+
+    def distintos(self):
+        """Cardinalidade estimada dos valores não vazios (HyperLogLog com correção para poucos valores)."""
+        m = len(self.registradores)
+        estimativa = 0.7213 / (1 + 1.079 / m) * m * m / np.sum(np.ldexp(1.0, -self.registradores.astype(np.int64)))
+        zerados = int((self.registradores == 0).sum())
+        if estimativa <= 2.5 * m and zerados:
+            estimativa = m * math.log(m / zerados)
+        return min(int(round(estimativa)), self.linhas - self.vazios)
+
+    def resumo(self):
+        preenchidos = self.linhas - self.vazios
+        # Abaixo da margem de erro do Count-Min a estimativa pode ser só colisão (ex.: coluna de códigos únicos)
+        minimo_relevante = max(2, math.e * preenchidos / CONTAGEM_LARGURA)
+        top = []
+        if self.candidatos:
+            nomes = list(self.candidatos)
+            estimativas = self.estimar(np.array([self.candidatos[n] for n in nomes], dtype=np.uint64))
+            for i in np.argsort(-estimativas, kind='stable')[:PERFIL_COLUNA_TOP]:
+                frequencia = int(min(estimativas[i], preenchidos))
+                if frequencia < minimo_relevante:
+                    break
+                top.append({'valor': str(nomes[i]), 'frequencia': frequencia,
+                            'pct': round(100 * frequencia / preenchidos, 1) if preenchidos else 0})
+        limites = [0] + FAIXAS_TAMANHO
+        faixas = ['vazio'] + [f'{a}-{b - 1}' if b - 1 > a else f'{a}' for a, b in zip(limites[1:], limites[2:])] + [f'{limites[-1]}+']
+        return {
+            'linhas': self.linhas,
+            'vazios': self.vazios,
+            'pct_vazios': round(100 * self.vazios / self.linhas, 1) if self.linhas else 0,
+            'distintos': self.distintos(),
+            'top': top,
+            'tamanho_min': self.tamanho_min,
+            'tamanho_max': self.tamanho_max,
+            'tamanhos': [{'faixa': f, 'quantidade': int(q)} for f, q in zip(faixas, self.tamanhos) if q],
+        }
 
-    if campo in ['uf_rg', 'uf_inscricao_estadual']:
-        s = str(valor_limpo).strip()
-        return s.isdigit() and len(s) == 2
+def perfilar_coluna(serie, lote=PERFIL_COLUNA_LOTE):
+    """Passa a coluna pelos esboços em lotes de `lote` linhas."""
+    esboco = EsbocoColuna()
+    for inicio in range(0, len(serie), lote):
+        contagem = serie.iloc[inicio:inicio + lote].value_counts(dropna=False, sort=False)
+        contagem = contagem[contagem > 0]  # categóricas listam também as categorias ausentes do lote
+        esboco.adicionar(contagem.index.astype(TIPO_TEXTO), contagem.to_numpy())
+    return esboco.resumo()
+
+def perfilar_colunas(df, progresso=None):
+    """Perfil de todas as colunas do DataFrame, na ordem das colunas."""
+    perfis = {}
+    for i, coluna in enumerate(df.columns):
+        perfis[coluna] = perfilar_coluna(df.iloc[:, i])
+        if progresso:
+            progresso.avancar()
+    return perfis
+
+
+# ---------- MOTOR DE REGRAS ---------- #
+# O plano de cada layout é compilado uma vez a partir de LAYOUTS[tipo]['regras']. A análise
+# classifica cada valor distinto de uma coluna uma única vez e replica o resultado para as
+# linhas com numpy, então colunas repetitivas (unidades, tipos, UFs...) custam quase nada.
+
+ESTADO_OK = 0
+ESTADO_VAZIO = 1  # as falhas ocupam os estados seguintes, na ordem em que aparecem nas regras
 
-    if campo in ['data_venda', 'data_inicial_garantia', 'data_final_garantia']:
-        s = str(valor_limpo).strip()
-        # Espera formato dd/mm/yyyy ou yyyy-mm-dd
-        if not s:
-            return True
-        for fmt in ('%d/%m/%Y', '%Y-%m-%d', '%d-%m-%Y'):
-            try:
-                datetime.datetime.strptime(s, fmt)
+def is_vazio(v):
+    if v is None:
+        return True
+    if isinstance(v, float):
+        try:
+            if math.isnan(v):
                 return True
-            except Exception:
-                continue
-        return False
+        except Exception:
+            pass
 
-    if campo == 'data_hora_ultima_alteracao':
-        s = str(valor_limpo).strip()
-        # Espera formato yyyy-mm-dd HH:MM:SS ou similar
-        if not s:
+    if isinstance(v, str):
+        if v.strip() == "" or v.strip().lower() == "nan":
             return True
-        # Aceita ISO ou dd/mm/yyyy HH:MM:SS
-        for fmt in ('%Y-%m-%d %H:%M:%S', '%d/%m/%Y %H:%M:%S'):
-            try:
-                datetime.datetime.strptime(s, fmt)
-                return True
-            except Exception:
-                continue
-        return False
+    try:
+        if pd.isna(v):
+            return True
+    except Exception:
+        pass
+    return False
 
-    return True
+def remover_acentos(txt):
+    return ''.join(
+        c for c in unicodedata.normalize('NFD', str(txt))
+        if unicodedata.category(c) != 'Mn'
+    )
 
-def analisar_dados_veiculos_cliente(df, layout, mapeamento):
-    inconsistencias = {}
-    stats = []
-    total_linhas = len(df)
-    linha_valida = [True] * total_linhas
+def normalizar(txt):
+    return remover_acentos(str(txt)).strip().lower()
 
-    def is_vazio(v):
-        if v is None:
-            return True
-        if isinstance(v, float):
-            try:
-                if math.isnan(v):
-                    return True
-            except Exception:
-                pass
-        if isinstance(v, str):
-            if v.strip() == "" or v.strip().lower() == "nan":
-                return True
+# Decimal com vírgula ou ponto; milhar só em grupos de três dígitos com o outro separador (ou repetido).
+# Um único separador seguido de três dígitos ('1.234') continua sendo decimal.
+PADRAO_NUMERO_SIMPLES = r'[+-]?(?:[0-9]+(?:[.,][0-9]*)?|[.,][0-9]+)'
+PADRAO_MILHAR_PONTO = r'[+-]?[0-9]{1,3}(?:\.[0-9]{3})+(?:,[0-9]*)?'
+PADRAO_MILHAR_VIRGULA = r'[+-]?[0-9]{1,3}(?:,[0-9]{3})+(?:\.[0-9]*)?'
+_RE_NUMERO_SIMPLES = re.compile(PADRAO_NUMERO_SIMPLES)
+_RE_MILHAR_PONTO = re.compile(PADRAO_MILHAR_PONTO)
+_RE_MILHAR_VIRGULA = re.compile(PADRAO_MILHAR_VIRGULA)
+
+def converter_numero(valor):
+    """'1.234,56', '1,234.56', '1234,56' e '1234.56' -> 1234.56; None se não for número."""
+    s = str(valor)
+    if _RE_NUMERO_SIMPLES.fullmatch(s):
+        return float(s.replace(',', '.'))
+    if _RE_MILHAR_PONTO.fullmatch(s):
+        return float(s.replace('.', '').replace(',', '.'))
+    if _RE_MILHAR_VIRGULA.fullmatch(s):
+        return float(s.replace(',', ''))
+    return None
+
+def converter_numeros(valores):
+    """Versão vetorizada de converter_numero: devolve (float64 com NaN nos inválidos, máscara de inválidos)."""
+    serie = pd.Series(valores, dtype=TIPO_TEXTO)
+    simples = serie.str.fullmatch(PADRAO_NUMERO_SIMPLES).to_numpy(dtype=bool, na_value=False)
+    milhar_ponto = ~simples & serie.str.fullmatch(PADRAO_MILHAR_PONTO).to_numpy(dtype=bool, na_value=False)
+    milhar_virgula = ~simples & ~milhar_ponto & serie.str.fullmatch(PADRAO_MILHAR_VIRGULA).to_numpy(dtype=bool, na_value=False)
+    validos = simples | milhar_ponto | milhar_virgula
+    numeros = np.full(len(serie), np.nan)
+    if validos.any():
+        texto = serie.mask(milhar_ponto, serie.str.replace('.', '', regex=False))
+        texto = texto.mask(milhar_virgula, texto.str.replace(',', '', regex=False))
+        numeros[validos] = texto[validos].str.replace(',', '.', regex=False).astype('float64').to_numpy()
+    return numeros, ~validos
+
+def perfil_numerico(numeros, tipo):
+    """Mínimo, máximo, soma, média, negativos, zerados e percentis dos valores numéricos (NaN é ignorado)."""
+    numeros = numeros[~np.isnan(numeros)]
+    if not len(numeros):
+        return None
+    percentis = np.percentile(numeros, [5, 25, 50, 75, 95])
+    return {
+        'tipo': tipo,
+        'quantidade': int(len(numeros)),
+        'minimo': float(numeros.min()),
+        'maximo': float(numeros.max()),
+        'soma': float(numeros.sum()),
+        'media': float(numeros.mean()),
+        'negativos': int((numeros < 0).sum()),
+        'zerados': int((numeros == 0).sum()),
+        'percentis': {f'p{p}': float(v) for p, v in zip((5, 25, 50, 75, 95), percentis)},
+    }
+
+def data_valida(valor, formatos):
+    for fmt in formatos:
         try:
-            if pd.isna(v):
-                return True
-        except Exception:
-            pass
-        return False
+            datetime.datetime.strptime(valor, fmt)
+            return True
+        except ValueError:
+            continue
+    return False
 
-    # Exemplo de verificação: duplicidade de chassi, placa, cpf_cnpj
-    chassi_col = mapeamento.get('chassi')
-    chassi_vistos = set()
-    chassi_duplicados = set()
-    exemplos_chassi_duplicados = []
+def compilar_verificacao(regra, tamanho_layout):
+    """Transforma uma verificação declarativa numa função texto -> bool."""
+    if 'tamanho' in regra:
+        minimo, maximo = (tamanho_layout if limite == 'layout' else limite for limite in regra['tamanho'])
+        teste = lambda s: (minimo is None or len(s) >= minimo) and (maximo is None or len(s) <= maximo)
+    elif 'tamanhos' in regra:
+        tamanhos = frozenset(regra['tamanhos'])
+        teste = lambda s: len(s) in tamanhos
+    elif 'regex' in regra:
+        padrao = re.compile(regra['regex'])
+        teste = lambda s: padrao.search(s) is not None
+    elif 'sem_regex' in regra:
+        padrao = re.compile(regra['sem_regex'])
+        teste = lambda s: padrao.search(s) is None
+    elif 'palavras_proibidas' in regra:
+        proibidas = frozenset(regra['palavras_proibidas'])
+        teste = lambda s: proibidas.isdisjoint(s.lower().split())
+    elif 'numero' in regra:
+        minimo, maximo = regra['numero'].get('min'), regra['numero'].get('max')
+        diferente = regra['numero'].get('diferente')
+
+        def teste(s):
+            num = converter_numero(s)
+            return (num is not None
+                    and (minimo is None or num >= minimo)
+                    and (maximo is None or num <= maximo)
+                    and (diferente is None or num != diferente))
+
+        def vetorial(textos):
+            numeros, invalidos = converter_numeros(textos)
+            ok = ~invalidos
+            if minimo is not None:
+                ok &= numeros >= minimo
+            if maximo is not None:
+                ok &= numeros <= maximo
+            if diferente is not None:
+                ok &= numeros != diferente
+            return ok
+    elif 'opcoes' in regra:
+        opcoes = frozenset(normalizar(o) for o in regra['opcoes'])
+        teste = lambda s: normalizar(s) in opcoes
+    elif 'datas' in regra:
+        formatos = tuple(regra['datas'])
+        teste = lambda s: data_valida(s, formatos)
+    else:
+        raise ValueError(f"Regra de layout desconhecida: {regra}")
+
+    if regra.get('limpar'):
+        tabela = str.maketrans('', '', regra['limpar'])
+        teste_limpo = lambda s, teste=teste: teste(s.translate(tabela))
+        if 'numero' in regra:
+            teste_limpo.vetorial = lambda textos: vetorial(remover_caracteres(textos, regra['limpar']))
+        return teste_limpo
+    if 'numero' in regra:
+        teste.vetorial = vetorial
+    return teste
+
+def remover_caracteres(textos, caracteres):
+    """str.translate de remoção aplicado a uma Series de texto inteira."""
+    for c in caracteres:
+        textos = textos.str.replace(c, '', regex=False)
+    return textos
+
+def aplicar_verificacao(teste, textos, alvo):
+    """Resultado da verificação para os textos (Series) marcados em `alvo`; os demais ficam True."""
+    resultado = np.ones(len(textos), dtype=bool)
+    if alvo.any():
+        selecionados = textos[alvo]
+        if hasattr(teste, 'vetorial'):
+            resultado[alvo] = teste.vetorial(selecionados)
+        else:
+            resultado[alvo] = [teste(s) for s in selecionados]
+    return resultado
+
+# Amostra de cada inconsistência: no máximo `limite` valores distintos, com quantas vezes cada um
+# ocorre. Os escolhidos são os mais frequentes (empate pela primeira ocorrência no arquivo) e o modo
+# só define a ordem de exibição; 'primeiras' escolhe pela ordem das linhas. O tamanho da resposta
+# não depende de quantos registros falharam.
+AMOSTRA_LIMITE = 8
+
+def coletar_amostra(ocorrencias, codigos, mascara, distintos, modo, limite):
+    """(valores, contagens) da amostra; `ocorrencias` é a contagem de cada valor distinto entre as linhas da máscara."""
+    if modo == 'nenhuma':
+        return [], []
+    if modo == 'primeiras':
+        escolhidos = pd.unique(codigos[mascara])[:limite]
+    else:
+        presentes = np.flatnonzero(ocorrencias)
+        if len(presentes) > limite:
+            corte = np.partition(ocorrencias[presentes], -limite)[-limite]
+            presentes = presentes[ocorrencias[presentes] >= corte]
+        # Códigos do factorize seguem a ordem de primeira ocorrência: desempate determinístico
+        escolhidos = presentes[np.lexsort((presentes, -ocorrencias[presentes]))][:limite]
+    valores = [str(v) for v in distintos.take(escolhidos)]
+    contagens = [int(c) for c in ocorrencias[escolhidos]]
+    if modo in ('ordenada', 'numerica'):
+        chave = ((lambda i: converter_numero(valores[i].replace(' ', '')) or 0) if modo == 'numerica'
+                 else (lambda i: (valores[i].lower(), valores[i])))
+        ordem = sorted(range(len(valores)), key=chave)
+        valores, contagens = [valores[i] for i in ordem], [contagens[i] for i in ordem]
+    return valores, contagens
+
+class PlanoCampo:
+    """Verificações compiladas de um campo do layout."""
+
+    def __init__(self, campo, label, tipo, tamanho, obrigatorio, spec, regras_layout):
+        self.campo, self.label, self.obrigatorio = campo, label, obrigatorio
+        tamanho = tamanho if isinstance(tamanho, int) else None
+        self.mapa = spec.get('mapa')
+        self.vazio = spec.get('vazio') or ('invalido' if obrigatorio else regras_layout.get('vazio_opcional', 'valido'))
+        self.invalida_linha = obrigatorio or regras_layout.get('invalida_linha') == 'sempre'
+        self.mensagens = {**MENSAGENS_PADRAO, **regras_layout.get('mensagens', {}), **spec.get('mensagens', {})}
+        self.perfil = spec.get('perfil')
+        # O perfil numérico usa a mesma limpeza da primeira verificação numérica do campo
+        numericas = [r for r in spec.get('regras', []) + spec.get('avisos', []) if 'numero' in r]
+        self.limpar_numero = numericas[0].get('limpar', '') if numericas else ''
+
+        # Cada falha vira um estado; regras com a mesma falha compartilham o estado
+        self.falhas = []
+        self.regras = []
+        regras = list(spec.get('regras', []))
+        if self.mapa is not None:
+            # Depois da tradução só os códigos do mapa são aceitos
+            regras.append({'opcoes': sorted(set(self.mapa.values())), 'falha': 'fora_das_opcoes'})
+        for regra in regras:
+            falha = regra.get('falha', 'invalido')
+            if falha not in self.falhas:
+                self.falhas.append(falha)
+            estado = ESTADO_VAZIO + 1 + self.falhas.index(falha)
+            self.regras.append((compilar_verificacao(regra, tamanho), regra.get('bruto', False), estado))
+
+        avisos = list(spec.get('avisos', []))
+        if regras_layout.get('ultrapassa_texto') and tipo.lower() == 'texto' and tamanho:
+            avisos.append({'tamanho': [None, tamanho], 'bruto': True, 'aviso': 'ultrapassa', 'somente_validos': False})
+        self.avisos = [
+            (compilar_verificacao(a, tamanho), a.get('bruto', False), a.get('somente_validos', True), a['aviso'])
+            for a in avisos
+        ]
 
-    placa_col = mapeamento.get('placa')
-    placa_vistos = set()
-    placa_duplicados = set()
-    exemplos_placa_duplicados = []
+        self.unico = spec.get('unico')
+        if self.unico:
+            tabela = str.maketrans('', '', self.unico.get('limpar', ''))
+            maiusculas = self.unico.get('maiusculas', False)
+            self.chave_unico = lambda v: (str(v).strip().translate(tabela).upper() if maiusculas
+                                          else str(v).strip().translate(tabela))
+            if 'falha' in self.unico:
+                self.falhas.append(self.unico['falha'])
+                self.estado_duplicado = ESTADO_VAZIO + len(self.falhas)
+
+    def classificar(self, valor):
+        """Estado do valor (ok, vazio ou falha) e máscara de bits dos avisos."""
+        if is_vazio(valor):
+            return ESTADO_VAZIO, 0
+        bruto = str(valor)
+        if self.mapa is not None:
+            bruto = normalizar(bruto)
+            bruto = self.mapa.get(bruto, bruto)
+        limpo = bruto.strip()
+        estado = ESTADO_OK
+        for teste, usa_bruto, estado_falha in self.regras:
+            if not teste(bruto if usa_bruto else limpo):
+                estado = estado_falha
+                break
+        avisos = 0
+        for bit, (teste, usa_bruto, somente_validos, _) in enumerate(self.avisos):
+            if (estado == ESTADO_OK or not somente_validos) and not teste(bruto if usa_bruto else limpo):
+                avisos |= 1 << bit
+        return estado, avisos
+
+    def classificar_distintos(self, distintos):
+        """classificar() de todos os valores distintos de uma vez, com as verificações numéricas vetorizadas."""
+        estados = np.full(len(distintos), ESTADO_OK, dtype=np.int64)
+        avisos = np.zeros(len(distintos), dtype=np.int64)
+        textos = pd.Series(distintos, dtype=TIPO_TEXTO).reset_index(drop=True)
+        vazio = (textos.isna() | textos.str.strip().str.lower().isin(['', 'nan'])).to_numpy(dtype=bool)
+        estados[vazio] = ESTADO_VAZIO
+        preenchidos = np.flatnonzero(~vazio)
+        brutos = textos[~vazio].reset_index(drop=True)
+        if self.mapa is not None:
+            brutos = pd.Series([self.mapa.get(b, b) for b in map(normalizar, brutos)], dtype=TIPO_TEXTO)
+        limpos = brutos.str.strip()
+
+        pendentes = np.ones(len(preenchidos), dtype=bool)
+        for teste, usa_bruto, estado_falha in self.regras:
+            falhou = ~aplicar_verificacao(teste, brutos if usa_bruto else limpos, pendentes)
+            estados[preenchidos[falhou]] = estado_falha
+            pendentes &= ~falhou
+        todos = np.ones(len(preenchidos), dtype=bool)
+        for bit, (teste, usa_bruto, somente_validos, _) in enumerate(self.avisos):
+            falhou = ~aplicar_verificacao(teste, brutos if usa_bruto else limpos, pendentes if somente_validos else todos)
+            avisos[preenchidos[falhou]] |= 1 << bit
+        return estados, avisos
+
+    def perfil_numerico(self, distintos, codigos):
+        textos = pd.Series(distintos, dtype=TIPO_TEXTO).reset_index(drop=True).str.strip()
+        numeros, _ = converter_numeros(remover_caracteres(textos, self.limpar_numero))
+        return perfil_numerico(numeros[codigos], self.perfil)
+
+    def validar(self, valor):
+        estado, _ = self.classificar(valor)
+        if estado == ESTADO_VAZIO:
+            return not self.obrigatorio
+        return estado == ESTADO_OK
+
+    def validar_distintos(self, distintos):
+        """validar() de vários valores de uma vez: máscara booleana dos válidos."""
+        estados, _ = self.classificar_distintos(distintos)
+        return (estados == ESTADO_OK) | ((estados == ESTADO_VAZIO) & (not self.obrigatorio))
+
+    def avaliar(self, serie):
+        """Avalia a coluna inteira: contagens, inconsistências, máscara de linhas inválidas e perfil numérico."""
+        codigos, distintos = pd.factorize(serie, use_na_sentinel=False)
+        estados, avisos = self.classificar_distintos(distintos)
+        estados, avisos = estados[codigos], avisos[codigos]
+
+        duplicados = None
+        if self.unico:
+            chaves = pd.factorize(pd.Index([self.chave_unico(v) for v in distintos], dtype=object))[0][codigos]
+            candidatas = np.flatnonzero(estados == ESTADO_OK if 'falha' in self.unico else estados != ESTADO_VAZIO)
+            duplicados = np.zeros(len(codigos), dtype=bool)
+            duplicados[candidatas] = pd.Series(chaves[candidatas]).duplicated().to_numpy()
+            if 'falha' in self.unico:
+                estados[duplicados] = self.estado_duplicado
+                duplicados = None
+
+        contagem = np.bincount(estados, minlength=ESTADO_VAZIO + 1 + len(self.falhas))
+        vazios = int(contagem[ESTADO_VAZIO])
+        validos = int(contagem[ESTADO_OK]) + (vazios if self.vazio == 'valido' else 0)
+        invalidos = int(contagem[ESTADO_VAZIO + 1:].sum()) + (vazios if self.vazio == 'invalido' else 0)
+
+        inconsistencias = {}
+        for i, falha in enumerate(self.falhas):
+            self.relatar(inconsistencias, falha, estados == ESTADO_VAZIO + 1 + i, codigos, distintos)
+        if self.vazio in ('invalido', 'aviso'):
+            self.relatar(inconsistencias, 'em_branco', estados == ESTADO_VAZIO, codigos, distintos)
+        for bit, (*_, aviso) in enumerate(self.avisos):
+            self.relatar(inconsistencias, aviso, (avisos >> bit) & 1 == 1, codigos, distintos)
+        if duplicados is not None:
+            self.relatar(inconsistencias, self.unico['aviso'], duplicados, codigos, distintos)
+
+        linhas_invalidas = np.zeros(len(codigos), dtype=bool)
+        if self.invalida_linha:
+            linhas_invalidas |= estados > ESTADO_VAZIO
+            if self.vazio == 'invalido':
+                linhas_invalidas |= estados == ESTADO_VAZIO
+        if duplicados is not None:
+            linhas_invalidas |= duplicados
+        perfil = self.perfil_numerico(distintos, codigos) if self.perfil else None
+        return validos, invalidos, inconsistencias, linhas_invalidas, perfil
+
+    def relatar(self, inconsistencias, nome, mascara, codigos, distintos):
+        spec = self.mensagens.get(nome)
+        if spec is None or not mascara.any():
+            return
+        ocorrencias = np.bincount(codigos[mascara], minlength=len(distintos))
+        if spec.get('contagem') == 'distintos':
+            n = int(np.count_nonzero(ocorrencias))
+        elif spec.get('contagem') == 'distintos_limpos':
+            # Valores que só diferem por espaços nas pontas (ou caixa, na chave do 'unico') contam uma vez
+            maiusculas = (self.unico and self.unico.get('maiusculas')
+                          and nome in (self.unico.get('falha'), self.unico.get('aviso')))
+            n = len({str(v).strip().upper() if maiusculas else str(v).strip()
+                     for v in distintos.take(np.flatnonzero(ocorrencias))})
+        else:
+            n = int(mascara.sum())
+        amostra, contagens = coletar_amostra(ocorrencias, codigos, mascara, distintos,
+                                             spec.get('amostra', 'ordenada'), spec.get('limite', AMOSTRA_LIMITE))
+        inconsistencias[spec['chave'].format(campo=self.campo)] = {
+            "label": self.label,
+            "tipo": spec['tipo'],
+            "mensagem": spec['mensagem'].format(n=n),
+            "amostra": amostra,
+            "ocorrencias": contagens,
+        }
 
-    if chassi_col and chassi_col in df.columns:
-        for idx, v in enumerate(df[chassi_col]):
-            if is_vazio(v):
-                continue
-            valor = str(v).strip().upper()
-            if valor in chassi_vistos:
-                chassi_duplicados.add(valor)
-                if len(exemplos_chassi_duplicados) < 8:
-                    exemplos_chassi_duplicados.append(valor)
-                linha_valida[idx] = False
-            else:
-                chassi_vistos.add(valor)
+class PlanoLayout:
+    """Plano compilado de um layout: campos na ordem do layout, acessíveis por nome."""
+
+    def __init__(self, config):
+        regras_layout = config.get('regras', {})
+        regras_por_tipo = regras_layout.get('regras_por_tipo', {})
+        self.totalizadores = regras_layout.get('totalizadores', {})
+        self.campos = {}
+        for campo, label, tipo, tamanho, obrigatorio in config['layout']:
+            spec = {**regras_por_tipo.get(tipo.lower(), {}), **regras_layout.get('campos', {}).get(campo, {})}
+            self.campos[campo] = PlanoCampo(campo, label, tipo, tamanho, obrigatorio, spec, regras_layout)
+
+    def validar(self, campo, valor):
+        plano = self.campos.get(campo)
+        return plano.validar(valor) if plano else True
+
+def compilar_layout(config):
+    return PlanoLayout(config)
+
+PLANOS = {tipo: compilar_layout(config) for tipo, config in LAYOUTS.items()}
+
+# Casos conferidos por `flask conferir-regras`: (layout, campo, valor, válido).
+EXEMPLOS_REGRAS = [
+    ('pessoas', 'sexo', '1234', False),
+    ('pessoas', 'sexo', 'Feminino', True),
+    ('pessoas', 'tipo_pessoa', '-3', False),
+    ('pessoas', 'tipo_pessoa', 'PJ', True),
+    ('pessoas', 'estado_civil', '12345678909', False),
+    ('pessoas', 'estado_civil', 'Viúvo', True),
+    ('pessoas', 'tipo_contribuinte', '9', True),
+    ('pessoas', 'tipo_telefone', '6', False),
+    ('pessoas', 'tipo_endereco', 'coleta', True),
+    ('pessoas', 'produtor_rural', 'sim', True),
+    ('pessoas', 'produtor_rural', '2', False),
+]
 
-    if placa_col and placa_col in df.columns:
-        for idx, v in enumerate(df[placa_col]):
-            if is_vazio(v):
-                continue
-            valor = str(v).strip().upper()
-            if valor in placa_vistos:
-                placa_duplicados.add(valor)
-                if len(exemplos_placa_duplicados) < 8:
-                    exemplos_placa_duplicados.append(valor)
-                linha_valida[idx] = False
+def conferir_regras():
+    """Mensagens dos EXEMPLOS_REGRAS cujo resultado (por valor ou vetorizado) difere do esperado."""
+    falhas = []
+    for tipo, campo, valor, esperado in EXEMPLOS_REGRAS:
+        plano = PLANOS[tipo].campos[campo]
+        obtidos = {plano.validar(valor), bool(plano.validar_distintos([valor])[0])}
+        if obtidos != {esperado}:
+            falhas.append(f"{tipo}.{campo}: {valor!r} deveria ser {'válido' if esperado else 'inválido'}")
+    return falhas
+
+# ---------- ANÁLISE PARALELA ---------- #
+# Em arquivos grandes cada campo mapeado vira uma tarefa num pool de processos. As colunas são
+# gravadas uma única vez num arquivo Arrow em memória compartilhada (/dev/shm), que cada processo
+# abre por memory map sem copiar os dados; só os resultados voltam serializados.
+
+ANALISE_PROCESSOS = int(os.environ.get('ANALISE_PROCESSOS', os.cpu_count() or 1))
+# Abaixo deste total de células (linhas x campos mapeados) o custo do pool não compensa
+ANALISE_MIN_CELULAS_PARALELO = int(os.environ.get('ANALISE_MIN_CELULAS_PARALELO', 1000000))
+
+_pool_analise = None
+_pool_analise_lock = threading.Lock()
+
+def pool_analise():
+    global _pool_analise
+    with _pool_analise_lock:
+        if _pool_analise is None:
+            # O servidor já tem threads quando o pool nasce: fork copiaria locks presos por elas.
+            # O forkserver parte de um processo limpo que importa o app uma vez e faz fork de cada
+            # worker a partir dele; spawn fica para sistemas sem forkserver.
+            if 'forkserver' in multiprocessing.get_all_start_methods():
+                contexto = multiprocessing.get_context('forkserver')
+                if __name__ != '__main__':
+                    contexto.set_forkserver_preload([__name__])
             else:
-                placa_vistos.add(valor)
-
-    if chassi_duplicados:
-        inconsistencias['chassi_duplicado'] = {
-            "label": "Chassi",
-            "tipo": "duplicado",
-            "mensagem": f"Duplicados: {len(chassi_duplicados)} registro(s)",
-            "amostra": exemplos_chassi_duplicados
-        }
-    if placa_duplicados:
-        inconsistencias['placa_duplicado'] = {
-            "label": "Placa",
-            "tipo": "duplicado",
-            "mensagem": f"Duplicados: {len(placa_duplicados)} registro(s)",
-            "amostra": exemplos_placa_duplicados
-        }
+                contexto = multiprocessing.get_context('spawn')
+            _pool_analise = ProcessPoolExecutor(max_workers=ANALISE_PROCESSOS, mp_context=contexto)
+        return _pool_analise
+
+def descartar_pool_analise(pool):
+    """Troca o pool quebrado; se outra requisição já o trocou, o novo é mantido."""
+    global _pool_analise
+    with _pool_analise_lock:
+        if _pool_analise is pool:
+            _pool_analise = None
+    pool.shutdown(wait=False)
+
+def diretorio_compartilhado():
+    return '/dev/shm' if os.access('/dev/shm', os.W_OK) else tempfile.gettempdir()
+
+def avaliar_campo_arrow(caminho, tipo, campo, coluna):
+    """Tarefa do pool: avalia um campo lendo a coluna do arquivo Arrow compartilhado."""
+    fonte = pa.memory_map(caminho)
+    dados = pa.ipc.open_file(fonte).read_all().column(coluna)
+    if pa.types.is_dictionary(dados.type):
+        serie = dados.to_pandas()
+    else:
+        serie = pd.Series(pd.arrays.ArrowStringArray(dados.cast(pa.large_string())))
+    validos, invalidos, inconsistencias, linhas_invalidas, perfil = PLANOS[tipo].campos[campo].avaliar(serie)
+    return validos, invalidos, inconsistencias, np.packbits(linhas_invalidas), perfil
+
+def avaliar_campos(tipo, df, campos, progresso=None):
+    """Resultado de PlanoCampo.avaliar para cada (campo, coluna), em paralelo quando compensa."""
+    plano = PLANOS[tipo]
+    colunas = list(dict.fromkeys(col for _, col in campos))
+
+    def concluido(campo, resultado):
+        if progresso:
+            validos, invalidos, inconsistencias = resultado[:3]
+            progresso.campo_avaliado(plano.campos[campo].label, validos, invalidos, len(inconsistencias))
+        return resultado
+
+    def em_serie():
+        return {campo: concluido(campo, plano.campos[campo].avaliar(df[col])) for campo, col in campos}
+
+    if pa is None or ANALISE_PROCESSOS < 2 or len(campos) < 2 or len(df) * len(campos) < ANALISE_MIN_CELULAS_PARALELO:
+        return em_serie()
+
+    def recomecar_em_serie(motivo):
+        print(f"{motivo}, analisando em série.")
+        if progresso:
+            progresso.etapa('analise', total=len(campos), unidade='campos')
+        return em_serie()
+
+    caminho = None
+    try:
+        try:
+            tabela = pa.table({str(i): pa.array(df[col]) for i, col in enumerate(colunas)})
+            with tempfile.NamedTemporaryFile(dir=diretorio_compartilhado(), prefix='analise_', suffix='.arrow', delete=False) as f:
+                caminho = f.name
+            with pa.OSFile(caminho, 'wb') as destino, pa.ipc.new_file(destino, tabela.schema) as escritor:
+                escritor.write_table(tabela)
+            del tabela
+        except (OSError, pa.ArrowException) as e:
+            return recomecar_em_serie(f"Erro ao gravar as colunas para a análise paralela: {e}")
+
+        pool = pool_analise()
+        futuros = {}
+        try:
+            for campo, col in campos:
+                futuros[pool.submit(avaliar_campo_arrow, caminho, tipo, campo, colunas.index(col))] = campo
+            resultados = {}
+            for futuro in as_completed(futuros):
+                validos, invalidos, inconsistencias, bits, perfil = futuro.result()
+                resultado = (validos, invalidos, inconsistencias, np.unpackbits(bits, count=len(df)).astype(bool), perfil)
+                resultados[futuros[futuro]] = concluido(futuros[futuro], resultado)
+        except BrokenProcessPool as e:
+            # Um worker morreu (ex.: falta de memória): só então o pool é trocado
+            descartar_pool_analise(pool)
+            return recomecar_em_serie(f"Processo da análise paralela encerrado inesperadamente ({e})")
+        except BaseException:
+            # Erro da própria avaliação: a análise em série falharia igual, então ele sobe
+            for futuro in futuros:
+                futuro.cancel()
+            raise
+        # Mesma ordem dos campos do layout, como no caminho em série
+        return {campo: resultados[campo] for campo, _ in campos}
+    finally:
+        if caminho and os.path.exists(caminho):
+            os.remove(caminho)
+
+def analisar_dados(tipo, df, mapeamento, progresso=None, mascaras=None):
+    """Analisa os campos mapeados; `mascaras`, se informado, recebe as linhas inválidas de cada campo."""
+    plano = PLANOS[tipo]
+    inconsistencias = {}
+    stats = []
+    total_linhas = len(df)
+    linha_valida = np.ones(total_linhas, dtype=bool)
 
-    texto_ultrapassa = {}
-    texto_nao_texto = {}
+    campos_mapeados = [(campo, mapeamento[campo]) for campo in plano.campos if mapeamento.get(campo) in df.columns]
+    if progresso:
+        progresso.etapa('analise', total=len(campos_mapeados), unidade='campos', linhas=total_linhas)
+    resultados = avaliar_campos(tipo, df, campos_mapeados, progresso)
 
-    for campo, label, tipo, tamanho, obrigatorio in layout:
+    for campo, plano_campo in plano.campos.items():
+        label = plano_campo.label
         col = mapeamento.get(campo)
-        if obrigatorio and (not col or col not in df.columns):
+        if plano_campo.obrigatorio and (not col or col not in df.columns):
             inconsistencias[campo] = {
                 "label": label,
                 "tipo": "invalido",
@@ -1937,94 +3750,28 @@ def analisar_dados_veiculos_cliente(df, layout, mapeamento):
                 "amostra": []
             }
             stats.append({'campo': label, 'validos': 0, 'invalidos': total_linhas})
-            linha_valida = [False] * total_linhas
+            linha_valida[:] = False
             continue
         if not col or col not in df.columns:
             stats.append({'campo': label, 'validos': 0, 'invalidos': 0})
             continue
 
-        serie = df[col].astype(str)
-        validos, invalidos = 0, 0
-        em_branco_qtd = 0
-        exemplos_em_branco = []
-        exemplos_outros_invalidos = []
-
-        for idx, v in enumerate(serie):
-            vazio = is_vazio(v)
-            if tipo.lower() == 'texto':
-                maxlen = [x[3] for x in layout if x[0] == campo][0]
-                if not isinstance(v, str):
-                    texto_nao_texto.setdefault(campo, set()).add(v)
-                if maxlen and isinstance(v, str) and v.strip() != "" and len(str(v)) > int(maxlen):
-                    texto_ultrapassa.setdefault(campo, set()).add(v)
-            valido = validar_campo_veiculos_cliente(campo, v)
-            if not valido:
-                invalidos += 1
-                if vazio:
-                    em_branco_qtd += 1
-                    if len(exemplos_em_branco) < 8:
-                        exemplos_em_branco.append(v)
-                else:
-                    if len(exemplos_outros_invalidos) < 8 and not is_vazio(v):
-                        exemplos_outros_invalidos.append(v)
-                if obrigatorio:
-                    linha_valida[idx] = False
-            else:
-                validos += 1
-
+        validos, invalidos, inconsistencias_campo, linhas_invalidas, perfil = resultados[campo]
         stats.append({'campo': label, 'validos': validos, 'invalidos': invalidos})
-
-        if invalidos - em_branco_qtd > 0:
-            exemplos_distintos_ordenados = sorted(
-                set([v for v in exemplos_outros_invalidos if not is_vazio(v)]),
-                key=lambda x: (str(x).lower(), str(x))
-            )
-            inconsistencias[campo] = {
-                "label": label,
-                "tipo": "invalido",
-                "mensagem": f"Valor inválido: {invalidos - em_branco_qtd} registro(s)",
-                "amostra": exemplos_distintos_ordenados
-            }
-
-        if em_branco_qtd > 0:
-            inconsistencias[f'{campo}_em_branco'] = {
-                "label": label,
-                "tipo": "em_branco",
-                "mensagem": f"Em branco: {em_branco_qtd} registro(s)",
-                "amostra": []
-            }
-
-    for campo, valores in texto_ultrapassa.items():
-        label = [x[1] for x in layout if x[0] == campo][0]
-        inconsistencias[f'{campo}_ultrapassa'] = {
-            "label": label,
-            "tipo": "ultrapassa_tamanho",
-            "mensagem": f"Excede o limite de caracteres: {len(valores)} registro(s)",
-            "amostra": sorted(
-                [v for v in valores if not is_vazio(v)],
-                key=lambda x: (str(x).lower(), str(x))
-            )
-        }
-
-    for campo, valores in texto_nao_texto.items():
-        label = [x[1] for x in layout if x[0] == campo][0]
-        inconsistencias[f'{campo}_nao_texto'] = {
-            "label": label,
-            "tipo": "nao_texto",
-            "mensagem": f"Valor não é texto: {len(valores)} registro(s)",
-            "amostra": sorted(
-                [v for v in valores if not is_vazio(v)],
-                key=lambda x: (str(x).lower(), str(x))
-            )
-        }
+        if perfil:
+            stats[-1]['perfil'] = perfil
+        inconsistencias.update(inconsistencias_campo)
+        linha_valida &= ~linhas_invalidas
+        if mascaras is not None:
+            mascaras[campo] = linhas_invalidas
 
     inconsistencias_ordenadas = dict(sorted(inconsistencias.items(), key=lambda x: x[1]['label'].lower()))
-    total_validos_geral = sum(linha_valida)
+    total_validos_geral = int(linha_valida.sum())
     total_invalidos_geral = total_linhas - total_validos_geral
 
     return inconsistencias_ordenadas, stats, total_linhas, total_validos_geral, total_invalidos_geral
 
-def auto_map_header_veiculos_cliente(df, layout, keywords):
+def auto_map_header(df, layout, keywords):
     auto_map = {}
     for campo, *_ in layout:
         melhor_col, melhor_score = None, 0
@@ -2039,34 +3786,111 @@ def auto_map_header_veiculos_cliente(df, layout, keywords):
             auto_map[campo] = melhor_col
     return auto_map
 
-
-def auto_map_by_data_veiculos_cliente(df, layout, mapping_history):
+def auto_map_by_data(tipo, df, mapping_history):
+    validar = PLANOS[tipo].validar
     auto_map = {}
-    for campo, *_ in layout:
+    perfis_colunas = {}
+    for campo in PLANOS[tipo].campos:
         if campo in mapping_history and mapping_history[campo].get("amostras_validas"):
-            campo_amostras = set(mapping_history[campo]["amostras_validas"])
             melhor_col, melhor_score = None, 0
             for col in df.columns:
-                serie = df[col].dropna().astype(str)
-                serie_validas = set([v for v in serie if validar_campo_veiculos_cliente(campo, v)])
+                serie_validas = set(v for v in df[col].dropna().unique() if validar(campo, v))
                 if not serie_validas:
                     continue
-                intersecao = campo_amostras.intersection(serie_validas)
-                score = len(intersecao) / max(len(serie_validas), 1)
+                score = pontuar_coluna_por_historico(serie_validas, mapping_history[campo])
                 if score > melhor_score and score >= 0.5:
                     melhor_col, melhor_score = col, score
             if melhor_col:
                 auto_map[campo] = melhor_col
+        if campo not in auto_map and mapping_history.get(campo, {}).get("perfil"):
+            melhor_col = melhor_coluna_por_perfil(df, campo, mapping_history[campo]["perfil"], validar, perfis_colunas, set(auto_map.values()))
+            if melhor_col:
+                auto_map[campo] = melhor_col
     return auto_map
 
+def sugerir_mapeamento(tipo, df, assinatura, mapping_history=None):
+    """Mapeamento confirmado para o cabeçalho ou, sem ele, sugestão por nome e depois por dados.
 
-def aprender_metadados_coluna_veiculos_cliente(serie, campo_layout, old_samples=None):
+    Devolve (auto_map, memorizado, mapping_history); o histórico é carregado só quando preciso e
+    pode ser repassado às chamadas seguintes do mesmo upload.
+    """
+    auto_map = buscar_mapeamento_confirmado(tipo, assinatura, df.columns)
+    if auto_map is not None:
+        return auto_map, True, mapping_history
+    layout = LAYOUTS[tipo]["layout"]
+    auto_map = auto_map_header(df, layout, LAYOUTS[tipo]["keywords"])
+    if not all(auto_map.get(c) for c, _, _, _, o in layout if o):
+        if mapping_history is None:
+            mapping_history = load_mapping_history(tipo)
+        for campo, col in auto_map_by_data(tipo, df, mapping_history).items():
+            if campo not in auto_map:
+                auto_map[campo] = col
+    return auto_map, False, mapping_history
+
+def aprender_metadados_coluna(tipo, serie, campo_layout, old_samples=None):
+    if campo_layout in CAMPOS_IGNORAR_HISTORY_IA:
+        return old_samples or []
     valid_samples = set(s for s in (old_samples or []) if s != "")
-    for val in pd.Series(serie.dropna().astype(str).unique()):
-        if validar_campo_veiculos_cliente(campo_layout, val) and val != "":
+    for val in serie.dropna().unique():
+        if PLANOS[tipo].validar(campo_layout, val) and val != "":
             valid_samples.add(val)
     return list(valid_samples)
 
+# ---------- RESULTADOS DA ANÁLISE ---------- #
+# O resultado completo de cada execução (inconsistências com amostras) fica num JSON na pasta de
+# uploads da sessão; a sessão guarda só o identificador da execução e o resumo dos cartões. A página
+# busca as inconsistências pela rota paginada e cada amostra só quando o item é expandido.
+
+RESULTADOS_POR_PAGINA = 50
+RESULTADOS_MAX_POR_PAGINA = 500
+
+def caminho_resultado(execucao):
+    return os.path.join(pasta_upload_sessao(), f'resultado-{execucao}.json')
+
+def itens_inconsistencia(tipo, nome_arquivo, inconsistencias):
+    """Inconsistências de um arquivo na ordem da página: campos obrigatórios e depois os demais, na ordem do layout."""
+    itens, vistos = [], set()
+    for campo, label, _, _, obrigatorio in sorted(LAYOUTS[tipo]['layout'], key=lambda c: not c[4]):
+        for chave, data in inconsistencias.items():
+            if chave in vistos or not (data['label'] == label or chave.startswith(campo + '_')):
+                continue
+            vistos.add(chave)
+            itens.append({
+                'arquivo': nome_arquivo, 'chave': chave, 'campo': campo, 'label': label.replace(' *', ''),
+                'obrigatorio': obrigatorio, 'tipo': data['tipo'], 'mensagem': data['mensagem'],
+                'amostra': data['amostra'], 'ocorrencias': data.get('ocorrencias', []),
+            })
+    return itens
+
+def salvar_resultado(tipo, arquivos):
+    """Grava as inconsistências de todos os arquivos da execução; devolve o identificador dela e o
+    resumo por arquivo (nome e quantidade de inconsistências) que fica na sessão."""
+    execucao = secrets.token_hex(8)
+    itens, resumo = [], []
+    for arquivo in arquivos:
+        itens_arquivo = itens_inconsistencia(tipo, arquivo['nome'], arquivo['inconsistencias'])
+        itens.extend(itens_arquivo)
+        resumo.append({'nome': arquivo['nome'], 'quantidade': len(itens_arquivo)})
+    caminho = caminho_resultado(execucao)
+    temporario = f'{caminho}.{secrets.token_hex(4)}.tmp'
+    with open(temporario, 'w', encoding='utf-8') as f:
+        json.dump({'tipo': tipo, 'itens': itens}, f, ensure_ascii=False, default=valor_json)
+    os.replace(temporario, caminho)
+    return execucao, resumo
+
+def carregar_resultado(tipo):
+    """Resultado da última execução da sessão para o layout; 404 se não houver ou se já expirou."""
+    execucao = session.get('execucao')
+    if tipo not in LAYOUTS or not execucao:
+        abort(404)
+    try:
+        with open(caminho_resultado(execucao), encoding='utf-8') as f:
+            resultado = json.load(f)
+    except FileNotFoundError:
+        abort(404, description='O resultado desta análise expirou; envie os arquivos novamente.')
+    if resultado['tipo'] != tipo:
+        abort(404)
+    return resultado
 
 
 # ------------ R O T A S  ------------ #
@@ -2107,68 +3931,82 @@ def validador_upload(tipo):
     tipo_layout = tipo
     contexto = LAYOUTS[tipo]
     layout = contexto["layout"]
-    keywords = contexto["keywords"]
+    descartar_dataframes_sessao()
     session['dataframes'] = {}
     arquivos_para_mapear = []
-    mapping_history = load_mapping_history(tipo_layout)
+    mapping_history = None
     total_registros = 0
     alerta_quebra = []
+    progresso = progresso_requisicao()
 
     arquivos = request.files.getlist('files')
-    auto_map_header_func = globals()[f'auto_map_header_{tipo}']
-    auto_map_by_data_func = globals()[f'auto_map_by_data_{tipo}']
 
-    for file in arquivos:
+    for numero_arquivo, file in enumerate(arquivos, 1):
         if not file:
             continue
         filename = secure_filename(file.filename)
-        filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-        file.save(filepath)
+        filepath = os.path.join(pasta_upload_sessao(), filename)
         ext = os.path.splitext(filename)[1].lower()
-        df = None
+        if ext not in EXTENSOES_UPLOAD and ext not in EXTENSOES_COMPACTADAS:
+            arquivos_para_mapear.append({'nome': filename, 'erro': 'Formato não suportado.'})
+            continue
         try:
-            if ext in ['.csv', '.txt']:
-                with open(filepath, 'rb') as f_bytes:
-                    raw = f_bytes.read()
-                df, sep, encoding, linhas_ignoradas_indices = detectar_encoding_e_linhas_validas(raw, extensao=ext, filename=filename)
-                if linhas_ignoradas_indices:
-                    alerta_quebra.extend(linhas_ignoradas_indices)
-            elif ext == '.xlsx':
-                with open(filepath, 'rb') as f_bytes:
-                    raw = f_bytes.read()
-                df, sep, encoding, linhas_ignoradas_indices = detectar_encoding_e_linhas_validas(raw, extensao=ext, filename=filename)
-                if linhas_ignoradas_indices:
-                    alerta_quebra.extend(linhas_ignoradas_indices)
-            else:
-                arquivos_para_mapear.append({'nome': filename, 'erro': 'Formato não suportado.'})
-                continue
-
-            num_registros = len(df)
-            total_registros += num_registros
-            auto_map = auto_map_header_func(df, layout, keywords)
-            obrigatorios = [c for c, _, _, _, o in layout if o]
-
-            if not all(auto_map.get(c) for c in obrigatorios):
-                auto_map_data = auto_map_by_data_func(df, layout, mapping_history)
-                for campo, col in auto_map_data.items():
-                    if campo not in auto_map:
-                        auto_map[campo] = col
-
-            pedir_manual = not all(auto_map.get(c) for c in obrigatorios)
-            session['dataframes'][filename] = df.to_json(orient='split')
-            arquivos_para_mapear.append({
-                'nome': filename,
-                'colunas': df.columns.tolist(),
-                'amostra': df.head(20).where(pd.notnull(df.head(20)), '').to_dict('records'),
-                'auto_map': auto_map,
-                'has_header': True,
-                'pedir_manual': pedir_manual,
-                'num_registros': num_registros,
-            })
+            info_upload = gravar_upload(file, filepath)
+            # Cada conteúdo de um compactado vira um arquivo na tela de mapeamento
+            conteudos = membros_compactados(filepath, filename) if ext in EXTENSOES_COMPACTADAS else [(filename, None, ext)]
         except Exception as e:
-            arquivos_para_mapear.append({'nome': filename, 'erro': f'Erro: {str(e)}'})
+            arquivos_para_mapear.append({'nome': filename, 'erro': f'Erro: {e.description if isinstance(e, HTTPException) else e}'})
             if os.path.exists(filepath):
                 os.remove(filepath)
+            continue
+
+        for nome, fonte, ext_conteudo in conteudos:
+            if fonte is None and ext_conteudo not in EXTENSOES_UPLOAD:
+                arquivos_para_mapear.append({'nome': nome, 'erro': 'Formato não suportado.'})
+                continue
+            df = None
+            try:
+                if progresso:
+                    progresso.etapa('leitura', total=0 if fonte else info_upload['tamanho'], unidade='bytes',
+                                    arquivo=nome, arquivo_atual=numero_arquivo, arquivos=len(arquivos))
+                with (contextlib.nullcontext(fonte) if fonte else abrir_mmap(filepath)) as dados:
+                    df, sep, encoding, linhas_ignoradas_indices = detectar_encoding_e_linhas_validas(dados, extensao=ext_conteudo, filename=nome)
+                if progresso:
+                    progresso.avancar(fonte.tamanho if fonte else info_upload['tamanho'])
+                    progresso.etapa('perfil', total=df.shape[1], unidade='colunas', linhas=len(df))
+                perfil_colunas = perfilar_colunas(df, progresso)
+                if progresso:
+                    progresso.etapa('mapeamento', linhas=len(df))
+                if linhas_ignoradas_indices:
+                    alerta_quebra.extend(linhas_ignoradas_indices)
+
+                num_registros = len(df)
+                total_registros += num_registros
+                obrigatorios = [c for c, _, _, _, o in layout if o]
+                assinatura = assinatura_cabecalho(df.columns)
+                auto_map, mapeamento_memorizado, mapping_history = sugerir_mapeamento(tipo_layout, df, assinatura, mapping_history)
+
+                pedir_manual = not all(auto_map.get(c) for c in obrigatorios)
+                session['dataframes'][nome] = gravar_dataframe_sessao(df)
+                arquivos_para_mapear.append({
+                    'nome': nome,
+                    'colunas': df.columns.tolist(),
+                    'amostra': df.head(20).astype(object).where(pd.notnull(df.head(20)), '').to_dict('records'),
+                    'auto_map': auto_map,
+                    'assinatura': assinatura,
+                    'mapeamento_memorizado': mapeamento_memorizado,
+                    'has_header': True,
+                    'pedir_manual': pedir_manual,
+                    'num_registros': num_registros,
+                    'memoria': relatorio_memoria(df, fonte.tamanho if fonte else info_upload['tamanho']),
+                    'hash': info_upload['hash'],
+                    'linhas_arquivo': fonte.linhas if fonte else info_upload['linhas'],
+                    'perfil_colunas': perfil_colunas,
+                })
+            except Exception as e:
+                arquivos_para_mapear.append({'nome': nome, 'erro': f'Erro: {e.description if isinstance(e, HTTPException) else e}'})
+                if fonte is None and os.path.exists(filepath):
+                    os.remove(filepath)
 
     session['mapear'] = arquivos_para_mapear
     session['tipo_layout'] = tipo_layout
@@ -2179,6 +4017,19 @@ def validador_upload(tipo):
         session.pop('alerta_quebra', None)
     return redirect(url_for('validador', tipo=tipo))
 
+@app.errorhandler(RequestEntityTooLarge)
+def upload_muito_grande(e):
+    tipo = (request.view_args or {}).get('tipo')
+    progresso = g.get('progresso')
+    if progresso:
+        progresso.encerrar(erro=e.description)
+    if request.endpoint == 'api_validar':
+        return erro_api(e)
+    if request.endpoint == 'validador_upload' and tipo in LAYOUTS:
+        session['mapear'] = [{'nome': 'Upload recusado', 'erro': e.description}]
+        return redirect(url_for('validador', tipo=tipo))
+    return e
+
 @app.route('/validador/<tipo>/mapear', methods=['POST'])
 def validador_mapear(tipo):
     if tipo not in LAYOUTS:
@@ -2186,45 +4037,43 @@ def validador_mapear(tipo):
 
     tipo_layout = tipo
     layout = LAYOUTS[tipo_layout]["layout"]
-    analyzer = globals()[f'analisar_dados_{tipo}']
-    validator = globals()[f'validar_campo_{tipo}']
+    validator = PLANOS[tipo_layout].validar
     mapear = session.get('mapear', [])
     dataframes = session.get('dataframes', {})
 
-    # Carrega o histórico existente para comparar
-    mapping_history = load_mapping_history(tipo_layout)
-    # Dicionário para guardar apenas as amostras novas
+    # Amostras vistas neste mapeamento; o banco soma os hits das já conhecidas
     history_para_salvar = {}
+    perfis_para_salvar = {}
 
     novos_arquivos = []
     stats_totais = []
+    progresso = progresso_requisicao()
 
-    for item_data in mapear:
+    for numero_arquivo, item_data in enumerate(mapear, 1):
         nome_arquivo = item_data['nome']
         if nome_arquivo not in dataframes:
             continue
 
-        df = pd.read_json(io.StringIO(dataframes[nome_arquivo]), orient='split')
-        df = normalizar_colunas_vazias(df)
+        if progresso:
+            progresso.etapa('carregando', arquivo=nome_arquivo, arquivo_atual=numero_arquivo, arquivos=len(mapear))
+        df = carregar_dataframe_sessao(dataframes[nome_arquivo])
+        if df is None:
+            continue
 
         mapeamento_do_usuario = {campo[0]: request.form.get(f"{nome_arquivo}_{campo[0]}") for campo in layout}
         mapeamento_do_usuario = {k: v for k, v in mapeamento_do_usuario.items() if v}
+        salvar_mapeamento_confirmado(tipo_layout, item_data.get('assinatura'), mapeamento_do_usuario)
 
         for campo, col_name in mapeamento_do_usuario.items():
             if col_name in df.columns:
-                serie = df[col_name]
-                old_samples_set = set(mapping_history.get(campo, {}).get("amostras_validas", []))
-
-                # Valida e coleta todas as amostras únicas do arquivo atual
-                all_valid_from_serie = {str(v) for v in serie.dropna().unique() if validator(campo, v) and str(v)}
-
-                # Identifica apenas as amostras que são genuinamente novas
-                novas_amostras = list(all_valid_from_serie - old_samples_set)
+                amostras = amostras_para_historico(df[col_name], campo, validator)
+                if amostras:
+                    history_para_salvar.setdefault(campo, {"amostras_validas": []})["amostras_validas"].extend(amostras)
+                perfil = perfil_para_historico(df[col_name], campo, validator)
+                if perfil:
+                    perfis_para_salvar[campo] = mesclar_perfis(perfis_para_salvar[campo], perfil) if campo in perfis_para_salvar else perfil
 
-                if novas_amostras:
-                    history_para_salvar[campo] = {"amostras_validas": novas_amostras}
-
-        inconsistencias, stats, total_linhas, total_validos_geral, total_invalidos_geral = analyzer(df, layout, mapeamento_do_usuario)
+        inconsistencias, stats, total_linhas, total_validos_geral, total_invalidos_geral = analisar_dados(tipo_layout, df, mapeamento_do_usuario, progresso)
 
         novos_arquivos.append({
             'nome': nome_arquivo, 'mapeamento': mapeamento_do_usuario, 'inconsistencias': inconsistencias
@@ -2233,31 +4082,311 @@ def validador_mapear(tipo):
             'nome': nome_arquivo, 'stats': stats, 'total_registros': total_linhas,
             'total_validos_geral': total_validos_geral, 'total_invalidos_geral': total_invalidos_geral
         })
-
+        # Totalizadores do layout saem da soma já calculada no perfil numérico do campo
+        perfis = {campo: st['perfil'] for campo, st in zip(PLANOS[tipo_layout].campos, stats) if st.get('perfil')}
+        if PLANOS[tipo_layout].totalizadores and all(c in perfis for c in PLANOS[tipo_layout].totalizadores.values()):
+            stats_totais[-1]['total_mercadorias'] = total_linhas
+            for chave, campo in PLANOS[tipo_layout].totalizadores.items():
+                stats_totais[-1][chave] = perfis[campo]['soma']
+
+    if progresso and (history_para_salvar or perfis_para_salvar):
+        progresso.etapa('historico')
     if history_para_salvar:
         save_mapping_history(tipo_layout, history_para_salvar)
+    if perfis_para_salvar:
+        salvar_perfis_campos(tipo_layout, perfis_para_salvar)
 
-    session['inconsistencias'] = novos_arquivos
+    if session.get('execucao'):
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(caminho_resultado(session['execucao']))
+    session['execucao'], session['inconsistencias'] = salvar_resultado(tipo_layout, novos_arquivos)
     session['stats'] = stats_totais
-    session.pop('dataframes', None)
+    descartar_dataframes_sessao()
     session.pop('mapear', None)
     session.pop('tipo_layout', None)
     return redirect(url_for('validador', tipo=tipo))
 
-@app.template_filter('reais')
-def reais_format(valor):
+@app.route('/validador/<tipo>/progresso', methods=['GET'])
+def validador_progresso(tipo):
+    """Stream SSE com o andamento do upload ou da análise identificados por `?progresso=`."""
+    chave = request.args.get('progresso', '')
+    if tipo not in LAYOUTS or not PADRAO_CHAVE_PROGRESSO.fullmatch(chave):
+        abort(404)
+
+    def eventos():
+        versao = -1
+        limite_espera = time.monotonic() + PROGRESSO_ESPERA
+        ultimo_dado = ultimo_envio = time.monotonic()
+        while True:
+            with _progressos_cond:
+                progresso = _progressos.get(chave)
+                if progresso is None or progresso.versao == versao:
+                    # Sem registro local a requisição pode estar em outro worker: o arquivo é lido a cada intervalo
+                    _progressos_cond.wait(PROGRESSO_HEARTBEAT if progresso is not None else PROGRESSO_INTERVALO)
+                    progresso = _progressos.get(chave)
+                dados = progresso.resumo() if progresso is not None and progresso.versao != versao else None
+                if dados is not None:
+                    versao = progresso.versao
+            if progresso is None:
+                dados = ler_progresso_compartilhado(chave)
+                versao_arquivo = dados.pop('versao', None) if dados is not None else None
+                if versao_arquivo == versao:
+                    dados = None
+                elif dados is not None:
+                    versao = versao_arquivo
+            agora = time.monotonic()
+            if dados is None:
+                # Nada no prazo de espera, ou outro processo que parou de publicar: o stream termina
+                if (versao == -1 and agora > limite_espera) or (progresso is None and agora - ultimo_dado > PROGRESSO_TTL):
+                    return
+                if agora - ultimo_envio >= PROGRESSO_HEARTBEAT:
+                    ultimo_envio = agora
+                    yield ': aguardando\n\n'
+                continue
+            ultimo_dado = ultimo_envio = agora
+            yield f"data: {json.dumps(dados)}\n\n"
+            if dados['etapa'] in ('concluido', 'erro'):
+                return
+            time.sleep(PROGRESSO_INTERVALO)
+
+    return Response(eventos(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+@app.route('/validador/<tipo>/resultados', methods=['GET'])
+def validador_resultados(tipo):
+    """Inconsistências da última análise, paginadas (`pagina`, `por_pagina`) e filtradas por `arquivo`,
+    `campo` e `tipo_inconsistencia`. As amostras vêm só com `amostras=1`; sem ele, só a quantidade."""
+    itens = carregar_resultado(tipo)['itens']
+    for parametro, chave in (('arquivo', 'arquivo'), ('campo', 'campo'), ('tipo_inconsistencia', 'tipo')):
+        valor = request.args.get(parametro)
+        if valor:
+            itens = [item for item in itens if item[chave] == valor]
+    por_pagina = min(max(request.args.get('por_pagina', RESULTADOS_POR_PAGINA, type=int), 1), RESULTADOS_MAX_POR_PAGINA)
+    paginas = max(1, math.ceil(len(itens) / por_pagina))
+    pagina = min(max(request.args.get('pagina', 1, type=int), 1), paginas)
+    com_amostras = request.args.get('amostras') == '1'
+    pagina_itens = []
+    for item in itens[(pagina - 1) * por_pagina:pagina * por_pagina]:
+        resumo = {k: v for k, v in item.items() if com_amostras or k not in ('amostra', 'ocorrencias')}
+        resumo['amostras'] = len(item['amostra'])
+        pagina_itens.append(resumo)
+    return jsonify({'total': len(itens), 'pagina': pagina, 'paginas': paginas, 'por_pagina': por_pagina,
+                    'itens': pagina_itens})
+
+@app.route('/validador/<tipo>/resultados/amostra', methods=['GET'])
+def validador_resultados_amostra(tipo):
+    """Amostra (valores e ocorrências) de uma inconsistência, carregada quando o item é expandido."""
+    arquivo, chave = request.args.get('arquivo'), request.args.get('chave')
+    for item in carregar_resultado(tipo)['itens']:
+        if item['arquivo'] == arquivo and item['chave'] == chave:
+            return jsonify({'amostra': item['amostra'], 'ocorrencias': item['ocorrencias']})
+    abort(404)
+
+@app.template_filter('numero_br')
+def numero_br_format(valor, casas=2):
     try:
         valor = float(valor)
-        return f"R$ {valor:,.2f}".replace(',', 'v').replace('.', ',').replace('v', '.')
+        return f"{valor:,.{casas}f}".replace(',', 'v').replace('.', ',').replace('v', '.')
     except Exception:
-        return f"R$ {valor}"
+        return f"{valor}"
+
+@app.template_filter('reais')
+def reais_format(valor):
+    return f"R$ {numero_br_format(valor)}"
 
 @app.route('/validador/<tipo>/reset', methods=['POST'])
 def validador_reset(tipo):
+    descartar_uploads_sessao()
     session.clear()
-    limpar_uploads()
     return redirect(url_for('principal'))
 
+@app.route('/limpar_uploads', methods=['POST'])
+def limpar_uploads():
+    """Chamado antes de uma nova seleção de arquivos: descarta só os uploads desta sessão."""
+    descartar_uploads_sessao()
+    return jsonify({'ok': True})
+
+# ----------- API ------------------
+# Validação sem sessão para integrações: o arquivo (ou o SHA-256 de um já enviado) vai numa única
+# requisição e a resposta traz mapeamento, estatísticas e inconsistências em JSON, ou em NDJSON
+# com uma linha por registro inválido. Arquivos e respostas ficam em ARMAZENAMENTO_UPLOADS, na
+# pasta api-<hash>, sob o mesmo TTL e cota; repetir conteúdo, layout, mapeamento e formato devolve
+# a resposta já gravada sem reprocessar.
+
+app.config['API_MAX_CONCORRENTES'] = int(os.environ.get('API_MAX_CONCORRENTES', 4))
+app.config['API_ESPERA_SEGUNDOS'] = float(os.environ.get('API_ESPERA_SEGUNDOS', 10))
+API_REGISTROS_POR_BLOCO = 10000
+PADRAO_HASH = re.compile(r'[0-9a-f]{64}')
+
+_api_vagas = threading.BoundedSemaphore(app.config['API_MAX_CONCORRENTES'])
+_api_travas = {}
+_api_travas_lock = threading.Lock()
+
+@contextlib.contextmanager
+def trava_resultado_api(caminho):
+    """Serializa requisições iguais em andamento: a segunda espera e reaproveita a resposta da primeira."""
+    with _api_travas_lock:
+        trava, usos = _api_travas.get(caminho, (threading.Lock(), 0))
+        _api_travas[caminho] = (trava, usos + 1)
+    try:
+        with trava:
+            yield
+    finally:
+        with _api_travas_lock:
+            trava, usos = _api_travas[caminho]
+            if usos == 1:
+                del _api_travas[caminho]
+            else:
+                _api_travas[caminho] = (trava, usos - 1)
+
+def valor_json(obj):
+    """`default` do json.dumps para escalares numpy e demais tipos não nativos."""
+    return obj.item() if isinstance(obj, np.generic) else str(obj)
+
+def erro_api(e):
+    resposta = jsonify({'erro': e.description})
+    resposta.status_code = e.code
+    for nome, valor in e.get_headers():
+        if nome.lower() != 'content-type':
+            resposta.headers[nome] = valor
+    return resposta
+
+@app.errorhandler(HTTPException)
+def erro_http(e):
+    if request.path.startswith('/api/'):
+        return erro_api(e)
+    return e
+
+def receber_arquivo_api(arquivo):
+    """Grava o upload em api-<hash>/arquivo<ext> e devolve (caminho, hash)."""
+    nome = secure_filename(arquivo.filename or '')
+    ext = os.path.splitext(nome)[1].lower()
+    if ext not in EXTENSOES_UPLOAD:
+        abort(415, description=f'Formato não suportado. Use: {", ".join(EXTENSOES_UPLOAD)}.')
+    temporario = os.path.join(ARMAZENAMENTO_UPLOADS.pasta('api'), f'.{secrets.token_hex(8)}{ext}')
+    info = gravar_upload(arquivo, temporario)
+    caminho = os.path.join(ARMAZENAMENTO_UPLOADS.pasta(f"api-{info['hash']}"), f'arquivo{ext}')
+    os.replace(temporario, caminho)
+    return caminho, info['hash']
+
+def localizar_arquivo_api(referencia):
+    referencia = str(referencia or '').lower()
+    if not PADRAO_HASH.fullmatch(referencia):
+        abort(400, description='Envie o arquivo no campo "arquivo" ou o SHA-256 de um upload anterior em "referencia".')
+    candidatos = glob.glob(os.path.join(ARMAZENAMENTO_UPLOADS.raiz, f'api-{referencia}', 'arquivo.*'))
+    if not candidatos:
+        abort(404, description='Upload de referência não encontrado ou expirado; envie o arquivo novamente.')
+    ARMAZENAMENTO_UPLOADS.pasta(f'api-{referencia}')
+    return candidatos[0], referencia
+
+def analisar_arquivo_api(tipo, caminho, hash_arquivo, mapeamento, mascaras=None):
+    """Lê, mapeia e analisa o arquivo; devolve (resumo, df, mapeamento aplicado)."""
+    with abrir_mmap(caminho) as dados:
+        df, sep, encoding, alertas = detectar_encoding_e_linhas_validas(
+            dados, extensao=os.path.splitext(caminho)[1], filename=hash_arquivo[:12])
+    if df is None:
+        abort(422, description='Não foi possível ler o arquivo (encoding ou delimitador não reconhecido).')
+
+    assinatura = assinatura_cabecalho(df.columns)
+    auto_map, memorizado, _ = sugerir_mapeamento(tipo, df, assinatura)
+    if mapeamento is None:
+        mapeamento = {campo: col for campo, col in auto_map.items() if col}
+    else:
+        desconhecidos = [c for c in mapeamento if c not in PLANOS[tipo].campos]
+        ausentes = [col for col in mapeamento.values() if col not in df.columns]
+        if desconhecidos or ausentes:
+            abort(400, description=f'Mapeamento inválido. Campos desconhecidos: {desconhecidos}; colunas ausentes: {ausentes}.')
+
+    inconsistencias, stats, total_linhas, total_validos_geral, total_invalidos_geral = analisar_dados(
+        tipo, df, mapeamento, progresso_requisicao(), mascaras)
+    resumo = {
+        'layout': tipo,
+        'hash': hash_arquivo,
+        'encoding': encoding,
+        'separador': sep,
+        'colunas': df.columns.tolist(),
+        'auto_map': auto_map,
+        'mapeamento_memorizado': memorizado,
+        'mapeamento': mapeamento,
+        'obrigatorios_nao_mapeados': [c for c, _, _, _, o in LAYOUTS[tipo]['layout'] if o and c not in mapeamento],
+        'alertas': alertas,
+        'total_registros': total_linhas,
+        'total_validos_geral': total_validos_geral,
+        'total_invalidos_geral': total_invalidos_geral,
+        'stats': stats,
+        'inconsistencias': inconsistencias,
+    }
+    return resumo, df, mapeamento
+
+def registros_invalidos_ndjson(tipo, df, mapeamento, mascaras):
+    """Linhas NDJSON (em blocos) com a posição de cada registro inválido e os campos que o invalidaram."""
+    campos = [(campo, PLANOS[tipo].campos[campo].label, df[mapeamento[campo]], mascara) for campo, mascara in mascaras.items()]
+    algum = np.zeros(len(df), dtype=bool)
+    for *_, mascara in campos:
+        algum |= mascara
+    indices = np.flatnonzero(algum)
+    for inicio in range(0, len(indices), API_REGISTROS_POR_BLOCO):
+        bloco = indices[inicio:inicio + API_REGISTROS_POR_BLOCO]
+        colunas = [(campo, label, mascara[bloco], serie.take(bloco).tolist()) for campo, label, serie, mascara in campos]
+        linhas = []
+        for j, i in enumerate(bloco):
+            erros = [{'campo': campo, 'label': label, 'valor': valores[j] if isinstance(valores[j], str) else None}
+                     for campo, label, invalidas, valores in colunas if invalidas[j]]
+            linhas.append(json.dumps({'tipo': 'registro', 'registro': int(i) + 1, 'erros': erros}, ensure_ascii=False))
+        yield '\n'.join(linhas) + '\n'
+
+@app.route('/api/validador/<tipo>', methods=['POST'])
+def api_validar(tipo):
+    """Valida um arquivo sem sessão.
+
+    Multipart com `arquivo` (ou `referencia` = SHA-256 de um envio anterior) e, opcionalmente,
+    `mapeamento` como JSON {campo: coluna}; também aceita corpo JSON com `referencia` e `mapeamento`.
+    `?formato=ndjson` (ou Accept: application/x-ndjson) devolve o resumo seguido dos registros inválidos.
+    """
+    if tipo not in LAYOUTS:
+        abort(404, description='Layout desconhecido.')
+    if not _api_vagas.acquire(timeout=app.config['API_ESPERA_SEGUNDOS']):
+        raise TooManyRequests('Limite de validações simultâneas atingido; tente novamente em instantes.', retry_after=5)
+    try:
+        dados = (request.get_json(silent=True) if request.is_json else request.form) or {}
+        mapeamento = dados.get('mapeamento')
+        if isinstance(mapeamento, str):
+            try:
+                mapeamento = json.loads(mapeamento)
+            except ValueError:
+                abort(400, description='"mapeamento" deve ser um objeto JSON {campo: coluna}.')
+        if mapeamento is not None and not (isinstance(mapeamento, dict) and all(isinstance(v, str) for v in mapeamento.values())):
+            abort(400, description='"mapeamento" deve ser um objeto JSON {campo: coluna}.')
+        if mapeamento is not None:
+            mapeamento = {campo: col for campo, col in mapeamento.items() if col}
+        ndjson = request.args.get('formato') == 'ndjson' or 'application/x-ndjson' in request.headers.get('Accept', '')
+
+        arquivo = request.files.get('arquivo')
+        caminho, hash_arquivo = receber_arquivo_api(arquivo) if arquivo else localizar_arquivo_api(dados.get('referencia'))
+
+        chave = hashlib.sha256(json.dumps([tipo, mapeamento, ndjson], sort_keys=True).encode()).hexdigest()[:16]
+        saida = os.path.join(os.path.dirname(caminho), f"resultado-{tipo}-{chave}.{'ndjson' if ndjson else 'json'}")
+        with trava_resultado_api(saida):
+            reaproveitado = os.path.exists(saida)
+            if not reaproveitado:
+                mascaras = {} if ndjson else None
+                resumo, df, mapeamento_aplicado = analisar_arquivo_api(tipo, caminho, hash_arquivo, mapeamento, mascaras)
+                temporario = f'{saida}.{secrets.token_hex(4)}.tmp'
+                with open(temporario, 'w', encoding='utf-8') as f:
+                    if ndjson:
+                        f.write(json.dumps(dict(resumo, tipo='resumo'), ensure_ascii=False, default=valor_json) + '\n')
+                        for bloco in registros_invalidos_ndjson(tipo, df, mapeamento_aplicado, mascaras):
+                            f.write(bloco)
+                    else:
+                        json.dump(resumo, f, ensure_ascii=False, default=valor_json)
+                os.replace(temporario, saida)
+    finally:
+        _api_vagas.release()
+
+    resposta = send_file(saida, mimetype='application/x-ndjson' if ndjson else 'application/json')
+    resposta.headers['X-Resultado-Reaproveitado'] = 'true' if reaproveitado else 'false'
+    return resposta
+
 # ----------- HISTORY ------------------
 
 @app.route('/get_amostra', methods=['POST'])
@@ -2267,10 +4396,11 @@ def get_amostra():
     limit = int(request.form.get('limit', 20))
     if 'dataframes' not in session or nome_arquivo not in session['dataframes']:
         return jsonify({'ok': False, 'erro': 'Arquivo não encontrado na sessão.'})
-    df = pd.read_json(io.StringIO(session['dataframes'][nome_arquivo]), orient='split')
-    df = normalizar_colunas_vazias(df)
+    df = carregar_dataframe_sessao(session['dataframes'][nome_arquivo])
+    if df is None:
+        return jsonify({'ok': False, 'erro': 'Arquivo não encontrado na sessão.'})
     df_amostra = df.iloc[offset:offset+limit]
-    amostra = df_amostra.where(pd.notnull(df_amostra), '').to_dict('records')
+    amostra = df_amostra.astype(object).where(pd.notnull(df_amostra), '').to_dict('records')
     return jsonify({'ok': True, 'amostra': amostra, 'colunas': list(df.columns)})
 
 @app.route('/history_ia', methods=['GET'])
@@ -2279,42 +4409,123 @@ def mapping_history_ia():
     if token != 'ia-secrect':
         return "Acesso restrito.", 403
 
-    amostras_limit = 50
     mensagem = session.pop('mensagem', None)
     history_por_layout = {name: {"nome": config["nome"], "campos": {}} for name, config in LAYOUTS.items()}
-    conn = get_db()
 
-    if conn:
-        try:
-            with conn.cursor() as cur:
-                for layout_name in LAYOUTS.keys():
-                    table_name = layout_name
-                    query = f"""
-                        SELECT field_name, COUNT(id) as total,
-                               (array_agg(sample_value))[1:%s] as amostras
-                        FROM {table_name}
-                        GROUP BY field_name
-                        ORDER BY field_name;
-                    """
-                    cur.execute(query, (amostras_limit,))
-                    results = cur.fetchall()
-                    for row in results:
-                        field_name, total, amostras = row
-                        history_por_layout[layout_name]["campos"][field_name] = {
-                            "nome": field_name,
-                            "amostras": amostras or [],
-                            "total": total
-                        }
-        except Exception as e:
-            print(f"Erro ao carregar histórico: {e}")
+    try:
+        for layout_name, field_name, total in historico().resumo(LAYOUTS):
+            history_por_layout[layout_name]["campos"][field_name] = {
+                "nome": field_name,
+                "total": total
+            }
+    except Exception as e:
+        print(f"Erro ao carregar histórico: {e}")
 
     return render_template(
         "history_ia.html",
         history_por_layout=history_por_layout,
-        mensagem=mensagem,
-        amostras_limit=amostras_limit
+        campos_por_layout={name: list(PLANOS[name].campos) for name in LAYOUTS},
+        historico_postgres=historico().nome == 'postgres',
+        mensagem=mensagem
     )
 
+@app.route('/history_ia/previa', methods=['GET'])
+def history_ia_previa():
+    """Prévia (até RESUMO_PREVIA_AMOSTRAS) das amostras de um campo, carregada ao expandir o campo na tela."""
+    token = request.args.get('token', '')
+    if token != 'ia-secrect':
+        return jsonify({"error": "Acesso restrito."}), 403
+
+    layout = request.args.get('layout')
+    campo = request.args.get('campo')
+    if layout not in LAYOUTS:
+        return jsonify({"error": "Layout inválido."}), 400
+    amostras, total = [], 0
+
+    try:
+        amostras, total = historico().previa(layout, campo)
+    except Exception as e:
+        print(f"Erro ao carregar prévia de '{layout}.{campo}': {e}")
+
+    return jsonify(amostras=amostras, total=total)
+
+@app.route('/history_ia/importar', methods=['POST'])
+def history_ia_importar():
+    token = request.form.get('token', '')
+    if token != 'ia-secrect':
+        return "Acesso restrito.", 403
+
+    layout = request.form.get('layout')
+    arquivo = request.files.get('arquivo')
+    if layout not in LAYOUTS:
+        session['mensagem'] = "Layout inválido."
+        return redirect(url_for('mapping_history_ia', token=token))
+
+    try:
+        if arquivo and arquivo.filename:
+            stats = carregar_semente_historico(layout, arquivo.stream, request.content_length or 0, progresso_requisicao())
+        else:
+            caminho = caminho_semente(layout)
+            if not os.path.exists(caminho):
+                raise ValueError(f"não há semente para o layout em {os.path.relpath(caminho, app.root_path)}")
+            with open(caminho, 'rb') as f:
+                stats = carregar_semente_historico(layout, f, os.path.getsize(caminho), progresso_requisicao())
+        session['mensagem'] = f"{LAYOUTS[layout]['nome']}: {descrever_carga_semente(stats)}"
+    except Exception as e:
+        print(f"Erro ao importar amostras em '{layout}': {e}")
+        session['mensagem'] = f"Erro ao importar amostras: {e}"
+
+    return redirect(url_for('mapping_history_ia', token=token))
+
+@app.route('/history_ia/snapshot', methods=['GET'])
+def history_ia_exportar_snapshot():
+    token = request.args.get('token', '')
+    if token != 'ia-secrect':
+        return "Acesso restrito.", 403
+
+    if historico().nome != 'postgres':
+        session['mensagem'] = MENSAGEM_SO_POSTGRES
+        return redirect(url_for('mapping_history_ia', token=token))
+
+    partes = gerar_snapshot_historico(request.args.getlist('layout') or None)
+    try:
+        # O primeiro pedaço (schema) já valida pyarrow e banco antes de a resposta começar
+        inicio = next(partes)
+    except Exception as e:
+        print(f"Erro ao exportar snapshot do histórico: {e}")
+        session['mensagem'] = f"Erro ao exportar snapshot: {e}"
+        return redirect(url_for('mapping_history_ia', token=token))
+
+    def corpo():
+        # Gerador (e não itertools.chain) para que fechar a resposta feche também o snapshot e sua conexão
+        yield inicio
+        yield from partes
+
+    nome = f"historico-{datetime.datetime.now():%Y%m%d-%H%M}.arrow"
+    return Response(corpo(), mimetype=SNAPSHOT_TIPO,
+                    headers={'Content-Disposition': f'attachment; filename="{nome}"'})
+
+@app.route('/history_ia/snapshot', methods=['POST'])
+def history_ia_importar_snapshot():
+    token = request.form.get('token', '')
+    if token != 'ia-secrect':
+        return "Acesso restrito.", 403
+
+    arquivo = request.files.get('arquivo')
+    modo = request.form.get('modo', 'mesclar')
+    try:
+        if historico().nome != 'postgres':
+            raise ValueError(MENSAGEM_SO_POSTGRES)
+        if not arquivo or not arquivo.filename:
+            raise ValueError("nenhum arquivo enviado")
+        stats = importar_snapshot_historico(arquivo.stream, modo, progresso_requisicao())
+        session['mensagem'] = descrever_importacao_snapshot(stats)
+    except Exception as e:
+        print(f"Erro ao importar snapshot do histórico: {e}")
+        session['mensagem'] = f"Erro ao importar snapshot: {e}"
+
+    return redirect(url_for('mapping_history_ia', token=token))
+
 @app.route('/history_ia/busca_amostras', methods=['POST'])
 def history_ia_busca_amostras():
     token = request.form.get('token', '')
@@ -2323,31 +4534,20 @@ def history_ia_busca_amostras():
 
     layout = request.form.get('layout')
     campo = request.form.get('campo')
-    termo = request.form.get('termo', '').lower()
-    limit = int(request.form.get('limit', 100))
-    table_name = layout
-    resultados = []
-    total = 0
-    conn = get_db()
+    termo = request.form.get('termo', '').strip()
+    depois = request.form.get('depois') or None
+    limit = min(max(request.form.get('limit', BUSCA_POR_PAGINA, type=int), 1), BUSCA_MAX_POR_PAGINA)
+    if layout not in LAYOUTS:
+        return jsonify({"error": "Layout inválido."}), 400
 
-    if conn:
-        try:
-            with conn.cursor() as cur:
-                query = f"""
-                    SELECT sample_value FROM {table_name}
-                    WHERE field_name = %s AND sample_value ILIKE %s
-                    LIMIT %s;
-                """
-                cur.execute(query, (campo, f'%{termo}%', limit))
-                resultados = [row[0] for row in cur.fetchall()]
-
-                count_query = f"SELECT COUNT(id) FROM {table_name} WHERE field_name = %s AND sample_value ILIKE %s;"
-                cur.execute(count_query, (campo, f'%{termo}%'))
-                total = cur.fetchone()[0]
-        except Exception as e:
-            print(f"Erro na busca em '{table_name}': {e}")
+    resultado = {'amostras': [], 'proximo': None, 'total': 0, 'estimado': False}
+
+    try:
+        resultado = historico().buscar(layout, campo, termo, depois, limit, contar=depois is None)
+    except Exception as e:
+        print(f"Erro na busca em '{layout}': {e}")
 
-    return jsonify(amostras=resultados, total=total)
+    return jsonify(resultado)
 
 @app.route('/history_ia/delete', methods=['POST'])
 def history_ia_delete():
@@ -2359,35 +4559,309 @@ def history_ia_delete():
     campo = request.form.get('campo')
     valor = request.form.get('valor')
     acao = request.form.get('acao')
-    table_name = layout
+    if layout not in LAYOUTS:
+        return jsonify({"success": False, "mensagem": "Layout inválido."}), 400
     success = False
-    mensagem = ""
+    operacao = None
+
+    try:
+        if acao == 'delcampo':
+            _, operacao = historico().remover(layout, campo)
+            mensagem = f"Todas as amostras do campo '{campo}' foram removidas."
+            success = True
+        elif acao == 'delvalor' and valor is not None:
+            quantidade, operacao = historico().remover(layout, campo, valor)
+            if quantidade > 0:
+                mensagem = f'Valor "{valor}" removido do campo "{campo}".'
+                success = True
+            else:
+                mensagem = f'Valor "{valor}" não encontrado.'
+        else:
+            mensagem = "Ação inválida."
+    except Exception as e:
+        mensagem = f"Erro ao excluir de '{layout}': {e}"
+
+    return jsonify({"success": success, "mensagem": mensagem, "operacao": operacao})
+
+@app.route('/history_ia/curadoria', methods=['POST'])
+def history_ia_curadoria():
+    """Exclusão em massa: lista de valores, padrão (regex), campo inteiro ou amostras reprovadas nas regras atuais."""
+    token = request.form.get('token', '')
+    if token != 'ia-secrect':
+        return jsonify({"success": False, "mensagem": "Acesso restrito."}), 403
+
+    layout = request.form.get('layout', '')
+    if layout not in LAYOUTS:
+        return jsonify({"success": False, "mensagem": "Layout inválido."}), 400
+    simular = request.form.get('simular') == '1'
+    if historico().nome != 'postgres':
+        return jsonify({"success": False, "mensagem": MENSAGEM_SO_POSTGRES}), 400
     conn = get_db()
+    if conn is None:
+        return jsonify({"success": False, "mensagem": "Não foi possível conectar ao banco de dados."}), 503
 
-    if conn:
-        try:
+    try:
+        resultado = curar_historico(
+            conn, layout, request.form.get('modo', ''),
+            campo=request.form.get('campo') or None,
+            valores=request.form.get('valores', '').splitlines(),
+            padrao=request.form.get('padrao', ''),
+            ignorar_maiusculas=request.form.get('ignorar_maiusculas') == '1',
+            simular=simular,
+            progresso=progresso_requisicao()
+        )
+    except ValueError as e:
+        return jsonify({"success": False, "mensagem": str(e)}), 400
+    except psycopg2.errors.InvalidRegularExpression as e:
+        return jsonify({"success": False, "mensagem": f"Expressão regular inválida: {e.diag.message_primary}"}), 400
+    except Exception as e:
+        print(f"Erro na curadoria de '{layout}': {e}")
+        return jsonify({"success": False, "mensagem": f"Erro na curadoria de '{layout}': {e}"}), 500
+
+    quantidade = resultado['quantidade']
+    if simular:
+        mensagem = f"{quantidade} amostra(s) seriam removidas: {resultado['descricao']}."
+    elif quantidade:
+        mensagem = f"{quantidade} amostra(s) removidas: {resultado['descricao']}."
+    else:
+        mensagem = "Nenhuma amostra atende aos critérios."
+    return jsonify({"success": True, "mensagem": mensagem, **resultado})
+
+@app.route('/history_ia/curadoria', methods=['GET'])
+def history_ia_curadoria_operacoes():
+    """Operações de curadoria mais recentes, com as que ainda podem ser desfeitas."""
+    token = request.args.get('token', '')
+    if token != 'ia-secrect':
+        return jsonify({"error": "Acesso restrito."}), 403
+
+    if historico().nome != 'postgres':
+        return jsonify({"operacoes": []})
+    conn = get_db()
+    if conn is None:
+        return jsonify({"error": "Não foi possível conectar ao banco de dados."}), 503
+    try:
+        return jsonify({"operacoes": operacoes_curadoria(conn)})
+    except Exception as e:
+        conn.rollback()
+        print(f"Erro ao listar operações de curadoria: {e}")
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/history_ia/curadoria/desfazer', methods=['POST'])
+def history_ia_curadoria_desfazer():
+    token = request.form.get('token', '')
+    if token != 'ia-secrect':
+        return jsonify({"success": False, "mensagem": "Acesso restrito."}), 403
+
+    operacao = request.form.get('operacao', '')
+    if not operacao.isdigit():
+        return jsonify({"success": False, "mensagem": "Operação inválida."}), 400
+    if historico().nome != 'postgres':
+        return jsonify({"success": False, "mensagem": MENSAGEM_SO_POSTGRES}), 400
+    conn = get_db()
+    if conn is None:
+        return jsonify({"success": False, "mensagem": "Não foi possível conectar ao banco de dados."}), 503
+
+    try:
+        layout, quantidade = desfazer_curadoria(conn, int(operacao))
+    except ValueError as e:
+        return jsonify({"success": False, "mensagem": str(e)}), 400
+    except Exception as e:
+        print(f"Erro ao desfazer a operação {operacao}: {e}")
+        return jsonify({"success": False, "mensagem": f"Erro ao desfazer a operação {operacao}: {e}"}), 500
+    return jsonify({"success": True, "mensagem": f"{quantidade} amostra(s) restauradas em {LAYOUTS[layout]['nome']}."})
+
+# ----------- COMANDOS ------------------
+
+@app.cli.command('migrar-banco')
+def migrar_banco_comando():
+    """Aplica as migrações pendentes do banco de dados e informa as versões aplicadas."""
+    app.config['DB_MIGRAR_AUTOMATICAMENTE'] = False
+    conn = get_db()
+    if conn is None:
+        raise click.ClickException("Não foi possível conectar ao banco de dados PostgreSQL.")
+    aplicadas = migrar_banco(conn)
+    if aplicadas:
+        click.echo(f"Migrações aplicadas: {', '.join(map(str, aplicadas))}")
+    else:
+        click.echo(f"Banco já está na versão {MIGRACOES[-1][0]}.")
+
+@app.cli.command('conferir-regras')
+def conferir_regras_comando():
+    """Confere as regras compiladas dos layouts contra os EXEMPLOS_REGRAS."""
+    falhas = conferir_regras()
+    for falha in falhas:
+        click.echo(falha)
+    if falhas:
+        raise click.ClickException(f"{len(falhas)} de {len(EXEMPLOS_REGRAS)} caso(s) com resultado inesperado.")
+    click.echo(f"{len(EXEMPLOS_REGRAS)} caso(s) conferido(s).")
+
+@app.cli.command('benchmark-leitura')
+@click.argument('arquivo', type=click.Path(exists=True, dir_okay=False))
+def benchmark_leitura(arquivo):
+    """Mede a vazão (MB/s) da leitura de um CSV com o leitor Arrow e com o leitor de reserva."""
+    tamanho_mb = os.path.getsize(arquivo) / (1024 * 1024)
+    with abrir_mmap(arquivo) as dados:
+        inicio = time.perf_counter()
+        df, sep, enc, _ = detectar_encoding_e_linhas_validas(dados, filename=os.path.basename(arquivo))
+        total = time.perf_counter() - inicio
+        if df is None:
+            click.echo("Não foi possível ler o arquivo.")
+            return
+        click.echo(f"{os.path.basename(arquivo)}: {tamanho_mb:.1f} MB, encoding {enc}, separador {sep!r}, {len(df)} registros")
+        click.echo(f"{'detecção + leitura':<20} {total:8.2f}s {tamanho_mb / total:8.1f} MB/s")
+        for nome, leitor in (('arrow', ler_csv_arrow), ('python', ler_csv_python)):
+            inicio = time.perf_counter()
+            lido = leitor(dados, enc, sep)
+            segundos = time.perf_counter() - inicio
+            if lido is None:
+                click.echo(f"{nome:<20} indisponível para este arquivo")
+                continue
+            click.echo(f"{nome:<20} {segundos:8.2f}s {tamanho_mb / segundos:8.1f} MB/s  {len(lido[0])} registros, {len(lido[1])} ignorados")
+            del lido
+
+@app.cli.command('semear-historico')
+@click.argument('layouts', nargs=-1)
+@click.option('--arquivo', type=click.Path(exists=True, dir_okay=False),
+              help='Arquivo no formato do histórico em vez de dados/ia_<layout>.json (um único layout).')
+def semear_historico(layouts, arquivo):
+    """Carrega as sementes dados/ia_<layout>.json (ou um arquivo exportado) no histórico de amostras."""
+    layouts = layouts or tuple(LAYOUTS)
+    desconhecidos = [layout for layout in layouts if layout not in LAYOUTS]
+    if desconhecidos:
+        raise click.ClickException(f"Layout(s) desconhecido(s): {', '.join(desconhecidos)}")
+    if arquivo and len(layouts) != 1:
+        raise click.ClickException("Com --arquivo, informe exatamente um layout.")
+
+    for layout in layouts:
+        caminho = arquivo or caminho_semente(layout)
+        if not os.path.exists(caminho):
+            click.echo(f"{layout:<20} sem semente em {caminho}")
+            continue
+        inicio = time.perf_counter()
+        with open(caminho, 'rb') as f:
+            stats = carregar_semente_historico(
+                layout, f, ao_avancar=lambda st: click.echo(f"{layout:<20} {st['lidas']} amostra(s) enviada(s)..."))
+        click.echo(f"{layout:<20} {descrever_carga_semente(stats)} ({time.perf_counter() - inicio:.2f}s)")
+
+@app.cli.command('exportar-historico')
+@click.argument('arquivo', type=click.Path(dir_okay=False, writable=True))
+@click.option('--layout', 'layouts', multiple=True, help='Layout a exportar (repetível; padrão: todos).')
+def exportar_historico(arquivo, layouts):
+    """Grava o histórico de amostras, perfis e mapeamentos num snapshot binário (Arrow IPC comprimido)."""
+    inicio = time.perf_counter()
+    try:
+        with open(arquivo, 'wb') as destino:
+            for parte in gerar_snapshot_historico(layouts or None):
+                destino.write(parte)
+    except RuntimeError as e:
+        raise click.ClickException(str(e))
+    click.echo(f"Snapshot gravado em {arquivo}: {os.path.getsize(arquivo) / 1024:.1f} KB "
+               f"({time.perf_counter() - inicio:.2f}s)")
+
+@app.cli.command('importar-historico')
+@click.argument('arquivo', type=click.Path(exists=True, dir_okay=False))
+@click.option('--modo', type=click.Choice(SNAPSHOT_MODOS), default='mesclar', show_default=True,
+              help='mesclar: soma ao histórico atual sem duplicar; substituir: troca o histórico dos layouts do snapshot.')
+def importar_historico(arquivo, modo):
+    """Aplica um snapshot gerado por `flask exportar-historico` ao histórico deste banco."""
+    inicio = time.perf_counter()
+    try:
+        with open(arquivo, 'rb') as fonte:
+            stats = importar_snapshot_historico(
+                fonte, modo, ao_avancar=lambda st: click.echo(
+                    f"{sum(info['lidas'] for info in st.values())} amostra(s) carregada(s)..."))
+    except (RuntimeError, ValueError) as e:
+        raise click.ClickException(str(e))
+    click.echo(f"{descrever_importacao_snapshot(stats)} ({time.perf_counter() - inicio:.2f}s)")
+
+def _encobrir_historico_postgres(conn, tipo_layout):
+    """Cria tabelas temporárias com os nomes das do histórico; nesta conexão elas encobrem as reais."""
+    with conn.cursor() as cur:
+        for tabela in (tipo_layout, 'perfis_campos', 'curadoria_operacoes', 'curadoria_lixeira'):
+            cur.execute(f"CREATE TEMP TABLE {tabela} (LIKE {tabela} INCLUDING DEFAULTS INCLUDING INDEXES);")
+    conn.commit()
+
+@app.cli.command('benchmark-historico')
+@click.option('--layout', type=click.Choice(list(LAYOUTS)), default='pessoas', show_default=True)
+@click.option('--campos', default=10, show_default=True, help='Campos do layout usados na medição.')
+@click.option('--amostras', default=2000, show_default=True, help='Amostras por campo em cada gravação.')
+@click.option('--buscas', default=200, show_default=True, help='Buscas por trecho de amostra.')
+def benchmark_historico(layout, campos, amostras, buscas):
+    """Compara o histórico no PostgreSQL e no SQLite: carga em massa, gravação, leitura, busca e remoção.
+
+    No PostgreSQL a medição roda em tabelas temporárias, sem tocar no histórico real.
+    """
+    campos = list(PLANOS[layout].campos)[:campos]
+    def gerar(rodada):
+        return {campo: {'amostras_validas': [f'{campo} {rodada}{j:06d} {secrets.token_hex(4)}' for j in range(amostras)]}
+                for campo in campos}
+    semente = json.dumps(gerar('s')).encode('utf-8')
+    novas = gerar('g')
+    termos = [(campos[k % len(campos)], f'g{(k * 7919) % amostras:06d}') for k in range(buscas)]
+    total = len(campos) * amostras
+
+    with tempfile.TemporaryDirectory() as pasta:
+        armazenamentos = [HistoricoSQLite(os.path.join(pasta, 'historico.sqlite3'))]
+        conn = get_db()
+        if conn is None:
+            click.echo("PostgreSQL indisponível: medindo só o SQLite.")
+        else:
+            _encobrir_historico_postgres(conn, layout)
+            armazenamentos.insert(0, HistoricoPostgres(conn))
+
+        for armazenamento in armazenamentos:
+            etapas = (
+                ('semente', total, 'amostras', lambda: armazenamento.carregar_semente(layout, io.BytesIO(semente))),
+                ('gravação', total, 'amostras', lambda: armazenamento.registrar(layout, novas)),
+                ('leitura', 1, 'layouts', lambda: armazenamento.carregar(layout)),
+                ('busca', buscas, 'buscas', lambda: [armazenamento.buscar(layout, campo, termo) for campo, termo in termos]),
+                ('remoção', len(campos), 'campos', lambda: [armazenamento.remover(layout, campo) for campo in campos]),
+            )
+            for etapa, quantidade, unidade, medir in etapas:
+                inicio = time.perf_counter()
+                medir()
+                segundos = time.perf_counter() - inicio
+                click.echo(f"{armazenamento.nome:<10} {etapa:<10} {segundos:8.3f}s {quantidade / segundos:12,.0f} {unidade}/s")
+            armazenamento.fechar()
+
+        if conn is not None:
             with conn.cursor() as cur:
-                if acao == 'delcampo':
-                    query = f"DELETE FROM {table_name} WHERE field_name = %s;"
-                    cur.execute(query, (campo,))
-                    mensagem = f"Todas as amostras do campo '{campo}' foram removidas."
-                    success = True
-                elif acao == 'delvalor' and valor is not None:
-                    query = f"DELETE FROM {table_name} WHERE field_name = %s AND sample_value = %s;"
-                    cur.execute(query, (campo, valor))
-                    if cur.rowcount > 0:
-                        mensagem = f'Valor "{valor}" removido do campo "{campo}".'
-                        success = True
-                    else:
-                        mensagem = f'Valor "{valor}" não encontrado.'
+                cur.execute("DISCARD TEMP;")
             conn.commit()
-        except Exception as e:
-            conn.rollback()
-            mensagem = f"Erro ao excluir de '{table_name}': {e}"
-    else:
-        mensagem = "Não foi possível conectar ao banco de dados."
 
-    return jsonify({"success": success, "mensagem": mensagem})
+# Executado num processo novo: importa o app e faz a primeira requisição, medindo cada etapa
+_SCRIPT_BENCHMARK_INICIO = """
+import sys, time
+t0 = time.perf_counter()
+import app
+t1 = time.perf_counter()
+resposta = app.app.test_client().get(sys.argv[1])
+t2 = time.perf_counter()
+print(t1 - t0, t2 - t1, resposta.status_code)
+"""
+
+@app.cli.command('benchmark-inicio')
+@click.option('--repeticoes', default=5, show_default=True, help='Processos novos por cenário.')
+@click.option('--rota', default='/principal', show_default=True, help='Rota da primeira requisição.')
+def benchmark_inicio(repeticoes, rota):
+    """Mede, em processos novos, o tempo de importação do app e até a primeira resposta, com e sem pré-carga."""
+    for nome, precarregar in (('tardio', '0'), ('pré-carregado', '1')):
+        ambiente = dict(os.environ, PRECARREGAR_MODULOS=precarregar)
+        importacao, requisicao, total = [], [], []
+        for _ in range(repeticoes):
+            inicio = time.perf_counter()
+            saida = subprocess.run([sys.executable, '-c', _SCRIPT_BENCHMARK_INICIO, rota], cwd=app.root_path,
+                                   env=ambiente, capture_output=True, text=True)
+            fim = time.perf_counter()
+            if saida.returncode != 0:
+                raise click.ClickException(saida.stderr.strip().splitlines()[-1])
+            segundos_importacao, segundos_requisicao, status = saida.stdout.split()[-3:]
+            importacao.append(float(segundos_importacao))
+            requisicao.append(float(segundos_requisicao))
+            total.append(fim - inicio)
+        click.echo(f"{nome:<14} importação {statistics.median(importacao):6.3f}s  "
+                   f"1ª requisição {statistics.median(requisicao):6.3f}s (HTTP {status})  "
+                   f"processo até a resposta {statistics.median(total):6.3f}s  (mediana de {repeticoes})")
 
 if __name__ == '__main__':
     app.run(debug=True)
\ No newline at end of file
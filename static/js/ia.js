@@ -20,7 +20,9 @@ document.addEventListener('DOMContentLoaded', function() {
         if (valor) {
             modalMsg.textContent = `Tem certeza que deseja excluir o valor "${valor}" do campo "${campo}"?`;
         } else {
-            modalMsg.textContent = `Tem certeza que deseja limpar TODAS as amostras do campo "${campo}"? Esta ação não pode ser desfeita.`;
+            // Só o histórico no PostgreSQL guarda a operação para desfazer (a seção de curadoria existe só nele)
+            const desfazer = document.getElementById('curadoria') ? ' A exclusão pode ser desfeita em "Operações recentes".' : ' A exclusão é definitiva.';
+            modalMsg.textContent = `Tem certeza que deseja limpar TODAS as amostras do campo "${campo}"?${desfazer}`;
         }
         modalConfirmacao.show();
     }
@@ -28,6 +30,11 @@ document.addEventListener('DOMContentLoaded', function() {
     document.body.addEventListener('click', configurarExclusao);
 
     modalBtnConfirmar.addEventListener('click', function() {
+        if (dadosParaExcluir.aoConfirmar) {
+            dadosParaExcluir.aoConfirmar();
+            modalConfirmacao.hide();
+            return;
+        }
         const { layout, campo, valor, acao, element } = dadosParaExcluir;
         const token = new URLSearchParams(window.location.search).get('token');
 
@@ -53,6 +60,7 @@ document.addEventListener('DOMContentLoaded', function() {
                     container.querySelector('.badge').textContent = '0';
                 }
                 mostrarSnackbar(data.mensagem, 'success');
+                carregarOperacoes();
             } else {
                 mostrarSnackbar(data.mensagem || 'Erro ao excluir.', 'error');
             }
@@ -62,44 +70,91 @@ document.addEventListener('DOMContentLoaded', function() {
     });
 
     // --- Lógica de Busca ---
+    // Busca enquanto digita (com uma espera curta) e pagina por keyset: "Carregar mais" pede a página
+    // seguinte a partir da última amostra mostrada. O total vem só na primeira página (com "~" quando
+    // é estimado pelo banco).
+
+    const ESPERA_BUSCA_MS = 250;
+
+    function itemAmostra(layout, campo, amostra) {
+        const li = document.createElement('li');
+        li.className = 'list-group-item d-flex justify-content-between align-items-center';
+        const span = document.createElement('span');
+        span.className = 'valor-amostra';
+        span.textContent = amostra;
+        const botao = document.createElement('button');
+        botao.className = 'btn btn-sm btn-outline-danger btn-excluir-valor';
+        botao.dataset.layout = layout;
+        botao.dataset.campo = campo;
+        botao.dataset.valor = amostra;
+        botao.innerHTML = '<i class="bi bi-x-lg"></i>';
+        li.append(span, botao);
+        return li;
+    }
+
+    function infoBusca(container) {
+        let info = container.querySelector('.info-busca');
+        if (!info) {
+            info = document.createElement('small');
+            info.className = 'text-muted info-busca';
+            container.querySelector('.lista-amostras').after(info);
+        }
+        return info;
+    }
 
-    function executarBusca(input) {
+    function executarBusca(input, depois) {
         const layout = input.dataset.layout;
         const campo = input.dataset.campo;
         const termo = input.value;
         const token = new URLSearchParams(window.location.search).get('token');
-        const lista = input.closest('.campo-container').querySelector('.lista-amostras');
+        const container = input.closest('.campo-container');
+        const lista = container.querySelector('.lista-amostras');
+        // Respostas de buscas já superadas por outra digitação são descartadas
+        const consulta = (input._consulta || 0) + 1;
+        input._consulta = consulta;
+
+        const corpo = new URLSearchParams({ token: token, layout: layout, campo: campo, termo: termo });
+        if (depois) corpo.append('depois', depois);
 
         fetch('/history_ia/busca_amostras', {
             method: 'POST',
             headers: { 'Content-Type': 'application/x-www-form-urlencoded' },
-            body: new URLSearchParams({
-                token: token,
-                layout: layout,
-                campo: campo,
-                termo: termo
-            })
+            body: corpo
         })
         .then(response => response.json())
         .then(data => {
-            lista.innerHTML = '';
-            if (data.amostras && data.amostras.length > 0) {
-                data.amostras.forEach(amostra => {
-                    const li = document.createElement('li');
-                    li.className = 'list-group-item d-flex justify-content-between align-items-center';
-                    li.innerHTML = `
-                        <span class="valor-amostra">${amostra}</span>
-                        <button class="btn btn-sm btn-outline-danger btn-excluir-valor" data-layout="${layout}" data-campo="${campo}" data-valor="${amostra}">
-                            <i class="bi bi-x-lg"></i>
-                        </button>
-                    `;
-                    lista.appendChild(li);
-                });
-            } else {
+            if (input._consulta !== consulta) return;
+            if (!depois) {
+                lista.innerHTML = '';
+                input._total = data.total;
+                input._estimado = data.estimado;
+            }
+            const mais = lista.querySelector('.item-mais-amostras');
+            if (mais) mais.remove();
+
+            (data.amostras || []).forEach(amostra => lista.appendChild(itemAmostra(layout, campo, amostra)));
+            if (!lista.children.length) {
                 lista.innerHTML = '<li class="list-group-item">Nenhuma amostra encontrada.</li>';
             }
+            if (data.proximo) {
+                const li = document.createElement('li');
+                li.className = 'list-group-item text-center item-mais-amostras';
+                const botao = document.createElement('button');
+                botao.type = 'button';
+                botao.className = 'btn btn-sm btn-link';
+                botao.textContent = 'Carregar mais';
+                botao.addEventListener('click', () => executarBusca(input, data.proximo));
+                li.appendChild(botao);
+                lista.appendChild(li);
+            }
+
+            const exibidas = lista.querySelectorAll('.valor-amostra').length;
+            infoBusca(container).textContent = input._total
+                ? `Mostrando ${exibidas} de ${input._estimado ? '~' : ''}${input._total.toLocaleString('pt-BR')} amostra(s) encontrada(s).`
+                : '';
         })
         .catch(() => {
+            if (input._consulta !== consulta) return;
             lista.innerHTML = '<li class="list-group-item text-danger">Erro ao buscar.</li>';
         });
     }
@@ -112,13 +167,181 @@ document.addEventListener('DOMContentLoaded', function() {
     });
 
     document.querySelectorAll('.input-busca').forEach(input => {
+        let espera = null;
+        input.addEventListener('input', function() {
+            clearTimeout(espera);
+            espera = setTimeout(() => executarBusca(input), ESPERA_BUSCA_MS);
+        });
         input.addEventListener('keyup', function(e) {
             if (e.key === 'Enter') {
+                clearTimeout(espera);
                 executarBusca(input);
             }
         });
     });
 
+    // --- Prévia sob demanda ---
+    // A página traz só o total de cada campo; a prévia vem do resumo do histórico ao expandir o campo.
+
+    document.querySelectorAll('.btn-ver-amostras').forEach(btn => {
+        btn.addEventListener('click', function() {
+            const container = btn.closest('.campo-container');
+            const lista = container.querySelector('.lista-amostras');
+            if (btn.dataset.carregado) {
+                const oculto = lista.style.display === 'none';
+                lista.style.display = oculto ? '' : 'none';
+                infoBusca(container).style.display = oculto ? '' : 'none';
+                return;
+            }
+            const token = new URLSearchParams(window.location.search).get('token');
+            const parametros = new URLSearchParams({ token: token, layout: btn.dataset.layout, campo: btn.dataset.campo });
+
+            fetch('/history_ia/previa?' + parametros)
+            .then(response => response.json())
+            .then(data => {
+                btn.dataset.carregado = '1';
+                lista.innerHTML = '';
+                (data.amostras || []).forEach(amostra => lista.appendChild(itemAmostra(btn.dataset.layout, btn.dataset.campo, amostra)));
+                if (!lista.children.length) {
+                    lista.innerHTML = '<li class="list-group-item">Nenhuma amostra encontrada.</li>';
+                }
+                infoBusca(container).textContent = data.total > (data.amostras || []).length
+                    ? `Mostrando ${data.amostras.length} de ${data.total.toLocaleString('pt-BR')} amostras. Use a busca para ver as demais.`
+                    : '';
+            })
+            .catch(() => {
+                lista.innerHTML = '<li class="list-group-item text-danger">Erro ao carregar amostras.</li>';
+            });
+        });
+    });
+
+    // --- Curadoria em massa ---
+    // Simular mostra quantas amostras sairiam (e alguns exemplos) sem excluir nada. Cada exclusão vira
+    // uma operação que pode ser desfeita na lista de operações recentes. Com o histórico fora do
+    // PostgreSQL a seção não existe na página.
+
+    const curadoria = document.getElementById('curadoria');
+    const formCuradoria = document.getElementById('form-curadoria');
+    const camposPorLayout = curadoria ? JSON.parse(curadoria.dataset.campos) : {};
+    const resultadoCuradoria = document.getElementById('curadoria-resultado');
+    const listaOperacoes = document.getElementById('curadoria-operacoes');
+
+    function preencherCampos() {
+        const select = formCuradoria.elements.campo;
+        const modo = formCuradoria.elements.modo.value;
+        select.innerHTML = '';
+        if (modo !== 'campo') select.add(new Option('(todos os campos)', ''));
+        (camposPorLayout[formCuradoria.elements.layout.value] || []).forEach(campo => select.add(new Option(campo, campo)));
+    }
+
+    function alternarModo() {
+        const modo = formCuradoria.elements.modo.value;
+        curadoria.querySelectorAll('.curadoria-opcao').forEach(div => {
+            div.style.display = div.dataset.modo === modo ? '' : 'none';
+        });
+        preencherCampos();
+    }
+
+    function executarCuradoria(simular) {
+        const token = new URLSearchParams(window.location.search).get('token');
+        const corpo = new URLSearchParams(new FormData(formCuradoria));
+        corpo.append('token', token);
+        if (simular) corpo.append('simular', '1');
+        resultadoCuradoria.textContent = simular ? 'Simulando...' : 'Excluindo...';
+
+        fetch('/history_ia/curadoria', {
+            method: 'POST',
+            headers: { 'Content-Type': 'application/x-www-form-urlencoded' },
+            body: corpo
+        })
+        .then(response => response.json())
+        .then(data => {
+            resultadoCuradoria.textContent = data.mensagem || '';
+            if (data.exemplos && data.exemplos.length) {
+                const exemplos = document.createElement('div');
+                exemplos.className = 'text-muted';
+                exemplos.textContent = 'Exemplos: ' + data.exemplos.join(' | ');
+                resultadoCuradoria.appendChild(exemplos);
+            }
+            if (!simular) {
+                mostrarSnackbar(data.mensagem || 'Erro na curadoria.', data.success ? 'success' : 'error');
+                if (data.success) carregarOperacoes();
+            }
+        })
+        .catch(() => {
+            resultadoCuradoria.textContent = '';
+            mostrarSnackbar('Erro de conexão.', 'error');
+        });
+    }
+
+    function itemOperacao(operacao) {
+        const li = document.createElement('li');
+        li.className = 'list-group-item d-flex justify-content-between align-items-center';
+        const texto = document.createElement('span');
+        texto.textContent = `${operacao.criada_em.replace('T', ' ')} · ${operacao.nome_layout}: ${operacao.descricao} (${operacao.quantidade})`;
+        li.appendChild(texto);
+        if (operacao.desfeita) {
+            const badge = document.createElement('span');
+            badge.className = 'badge bg-secondary';
+            badge.textContent = 'Desfeita';
+            li.appendChild(badge);
+        } else {
+            const botao = document.createElement('button');
+            botao.type = 'button';
+            botao.className = 'btn btn-sm btn-outline-primary';
+            botao.innerHTML = '<i class="bi bi-arrow-counterclockwise"></i> Desfazer';
+            botao.addEventListener('click', () => desfazerOperacao(operacao.operacao));
+            li.appendChild(botao);
+        }
+        return li;
+    }
+
+    function carregarOperacoes() {
+        if (!listaOperacoes) return;
+        const token = new URLSearchParams(window.location.search).get('token');
+        fetch('/history_ia/curadoria?' + new URLSearchParams({ token: token }))
+        .then(response => response.json())
+        .then(data => {
+            listaOperacoes.innerHTML = '';
+            (data.operacoes || []).forEach(operacao => listaOperacoes.appendChild(itemOperacao(operacao)));
+            if (!listaOperacoes.children.length) {
+                listaOperacoes.innerHTML = '<li class="list-group-item text-muted">Nenhuma operação registrada.</li>';
+            }
+        })
+        .catch(() => {
+            listaOperacoes.innerHTML = '<li class="list-group-item text-danger">Erro ao carregar operações.</li>';
+        });
+    }
+
+    function desfazerOperacao(operacao) {
+        const token = new URLSearchParams(window.location.search).get('token');
+        fetch('/history_ia/curadoria/desfazer', {
+            method: 'POST',
+            headers: { 'Content-Type': 'application/x-www-form-urlencoded' },
+            body: new URLSearchParams({ token: token, operacao: operacao })
+        })
+        .then(response => response.json())
+        .then(data => {
+            mostrarSnackbar(data.mensagem || 'Erro ao desfazer.', data.success ? 'success' : 'error');
+            carregarOperacoes();
+        })
+        .catch(() => mostrarSnackbar('Erro de conexão.', 'error'));
+    }
+
+    if (curadoria) {
+        formCuradoria.elements.layout.addEventListener('change', preencherCampos);
+        formCuradoria.elements.modo.addEventListener('change', alternarModo);
+        document.getElementById('btn-curadoria-simular').addEventListener('click', () => executarCuradoria(true));
+        document.getElementById('btn-curadoria-excluir').addEventListener('click', function() {
+            const select = formCuradoria.elements.layout;
+            dadosParaExcluir = { aoConfirmar: () => executarCuradoria(false) };
+            modalMsg.textContent = `Confirma a exclusão em massa em "${select.options[select.selectedIndex].text}"? Use "Simular" antes para conferir o que será removido.`;
+            modalConfirmacao.show();
+        });
+        alternarModo();
+        carregarOperacoes();
+    }
+
     // --- Snackbar e Mensagens ---
     function mostrarSnackbar(mensagem, tipo = 'info') {
         snackbar.textContent = mensagem;
@@ -0,0 +1,124 @@
+document.addEventListener("DOMContentLoaded", function() {
+    // --- Progresso ao vivo (SSE) durante o upload e a análise ---
+    var overlay = document.getElementById("loadingOverlay");
+    var painel = document.getElementById("progressoPainel");
+    if (!overlay || !painel || !window.EventSource) return;
+
+    var ETAPAS = {
+        upload: "Enviando arquivos",
+        leitura: "Lendo arquivo",
+        perfil: "Resumindo colunas",
+        mapeamento: "Sugerindo mapeamento",
+        carregando: "Carregando dados",
+        analise: "Validando campos",
+        historico: "Atualizando histórico",
+        concluido: "Concluído, carregando resultado",
+        erro: "Falha no processamento"
+    };
+
+    function novaChave() {
+        if (window.crypto && crypto.randomUUID) return crypto.randomUUID();
+        return Date.now().toString(36) + Math.random().toString(36).slice(2, 12);
+    }
+
+    function formataBytes(n) {
+        if (n >= 1048576) return (n / 1048576).toFixed(1) + " MB";
+        if (n >= 1024) return (n / 1024).toFixed(0) + " KB";
+        return n + " B";
+    }
+
+    function formataTempo(segundos) {
+        if (segundos == null) return "";
+        if (segundos < 60) return Math.ceil(segundos) + "s";
+        return Math.floor(segundos / 60) + "min " + Math.ceil(segundos % 60) + "s";
+    }
+
+    function formataQuantidade(dados, n) {
+        return dados.unidade === "bytes" ? formataBytes(n) : n.toLocaleString("pt-BR");
+    }
+
+    function render(dados) {
+        var mainMsg = document.getElementById("loadingMainMsg");
+        var extraMsg = document.getElementById("loadingExtraMsg");
+        var extraMsgTwo = document.getElementById("loadingExtraMsgTwo");
+        var barra = document.getElementById("progressoBarra");
+        var detalhe = document.getElementById("progressoDetalhe");
+        var lista = document.getElementById("progressoCampos");
+
+        painel.style.display = "block";
+        if (extraMsg) extraMsg.style.display = "none";
+        if (extraMsgTwo) extraMsgTwo.style.display = "none";
+
+        var titulo = ETAPAS[dados.etapa] || "Processando";
+        if (dados.arquivo) {
+            titulo += " - " + dados.arquivo;
+            if (dados.arquivos > 1) titulo += " (" + dados.arquivo_atual + " de " + dados.arquivos + ")";
+        }
+        if (mainMsg) mainMsg.textContent = dados.etapa === "erro" && dados.erro ? titulo + ": " + dados.erro : titulo;
+
+        var pct = dados.total ? Math.min(100, Math.floor(100 * dados.feito / dados.total)) : 0;
+        barra.style.width = (dados.etapa === "concluido" ? 100 : pct) + "%";
+
+        var partes = [];
+        if (dados.total) partes.push(formataQuantidade(dados, dados.feito) + " de " + formataQuantidade(dados, dados.total) + " (" + pct + "%)");
+        if (dados.etapa === "analise" && dados.linhas) partes.push(dados.linhas.toLocaleString("pt-BR") + " registro(s)");
+        if (dados.eta != null) partes.push("tempo restante estimado: " + formataTempo(dados.eta));
+        if (dados.etapa === "analise" || dados.campos.length) {
+            partes.push(dados.inconsistencias + " inconsistência(s), " + dados.invalidos.toLocaleString("pt-BR") + " valor(es) inválido(s) até agora");
+        }
+        detalhe.textContent = partes.join(" · ");
+
+        lista.innerHTML = "";
+        dados.campos.slice(-8).forEach(function(campo) {
+            var li = document.createElement("li");
+            li.textContent = campo.campo + ": " + campo.validos.toLocaleString("pt-BR") + " válido(s), "
+                + campo.invalidos.toLocaleString("pt-BR") + " inválido(s)";
+            if (campo.invalidos) li.className = "progresso-campo-invalido";
+            lista.appendChild(li);
+        });
+    }
+
+    // Sem progresso (o stream caiu ou a requisição foi para um worker que não publica onde este lê),
+    // o overlay volta às mensagens de espera em vez de ficar parado no último estado
+    var mainMsgOriginal = null;
+    function voltarMensagensEspera() {
+        var mainMsg = document.getElementById("loadingMainMsg");
+        var extraMsg = document.getElementById("loadingExtraMsg");
+        painel.style.display = "none";
+        if (extraMsg) extraMsg.style.display = "block";
+        if (mainMsg && mainMsgOriginal !== null) mainMsg.textContent = mainMsgOriginal;
+    }
+
+    function acompanhar(form) {
+        var chave = novaChave();
+        var mainMsg = document.getElementById("loadingMainMsg");
+        if (mainMsg) mainMsgOriginal = mainMsg.textContent;
+        var url = new URL(form.action, window.location.href);
+        url.searchParams.set("progresso", chave);
+        form.action = url.toString();
+
+        var fonte = new EventSource(overlay.dataset.progressoUrl + "?progresso=" + encodeURIComponent(chave));
+        var encerrado = false;
+        fonte.onmessage = function(e) {
+            var dados = JSON.parse(e.data);
+            render(dados);
+            if (dados.etapa === "concluido" || dados.etapa === "erro") {
+                encerrado = true;
+                fonte.close();
+            }
+        };
+        // Sem reconexão: se o stream cair antes do fim, ficam as mensagens de espera
+        fonte.onerror = function() {
+            fonte.close();
+            if (!encerrado) voltarMensagensEspera();
+        };
+    }
+
+    ["uploadForm", "formMapear"].forEach(function(id) {
+        var form = document.getElementById(id);
+        if (!form) return;
+        form.addEventListener("submit", function(e) {
+            if (!e.defaultPrevented) acompanhar(form);
+        });
+    });
+});
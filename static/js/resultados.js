@@ -0,0 +1,134 @@
+document.addEventListener("DOMContentLoaded", function() {
+    // --- Inconsistências carregadas sob demanda da rota paginada de resultados ---
+    var resultados = document.querySelector(".resultados[data-resultados-url]");
+    if (!resultados) return;
+    var urlResultados = resultados.dataset.resultadosUrl;
+    var urlAmostra = resultados.dataset.amostraUrl;
+    var caixas = Array.prototype.slice.call(resultados.querySelectorAll(".inc-box[data-arquivo]"));
+
+    function buscar(url, params) {
+        var busca = new URLSearchParams(params);
+        return fetch(url + "?" + busca.toString()).then(function(r) {
+            if (!r.ok) throw new Error("HTTP " + r.status);
+            return r.json();
+        });
+    }
+
+    function renderAmostra(titulo, dados) {
+        var lista = document.createElement("ul");
+        lista.className = "amostra-lista";
+        dados.amostra.forEach(function(valor, i) {
+            var li = document.createElement("li");
+            li.className = "amostra-exemplo";
+            li.textContent = valor;
+            if (dados.ocorrencias[i] > 1) {
+                var ocorrencias = document.createElement("span");
+                ocorrencias.className = "amostra-ocorrencias";
+                ocorrencias.textContent = " (" + dados.ocorrencias[i] + "×)";
+                li.appendChild(ocorrencias);
+            }
+            lista.appendChild(li);
+        });
+        titulo.parentNode.insertBefore(lista, titulo.nextSibling);
+        titulo.classList.add("inc-aberto");
+    }
+
+    // Busca a amostra uma vez; os cliques seguintes só mostram/escondem a lista
+    function expandir(titulo, alternar) {
+        var lista = titulo.nextElementSibling;
+        if (lista && lista.classList.contains("amostra-lista")) {
+            if (alternar) {
+                lista.hidden = !lista.hidden;
+                titulo.classList.toggle("inc-aberto", !lista.hidden);
+            }
+            return Promise.resolve();
+        }
+        if (titulo._carregando) return titulo._carregando;
+        titulo._carregando = buscar(urlAmostra, {arquivo: titulo.dataset.arquivo, chave: titulo.dataset.chave})
+            .then(function(dados) { renderAmostra(titulo, dados); })
+            .finally(function() { titulo._carregando = null; });
+        return titulo._carregando;
+    }
+
+    function renderItem(caixa, item) {
+        var titulo = document.createElement("div");
+        titulo.className = "inc-titulo";
+        titulo.dataset.arquivo = item.arquivo;
+        titulo.dataset.chave = item.chave;
+
+        var campo = document.createElement("span");
+        campo.className = "inc-campo";
+        campo.textContent = item.label;
+        if (item.obrigatorio) {
+            var asterisco = document.createElement("span");
+            asterisco.className = "inc-asterisco";
+            asterisco.textContent = "*";
+            campo.appendChild(asterisco);
+        }
+        campo.appendChild(document.createTextNode(": "));
+        var descricao = document.createElement("span");
+        descricao.className = "inc-descricao";
+        descricao.textContent = item.mensagem;
+        titulo.appendChild(campo);
+        titulo.appendChild(descricao);
+
+        if (item.amostras) {
+            titulo.classList.add("inc-expansivel");
+            titulo.title = "Clique para ver a amostra (" + item.amostras + " valor(es))";
+            titulo.addEventListener("click", function() {
+                expandir(titulo, true).catch(function() { titulo.title = "Falha ao carregar a amostra. Tente novamente."; });
+            });
+        }
+        caixa.querySelector('.grupo-inc[data-obrigatorio="' + (item.obrigatorio ? 1 : 0) + '"]').appendChild(titulo);
+    }
+
+    function carregarPagina(caixa) {
+        var pagina = (Number(caixa.dataset.pagina) || 0) + 1;
+        var botao = caixa.querySelector(".btn-mais-inconsistencias");
+        botao.disabled = true;
+        return buscar(urlResultados, {arquivo: caixa.dataset.arquivo, pagina: pagina}).then(function(dados) {
+            dados.itens.forEach(function(item) { renderItem(caixa, item); });
+            caixa.dataset.pagina = dados.pagina;
+            caixa.dataset.completo = dados.pagina >= dados.paginas ? "1" : "";
+            botao.hidden = !!caixa.dataset.completo;
+            botao.disabled = false;
+        }).catch(function(erro) {
+            botao.hidden = false;
+            botao.disabled = false;
+            botao.textContent = "Erro ao carregar. Tentar novamente";
+            throw erro;
+        });
+    }
+
+    function carregarTudo() {
+        return Promise.all(caixas.map(function carregarRestante(caixa) {
+            if (caixa.dataset.completo) return Promise.resolve();
+            return carregarPagina(caixa).then(function() { return carregarRestante(caixa); });
+        })).then(function() {
+            var titulos = resultados.querySelectorAll(".inc-titulo.inc-expansivel");
+            return Promise.all(Array.prototype.map.call(titulos, function(titulo) { return expandir(titulo, false); }));
+        });
+    }
+
+    caixas.forEach(function(caixa) {
+        caixa.querySelector(".btn-mais-inconsistencias").addEventListener("click", function() {
+            carregarPagina(caixa).catch(function() {});
+        });
+        carregarPagina(caixa).catch(function() {});
+    });
+
+    // O relatório copiado lê o que está na página: antes dele, carrega todas as páginas e amostras
+    var copiaPronta = false;
+    document.addEventListener("click", function(e) {
+        var botao = e.target.closest && e.target.closest("#copyResultBtn");
+        if (!botao || copiaPronta) return;
+        e.preventDefault();
+        e.stopImmediatePropagation();
+        botao.disabled = true;
+        carregarTudo().catch(function() {}).then(function() {
+            copiaPronta = true;
+            botao.disabled = false;
+            botao.click();
+        });
+    }, true);
+});